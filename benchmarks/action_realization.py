@@ -0,0 +1,130 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Benchmark `Action.realize` / `MetaAction.realize` against the previous deepcopy-based implementation.
+
+Run `python -m benchmarks.action_realization` from the repository root.
+"""
+import argparse
+import copy
+import json
+import random
+import time
+
+from dialog_generation.dataclass import Action, MetaAction
+
+STYLES = [(v, m) for v in ['verbosity_low', 'verbosity_mid', 'verbosity_high'] for m in ['mirroring', 'no_mirroring']]
+
+
+def legacy_realize(action: Action) -> str:
+    """ `Action.realize` before it became copy-free (kept verbatim as the reference). """
+    if action.arguments:
+        kv_list = []
+        for key, val in action.arguments.items():
+            if isinstance(val, Action):
+                if key == '':
+                    kv_list.append("{}".format(legacy_realize(val)))
+                else:
+                    kv_list.append("{}={}".format(key, legacy_realize(val)))
+            elif val or val == 0:
+                kv_list.append("{}={}".format(key, json.dumps(val, ensure_ascii=False)))
+            else:
+                kv_list.append("{}".format(key))
+        arguments_expression = ', '.join(kv_list)
+    else:
+        arguments_expression = ''
+    if action.no_bracket:
+        action_string = '{intent}'.format(intent=action.action_name)
+    else:
+        action_string = '{intent}({args})'.format(intent=action.action_name, args=arguments_expression)
+    if action.service_prefix:
+        action_string = '{prefix}_'.format(prefix=action.service_prefix) + action_string
+    if action.item_index or action.item_index == 0:
+        action_string += '[{}]'.format(action.item_index)
+    if action.attribute:
+        if isinstance(action.attribute, Action):
+            action_string += '.{}'.format(legacy_realize(action.attribute))
+        else:
+            action_string += '.{}'.format(action.attribute)
+    if action.referral_action:
+        action_string = legacy_realize(action.referral_action) + '.' + action_string
+    return action_string
+
+
+def legacy_meta_realize(meta_action: MetaAction, style=()) -> str:
+    if 'mirroring' in style and meta_action.special_mirroring_action:
+        action_to_realize = copy.deepcopy(meta_action.special_mirroring_action)
+    else:
+        action_to_realize = copy.deepcopy(meta_action.default_action)
+    if 'verbosity_low' in style and meta_action.special_low_verbosity:
+        action_to_realize.arguments = None
+    return legacy_realize(action_to_realize)
+
+
+def build_compositional_action(rng: random.Random, depth: int, width: int) -> Action:
+    """ A chain of `depth` nested intents, each with `width` slot values and a referral to a context entity. """
+    arguments = {f'slot_{i}': rng.choice(['Team sync', 'Thu 2024-10-17', '09:30', ['Ann Lee', 'Bo Chen'], 3, True])
+                 for i in range(width)}
+    action = Action(action_name='modify', service_prefix='calendar_events', arguments=arguments,
+                    referral_action=Action(action_name='get_calendar_events', arguments={'ordered_by': 'date', 'index': 2},
+                                           referral_event_index=1))
+    if depth > 1:
+        inner = build_compositional_action(rng, depth - 1, width)
+        inner.attribute = 'summary'
+        action.arguments['name'] = inner
+    return action
+
+
+def build_plot(rng: random.Random, turns: int, depth: int, width: int):
+    user_actions, system_actions = [], []
+    for _ in range(turns):
+        core_action = build_compositional_action(rng, depth, width)
+        proper_action = copy.deepcopy(core_action)
+        proper_action.referral_action = Action(action_name='get_calendar_events', arguments={'name': 'Team sync'},
+                                               referral_event_index=1)
+        user_actions.append([core_action])
+        system_actions.append([MetaAction(default_action=Action(action_name='notify_done', arguments={'': proper_action}),
+                                          special_mirroring_action=Action(action_name='notify_done', arguments={'': core_action}),
+                                          special_low_verbosity=True)])
+    return user_actions, system_actions
+
+
+def run_legacy(user_actions, system_actions):
+    user = [[legacy_realize(a) for a in turn] for turn in user_actions]
+    system = [[[legacy_meta_realize(a, style) for a in turn] for style in STYLES] for turn in system_actions]
+    return user, system
+
+
+def run_copy_free(user_actions, system_actions):
+    cache = {}
+    user = [[a.realize(cache=cache) for a in turn] for turn in user_actions]
+    system = [[[a.realize(style, cache=cache) for a in turn] for style in STYLES] for turn in system_actions]
+    return user, system
+
+
+def measure(func, *args, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, help='Number of turns of the plot.', default=8)
+    parser.add_argument('--depth', type=int, help='Nesting depth of the compositional actions.', default=4)
+    parser.add_argument('--width', type=int, help='Number of slot values per action.', default=4)
+    parser.add_argument('--repeat', type=int, help='Number of timed repetitions (the best one is reported).', default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    plot = build_plot(random.Random(args.seed), args.turns, args.depth, args.width)
+    assert run_legacy(*plot) == run_copy_free(*plot), "Copy-free realization differs from the reference"
+    legacy_time = measure(run_legacy, *plot, repeat=args.repeat)
+    copy_free_time = measure(run_copy_free, *plot, repeat=args.repeat)
+    print(f"turns={args.turns} depth={args.depth} width={args.width} (user turn + 6 styles per system turn)")
+    print(f"legacy (deepcopy): {legacy_time * 1000:.3f} ms")
+    print(f"copy-free:         {copy_free_time * 1000:.3f} ms ({legacy_time / copy_free_time:.1f}x)")
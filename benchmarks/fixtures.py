@@ -0,0 +1,179 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Fixed-seed inputs for the benchmarks, built without the LLM: synthetic raw contexts (in the `contexts.jsonl`
+format), operations and plots sampled from them, generated-looking dialog records and a census surname table.
+
+`use_offline_slot_values()` replaces the LLM requests of `slot_value_sampler` by deterministic placeholder values
+and empties the slot value bank, so that plot generation is reproducible and only measures local code.
+"""
+import json
+import logging
+import random
+import re
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from dialog_generation import slot_value_sampler
+from dialog_generation.context_loader import convert_context
+from dialog_generation.main import derive_seed
+from dialog_generation.operation_sampler import get_operation
+from dialog_generation.plot_generator import get_initial_buffer
+from dialog_generation.serialization import encode_buffer
+from dialog_generation.slot_value_bank import SlotValueBank
+from dialog_generation.slot_value_sampler import populate_operation_slot_values
+
+FIRST_NAMES = ['Ann', 'Bo', 'Cyrus', 'Dana', 'Eli', 'Farah', 'Gus', 'Hana', 'Ivan', 'Jo', 'Kai', 'Lena', 'Milo',
+               'Nora', 'Omar', 'Pia', 'Quinn', 'Rosa', 'Sam', 'Tara']
+LAST_NAMES = ['Lee', 'Chen', 'Dorn', 'Evans', 'Fox', 'Garcia', 'Hale', 'Ito', 'Jones', 'Kim', 'Lopez', 'Moore']
+RELATIONSHIPS = ['sister', 'brother', 'friend', 'colleague', 'boss', 'dentist', 'mother', 'neighbor', 'coach']
+EVENT_NAMES = ['Team sync', 'Dentist appointment', 'Yoga class', 'Project review', 'Lunch with {}', 'Call {}',
+               'Book club', 'Flight to Boston', 'Parent-teacher meeting', 'Gym session']
+TODOS = ['Buy milk', 'Pay the rent', 'Call {}', 'Renew passport', 'Water the plants', 'Send the report to {}',
+         'Pick up the dry cleaning', 'Book a table for {}']
+MESSAGES = ['See you at 5?', 'Running late, sorry!', 'Did you get my email?', 'Lunch tomorrow?', 'Happy birthday!',
+            'Can you send me the slides?', 'Thanks for yesterday.', 'Where are we meeting?']
+
+SETUP = {
+    'event_execute_count': 5,
+    'user_speaking_speed': 'slow',
+    'system_mirror_switch': False,
+    'system_kid_switch': False,
+}
+STYLES = [(v, m) for v in ['verbosity_low', 'verbosity_mid', 'verbosity_high'] for m in ['mirroring', 'no_mirroring']]
+
+
+def make_raw_context(rng: random.Random, index: int) -> dict:
+    """ A persona context like the ones of `context_generation.context_generator`. """
+    today = date(2023, 7, 1) + timedelta(days=rng.randrange(365 * 5))
+    names = rng.sample([f'{first} {last}' for first in FIRST_NAMES for last in LAST_NAMES], k=rng.randint(8, 20))
+    contacts = [{'full_name': name, 'relationship': rng.choice(RELATIONSHIPS)} for name in names]
+
+    def timestamp(days_range: int, with_time: bool = True) -> datetime:
+        moment = datetime.combine(today, datetime.min.time()) + timedelta(days=rng.randrange(-3, days_range))
+        return moment + timedelta(hours=rng.randrange(7, 21), minutes=rng.choice([0, 15, 30, 45])) if with_time else moment
+
+    events = []
+    for _ in range(rng.randint(5, 15)):
+        all_day = rng.random() < 0.15
+        start = timestamp(30, with_time=not all_day)
+        time_format = '%a %Y-%m-%d' if all_day else '%a %Y-%m-%d %H:%M'
+        events.append({
+            'calendar_name': rng.choice(['work', 'personal']),
+            'event_name': rng.choice(EVENT_NAMES).format(rng.choice(names)),
+            'all_day': all_day,
+            'repeated': rng.random() < 0.2,
+            'start_time': start.strftime(time_format),
+            'end_time': (start + timedelta(days=1) if all_day else start + timedelta(minutes=rng.choice([30, 60, 90]))).strftime(time_format),
+            'host': 'myself',
+            'attendees': rng.sample(names, k=rng.randint(0, 3)),
+            'location': rng.choice(['', 'Room 1', 'Cafe Luna', 'Home']),
+        })
+    reminders = []
+    for _ in range(rng.randint(3, 10)):
+        reminder = {'todo': rng.choice(TODOS).format(rng.choice(names))}
+        if rng.random() < 0.7:
+            reminder['trigger_time'] = timestamp(14).strftime('%a %Y-%m-%d %H:%M')
+        if rng.random() < 0.3:
+            reminder['notes'] = rng.choice(MESSAGES)
+        reminders.append(reminder)
+    alarms = [{'time': f'{rng.randrange(5, 23):0>2}:{rng.choice([0, 15, 30, 45]):0>2}', 'name': rng.choice(['', 'Wake up', 'Meds', 'Gym']),
+               'recurring': rng.random() < 0.5} for _ in range(rng.randint(1, 5))]
+    messages = {}
+    for name in rng.sample(names, k=min(len(names), rng.randint(2, 6))):
+        messages[name] = [{'sender': rng.choice([name, 'myself']), 'message': rng.choice(MESSAGES)}
+                          for _ in range(rng.randint(1, 6))]
+    return {
+        'id': f'bench{index}',
+        'intro': f'{rng.choice(FIRST_NAMES)} is a {rng.randint(22, 70)}-year-old {rng.choice(["teacher", "nurse", "engineer", "chef"])}.',
+        'apps': {'today': today.strftime('%Y-%m-%d'), 'projects': [], 'contacts': contacts, 'calendar_events': events,
+                 'reminders': reminders, 'alarms': alarms, 'messages': messages},
+    }
+
+
+def make_raw_contexts(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return [make_raw_context(rng, index) for index in range(count)]
+
+
+def offline_llm_response(prompt: str, stage: str):
+    """ Deterministic stand-in for `slot_value_sampler._request_openai_response`. """
+    if stage == 'summary':
+        return {'summary': 'Here are a few options.'}
+    slots = json.loads(re.findall(r'Slots: (\[.*?\])', prompt)[-1])
+    return [{slot: f'{slot.replace("_", " ")} {k}' for slot in slots} for k in range(5)]
+
+
+def use_offline_slot_values() -> None:
+    slot_value_sampler._request_openai_response = offline_llm_response
+    SlotValueBank.load('/nonexistent/slot_value_bank.jsonl')  # An empty bank, whatever is in data/
+    logging.getLogger().setLevel(logging.ERROR)  # Plot generation logs every datapoint
+
+
+def sample_operations(contexts: list, phenomena: str, count: int, seed: int = 0) -> list:
+    """ `count` (context, operation, rng) triples with filled slot values, ready for plot generation. The contexts
+    are converted, and datapoints whose sampling fails are skipped (deterministically).
+    """
+    samples = []
+    index = 0
+    while len(samples) < count and index < 20 * count:
+        rng = random.Random(derive_seed(seed, index))
+        context = convert_context(contexts[index % len(contexts)], rng)
+        index += 1
+        try:
+            operation = get_operation(context, phenomena, rng=rng)
+            populate_operation_slot_values(operation, context, rng)
+        except Exception:
+            continue
+        samples.append((context, operation, rng))
+    return samples
+
+
+def make_dialog_records(contexts: list, phenomena: str, count: int, seed: int = 0) -> list:
+    """ Encoded dialog records like the output of `dialog_generation.main`, with utterances built from the
+    realized actions (so they mention the slot values) in place of generated ones.
+    """
+    records = []
+    for context, operation, rng in sample_operations(contexts, phenomena, 2 * count, seed):
+        try:
+            buffer = get_initial_buffer(SETUP, context, operation=operation, rng=rng)
+        except Exception:
+            continue
+        conversation, response_options = [], []
+        for user_actions, system_actions in zip(buffer['dialog_action_user'], buffer['dialog_action_system']):
+            conversation.append(' and '.join(action.realize() for action in user_actions))
+            options = {style: ' and '.join(action.realize(style) for action in system_actions) for style in STYLES}
+            conversation.append(options[('verbosity_high', 'no_mirroring')])
+            response_options.append(options)
+        buffer.update({'id': f'bench-{phenomena}-{len(records)}', 'conversation': conversation,
+                       'response_options': response_options})
+        records.append(json.loads(json.dumps(encode_buffer(buffer), ensure_ascii=False, default=str)))
+        if len(records) == count:
+            break
+    return records
+
+
+def make_census(rows: int = 2000, seed: int = 0):
+    """ A table shaped like `resources/Names_2010Census.csv` after `load_surnames` (which needs the census file). """
+    rng = np.random.default_rng(seed)
+    races = ['pctwhite', 'pctblack', 'pctapi', 'pctaian', 'pct2prace', 'pcthispanic']
+    shares = rng.dirichlet(np.ones(len(races)), size=rows) * 100
+    shares[rng.random((rows, len(races))) < 0.1] = np.nan  # Suppressed values, "(S)" in the census file
+    df_surnames = pd.DataFrame({
+        'name': [f'SURNAME{i}' for i in range(rows)],
+        'rank': np.arange(1, rows + 1),
+        'count': np.sort(rng.integers(100, 2_000_000, rows))[::-1],
+        'prop100k': rng.random(rows),
+        'cum_prop100k': rng.random(rows),
+        **{race: shares[:, i] for i, race in enumerate(races)},
+    })
+    race_to_count = {}
+    for pct_col in races:
+        cnt_col = 'cnt' + pct_col[3:]
+        df_surnames[cnt_col] = df_surnames['count'] * df_surnames[pct_col].fillna(0) / 100
+        race_to_count[cnt_col] = sum(df_surnames[cnt_col])
+    return df_surnames, race_to_count
+
@@ -0,0 +1,97 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Compare the conversation history strategies of dialog generation: prompt tokens per dialog against the share of
+dialogs passing quality control.
+
+Every strategy generates the same datapoints (same seeds), so the plots are identical and only the prompts differ.
+This calls the configured LLM. Run from the repository root, e.g.
+`python -m benchmarks.history_strategies --phenomena compound --number_of_data 50 --llm_check`.
+"""
+import argparse
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dialog_generation import dialog_generator
+from dialog_generation.context_loader import load_converted_contexts, finalize_context
+from dialog_generation.dialog_generator import HISTORY_STRATEGIES
+from dialog_generation.main import derive_seed, generate_single_datapoint
+from quality_control.main import filter_nan_data, filter_misformat_data, filter_inconsistent_data_by_llm
+from utilities.llm_synthesis_utils import count_tokens
+
+_local = threading.local()
+
+
+def _counting(get_response, role):
+    def wrapper(prompt=None, messages=None, **kwargs):
+        if getattr(_local, 'prompt_tokens', None) is not None:
+            _local.prompt_tokens.append((role, count_tokens(prompt)))
+        return get_response(prompt, messages, **kwargs)
+    return wrapper
+
+
+dialog_generator.get_user_response = _counting(dialog_generator.get_user_response, 'user')
+dialog_generator.get_system_response = _counting(dialog_generator.get_system_response, 'system')
+
+
+def generate(strategy, args, contexts):
+    setup = {
+        'event_execute_count': 5,
+        'user_speaking_speed': 'slow',
+        'system_mirror_switch': False,
+        'system_kid_switch': False,
+        'history_strategy': strategy,
+        'history_turns': args.history_turns,
+    }
+
+    def _generate(index):
+        _local.prompt_tokens = []
+        rng = random.Random(derive_seed(args.seed, index))
+        context = finalize_context(contexts[index % len(contexts)], rng)
+        record = generate_single_datapoint(setup, context, args.phenomena, if_full_response_options=True,
+                                           data_id=str(index), rng=rng)
+        prompt_tokens, _local.prompt_tokens = _local.prompt_tokens, None
+        return record, prompt_tokens
+
+    with ThreadPoolExecutor(args.thread_num) as executor:
+        return list(executor.map(_generate, range(args.number_of_data)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--phenomena', type=str, help='The phenomena to simulate.', default='compound')
+    parser.add_argument('--number_of_data', type=int, help='Number of dialogs per strategy.', default=20)
+    parser.add_argument('--strategies', type=str, nargs='+', choices=HISTORY_STRATEGIES, default=HISTORY_STRATEGIES)
+    parser.add_argument('--history_turns', type=int, help='Turns shown verbatim by `last_k` and `actions`.', default=4)
+    parser.add_argument('--thread_num', type=int, help='Number of threads to use.', default=5)
+    parser.add_argument('--llm_check', action='store_true', help='Also run the LLM consistency check of quality control.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.ERROR)
+
+    contexts = load_converted_contexts()
+    rows = []
+    for strategy in args.strategies:
+        results = generate(strategy, args, contexts)
+        # Failed dialogs keep their raw, partially generated buffer
+        finished = [(record, tokens) for record, tokens in results if 'failure' not in record and record.get('conversation')]
+        dialog_tokens = [sum(n for _, n in tokens) for _, tokens in finished]
+        # Flat per-turn cost means the last user prompt is about as long as the first one
+        user_prompts = [[n for role, n in tokens if role == 'user'] for _, tokens in finished]
+        first_turn = [n[0] for n in user_prompts if n]
+        last_turn = [n[-1] for n in user_prompts if n]
+        data = filter_misformat_data(filter_nan_data([record for record, _ in finished]))
+        passed = len(data)
+        if args.llm_check and data:
+            passed = len(filter_inconsistent_data_by_llm(data))
+        mean = lambda values: sum(values) / len(values) if values else 0.0
+        rows.append((strategy, len(finished), mean(dialog_tokens), mean(first_turn), mean(last_turn),
+                     passed / len(finished) if finished else 0.0))
+
+    print(f"{args.phenomena}, {args.number_of_data} dialogs per strategy, history_turns={args.history_turns}")
+    print(f"{'strategy':<10}{'dialogs':>9}{'tokens/dialog':>15}{'first user prompt':>19}{'last user prompt':>18}{'QC pass':>9}")
+    for strategy, count, tokens, first, last, pass_rate in rows:
+        print(f"{strategy:<10}{count:>9}{tokens:>15.0f}{first:>19.0f}{last:>18.0f}{pass_rate:>9.1%}")
@@ -0,0 +1,186 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" End-to-end load test: runs `dialog_generation.main` (each phenomena, with and without `--full_options_mode`)
+and `quality_control.main` (on the full options dialogs) against the fake LLM server of `utilities.fake_llm_server`, for a sweep of
+`--thread_num`, and reports dialogs per minute, LLM calls per dialog, LLM latency percentiles and peak RSS.
+
+Run `python -m benchmarks.load_test --thread_nums 1 4 16 --latency 0.5 --csv load_test.csv` from the repository
+root. The runs use a scratch directory with `data/schema.json` and synthetic contexts (or `--contexts`); extra
+arguments of `dialog_generation.main` are passed with e.g. `--main_args "--engine async --llm_concurrency 16"`.
+"""
+import argparse
+import csv
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from utilities.fake_llm_server import add_server_arguments, server_from_args
+from utilities.llm_trace import TRACE_SUFFIX, format_table, load_trace, percentile
+from .fixtures import make_raw_contexts
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+PHENOMENA = ['none', 'compound', 'compositional']
+
+
+def setup_workdir(workdir: Path, contexts: Path = None, num_contexts: int = 50) -> None:
+    """ A scratch directory with what the pipeline reads from `data/`. """
+    (workdir / 'data').mkdir(parents=True, exist_ok=True)
+    shutil.copy(REPO_ROOT / 'data' / 'schema.json', workdir / 'data' / 'schema.json')
+    if (REPO_ROOT / 'data' / 'slot_value_bank.jsonl').exists():
+        shutil.copy(REPO_ROOT / 'data' / 'slot_value_bank.jsonl', workdir / 'data' / 'slot_value_bank.jsonl')
+    if contexts is not None:
+        shutil.copy(contexts, workdir / 'data' / 'contexts.jsonl')
+    else:
+        with open(workdir / 'data' / 'contexts.jsonl', 'w') as fp:
+            for context in make_raw_contexts(num_contexts):
+                fp.write(json.dumps(context, ensure_ascii=False) + '\n')
+
+
+def read_metric(path: Path, sample: str) -> float:
+    """ The value of a sample (name with labels, as written) of a Prometheus textfile, 0 if absent. """
+    if not path.exists():
+        return 0
+    with open(path, 'r') as fp:
+        for line in fp:
+            if line.startswith(sample + ' '):
+                return float(line.split()[-1])
+    return 0
+
+
+def read_peak_rss(pid: int) -> float:
+    """ The peak resident memory of a running process (MiB), from /proc (Linux; 0 elsewhere). The children's
+    `ru_maxrss` is no substitute: after fork and exec, it starts from the RSS of the parent.
+    """
+    try:
+        with open(f'/proc/{pid}/status', 'r') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0
+
+
+def run_process(command, workdir: Path, env: dict, log_path: Path):
+    """ Run a pipeline command; returns its exit code, wall time (s) and peak RSS (MiB). """
+    peak_rss = 0
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        while True:
+            peak_rss = max(peak_rss, read_peak_rss(process.pid))
+            try:
+                process.wait(timeout=0.1)
+                break
+            except subprocess.TimeoutExpired:
+                continue
+        elapsed = time.perf_counter() - start
+    return process.returncode, elapsed, peak_rss
+
+
+def summarize_run(stage: str, threads, full_options: bool, returncode: int, elapsed: float, peak_rss: float,
+                  dialogs: float, failed: float, trace_path: Path, rate_limited: int) -> dict:
+    records = load_trace(trace_path) if trace_path.exists() else []
+    latencies = sorted(record['latency'] for record in records)
+    return {
+        'stage': stage,
+        'full_options': full_options,
+        'threads': threads,
+        'status': 'ok' if returncode == 0 else f'exit {returncode}',
+        'dialogs': int(dialogs),
+        'failed': int(failed),
+        'wall_s': elapsed,
+        'dialogs_per_min': 60 * dialogs / elapsed if elapsed else 0.0,
+        'llm_calls': len(records),
+        'calls_per_dialog': len(records) / dialogs if dialogs else 0.0,
+        'p50_s': percentile(latencies, 50),
+        'p95_s': percentile(latencies, 95),
+        'p99_s': percentile(latencies, 99),
+        'rate_limited': rate_limited,
+        'peak_rss_mib': peak_rss,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the pipeline against a fake LLM server.')
+    parser.add_argument('--thread_nums', type=int, nargs='+', help='Values of --thread_num to sweep.', default=[1, 4, 16])
+    parser.add_argument('--phenomena', type=str, nargs='+', choices=PHENOMENA, default=PHENOMENA)
+    parser.add_argument('--full_options', type=str, choices=['off', 'on', 'both'], help='Runs with --full_options_mode.', default='both')
+    parser.add_argument('--number_of_data', type=int, help='Dialogs per run.', default=20)
+    parser.add_argument('--main_args', type=str, help='Additional arguments of dialog_generation.main.', default='')
+    parser.add_argument('--skip_qc', action='store_true', help='Do not run quality_control.main on the generated dialogs.')
+    parser.add_argument('--contexts', type=Path, help='contexts.jsonl to use (default: synthetic contexts).', default=None)
+    parser.add_argument('--workdir', type=Path, help='Scratch directory of the runs (default: a temporary one).', default=None)
+    parser.add_argument('--csv', type=Path, help='Write the results to this CSV file.', default=None)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix='toad_load_test_'))
+    setup_workdir(workdir, args.contexts)
+    modes = {'off': [False], 'on': [True], 'both': [False, True]}[args.full_options]
+    rows = []
+    with server_from_args(args) as server:
+        env = {**os.environ, 'BASE_URL': server.base_url, 'OPENAI_API_KEY': 'fake', 'ENGINE': 'fake',
+               'PYTHONPATH': os.pathsep.join([str(REPO_ROOT), os.environ.get('PYTHONPATH', '')])}
+        # Convert the contexts once, so that the first run doesn't pay for it
+        subprocess.run([sys.executable, '-m', 'dialog_generation.context_loader'], cwd=workdir, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        for full_options in modes:
+            for thread_num in args.thread_nums:
+                run_dir = workdir / f"threads{thread_num}{'_full' if full_options else ''}"
+                run_dir.mkdir(exist_ok=True)
+                for phenomena in args.phenomena:
+                    metrics_path = run_dir / f'{phenomena}.prom'
+                    command = [sys.executable, '-m', 'dialog_generation.main', '--phenomena', phenomena,
+                               '--output_dir', str(run_dir), '--number_of_data', str(args.number_of_data),
+                               '--thread_num', str(thread_num), '--erase_previous_data', '--seed', '0', '--llm_trace',
+                               '--metrics_file', str(metrics_path), *shlex.split(args.main_args)]
+                    if full_options:
+                        command.append('--full_options_mode')
+                    rate_limited = server.stats['rate_limited']
+                    returncode, elapsed, peak_rss = run_process(command, workdir, env, run_dir / f'{phenomena}.log')
+                    rows.append(summarize_run(
+                        phenomena, thread_num, full_options, returncode, elapsed, peak_rss,
+                        read_metric(metrics_path, 'toad_datapoints_total{outcome="generated"}'),
+                        read_metric(metrics_path, 'toad_datapoints_total{outcome="failed"}'),
+                        run_dir / f'{phenomena}{TRACE_SUFFIX}', server.stats['rate_limited'] - rate_limited))
+                    print(format_table([rows[-1]]).splitlines()[-1], flush=True)
+
+            if full_options and not args.skip_qc:
+                # Quality control needs all the response options, and its LLM check runs a fixed number of threads:
+                # measured once, on the dialogs of the largest --thread_num
+                qc_dir = run_dir / 'qc'
+                command = [sys.executable, '-m', 'quality_control.main', '--input_dir', str(run_dir),
+                           '--output_dir', str(qc_dir), '--llm_trace']
+                rate_limited = server.stats['rate_limited']
+                returncode, elapsed, peak_rss = run_process(command, workdir, env, run_dir / 'qc.log')
+                trace_path = qc_dir / f'qc{TRACE_SUFFIX}'
+                checked = len(load_trace(trace_path)) if trace_path.exists() else 0
+                rows.append(summarize_run('qc', '-', full_options, returncode, elapsed, peak_rss, checked, 0,
+                                          trace_path, server.stats['rate_limited'] - rate_limited))
+                print(format_table([rows[-1]]).splitlines()[-1], flush=True)
+
+    print(f'\nFake LLM: latency {args.latency} s, jitter {args.jitter}, rpm {args.rpm}, '
+          f'max concurrency {args.max_concurrency}; runs in {workdir}\n')
+    print(format_table(rows))
+    print('\nDialogs per minute by --thread_num:')
+    curves = {}
+    for row in rows:
+        if row['stage'] != 'qc':
+            key = f"{row['stage']}{' full' if row['full_options'] else ''}"
+            curves.setdefault(key, {'run': key})[f"threads={row['threads']}"] = row['dialogs_per_min']
+    print(format_table(list(curves.values())))
+    if args.csv:
+        with open(args.csv, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f'\nResults written to {args.csv}')
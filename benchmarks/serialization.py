@@ -0,0 +1,118 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Benchmark the dialog record encoder/decoder in `dialog_generation.serialization` against dataclasses_json.
+
+Run `python -m benchmarks.serialization --input data/dialogs/compound.jsonl` from the repository root
+(without `--input`, a synthetic corpus is used).
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from dialog_generation.dataclass import Action, MetaAction, SystemResponseStyle
+from dialog_generation.serialization import (action_from_dict, meta_action_from_dict, encode_buffer, dumps_record,
+                                             loads_record)
+from .action_realization import build_plot
+
+
+def load_corpus(path, limit=None):
+    records = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            d = json.loads(line)
+            if d.get('dialog_action_user') and d.get('dialog_action_system'):
+                records.append(d)
+            if limit and len(records) >= limit:
+                break
+    return records
+
+
+def build_synthetic_corpus(size: int, seed: int = 0):
+    rng = random.Random(seed)
+    records = []
+    for _ in range(size):
+        user_actions, system_actions = build_plot(rng, turns=rng.randint(2, 6), depth=rng.randint(1, 3), width=3)
+        buffer = {
+            'dialog_action_user': user_actions,
+            'dialog_action_system': system_actions,
+            'system_optimal_style': [SystemResponseStyle(verbosity='verbosity_high', additional=[]) for _ in system_actions],
+            'conversation': ['{"actions": [], "utterance": "Hello there."}'] * (len(user_actions) + len(system_actions)),
+        }
+        records.append(json.loads(json.dumps(encode_buffer(buffer), ensure_ascii=False)))
+    return records
+
+
+def decode_legacy(records):
+    return [([[Action.convert_from_dict(a) for a in turn] for turn in d['dialog_action_user']],
+             [[MetaAction.convert_from_dict(a) for a in turn] for turn in d['dialog_action_system']],
+             [SystemResponseStyle.from_dict(s) for s in d['system_optimal_style']]) for d in records]
+
+
+def decode_fast(records):
+    return [([[action_from_dict(a) for a in turn] for turn in d['dialog_action_user']],
+             [[meta_action_from_dict(a) for a in turn] for turn in d['dialog_action_system']],
+             [SystemResponseStyle(**s) for s in d['system_optimal_style']]) for d in records]
+
+
+def encode_legacy(decoded):
+    lines = []
+    for user_actions, system_actions, styles in decoded:
+        record = {
+            'dialog_action_user': [[a.to_dict() for a in turn] for turn in user_actions],
+            'dialog_action_system': [[a.to_dict() for a in turn] for turn in system_actions],
+            'system_optimal_style': [s.to_dict() for s in styles],
+        }
+        lines.append(json.dumps(record, ensure_ascii=False))
+    return lines
+
+
+def encode_fast(decoded):
+    lines = []
+    for user_actions, system_actions, styles in decoded:
+        record = {'dialog_action_user': user_actions, 'dialog_action_system': system_actions, 'system_optimal_style': styles}
+        lines.append(dumps_record(encode_buffer(record)))
+    return lines
+
+
+def measure(func, *args, repeat: int):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def measure_memory(func, *args):
+    tracemalloc.start()
+    result = func(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, help='A generated dialog file (jsonl).', default=None)
+    parser.add_argument('--limit', type=int, help='Maximum number of dialogs to use.', default=2000)
+    parser.add_argument('--repeat', type=int, help='Number of timed repetitions (the best one is reported).', default=5)
+    args = parser.parse_args()
+
+    records = load_corpus(args.input, args.limit) if args.input else build_synthetic_corpus(args.limit)
+    print(f"{len(records)} dialogs from {args.input or 'synthetic corpus'}")
+
+    legacy_decode_time, legacy_decoded = measure(decode_legacy, records, repeat=args.repeat)
+    fast_decode_time, fast_decoded = measure(decode_fast, records, repeat=args.repeat)
+    assert legacy_decoded == fast_decoded, "Fast decoder differs from Action.convert_from_dict"
+    legacy_encode_time, legacy_lines = measure(encode_legacy, legacy_decoded, repeat=args.repeat)
+    fast_encode_time, fast_lines = measure(encode_fast, fast_decoded, repeat=args.repeat)
+    assert [json.loads(x) for x in legacy_lines] == [loads_record(x) for x in fast_lines], "Fast encoder changes the JSON shape"
+    memory, _ = measure_memory(decode_fast, records)
+
+    print(f"decode: dataclasses_json {legacy_decode_time * 1000:.1f} ms, fast {fast_decode_time * 1000:.1f} ms ({legacy_decode_time / fast_decode_time:.1f}x)")
+    print(f"encode: dataclasses_json {legacy_encode_time * 1000:.1f} ms, fast {fast_encode_time * 1000:.1f} ms ({legacy_encode_time / fast_encode_time:.1f}x)")
+    print(f"decoded action trees: {memory / len(records) / 1024:.1f} KiB per dialog")
@@ -0,0 +1,281 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Micro-benchmarks of the CPU-bound components of the pipeline (schema loading, intent sampling, plot generation,
+action realization and decoding, context conversion, surname sampling, quality control rule filters), on fixed-seed
+inputs from `benchmarks.fixtures` and without any LLM request.
+
+Run `python -m benchmarks.suite` from the repository root. `--save_baseline benchmarks.json` stores the timings,
+and `--compare benchmarks.json` flags (and exits with an error on) the benchmarks slower than the baseline by more
+than `--threshold`.
+"""
+import argparse
+import contextlib
+import copy
+import gc
+import io
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+from context_generation.persona_generator import sample_surname_and_race
+from dialog_generation.context_loader import convert_context
+from dialog_generation.dataclass import Action, MetaAction
+from dialog_generation.intent_sampler import ContextIndex, sample_intent
+from dialog_generation.main import derive_seed
+from dialog_generation.plot_generator import compose_compositional_dialog, compose_compound_dialog
+from dialog_generation.plot_generator_utils import generic_intent_plot_generator
+from dialog_generation.schema_utils import Schema
+from dialog_generation.serialization import action_from_dict, meta_action_from_dict
+from quality_control.main import filter_misformat_data, filter_nan_data
+from .fixtures import (STYLES, make_census, make_dialog_records, make_raw_contexts, sample_operations,
+                       use_offline_slot_values)
+
+PHENOMENA = ['none', 'compound', 'compositional']
+
+
+class Benchmark(NamedTuple):
+    name: str
+    setup: Callable[[], tuple]  # Untimed, called before every repetition; returns the arguments of `func`
+    func: Callable
+    number: int  # Calls of `func` per repetition (as in timeit), so that every repetition takes a few ms
+
+
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(name: str, setup: Callable[[], tuple] = tuple, number: int = 1):
+    def register(func):
+        BENCHMARKS.append(Benchmark(name, setup, func, number))
+        return func
+    return register
+
+
+class Inputs:
+    """ The fixtures, built once on first use (sampling them takes a few seconds). """
+    _cache = {}
+
+    @classmethod
+    def get(cls, name: str, build: Callable):
+        if name not in cls._cache:
+            cls._cache[name] = build()
+        return cls._cache[name]
+
+    @classmethod
+    def raw_contexts(cls) -> list:
+        return cls.get('raw_contexts', lambda: make_raw_contexts(50))
+
+    @classmethod
+    def converted_contexts(cls) -> list:
+        return cls.get('converted_contexts', lambda: [convert_context(context, random.Random(i))
+                                                      for i, context in enumerate(cls.raw_contexts())])
+
+    @classmethod
+    def operations(cls, phenomena: str) -> list:
+        return cls.get(f'operations_{phenomena}', lambda: sample_operations(cls.raw_contexts(), phenomena, 30))
+
+    @classmethod
+    def records(cls) -> list:
+        return cls.get('records', lambda: [record for phenomena in PHENOMENA
+                                           for record in make_dialog_records(cls.raw_contexts(), phenomena, 40)])
+
+    @classmethod
+    def plots(cls) -> list:
+        return cls.get('plots', lambda: [([[action_from_dict(a) for a in turn] for turn in record['dialog_action_user']],
+                                          [[meta_action_from_dict(a) for a in turn] for turn in record['dialog_action_system']])
+                                         for record in cls.records()])
+
+
+def fresh_operations(phenomena: str):
+    """ Copies of the sampled operations (plot generation fills them in) with a fresh generator each. """
+    return ([(context, copy.deepcopy(operation), random.Random(derive_seed(1, i)))
+             for i, (context, operation, _) in enumerate(Inputs.operations(phenomena))],)
+
+
+@contextlib.contextmanager
+def suppress_plot_error():
+    """ Some plots fail for their seed (the pipeline dead-letters them), the failed attempts are timed too. """
+    try:
+        yield
+    except (ValueError, IndexError, KeyError):
+        pass
+
+
+def reset_schema():
+    Schema._data = []
+    Schema._compositional = []
+    return ()
+
+
+@benchmark('schema_load', setup=reset_schema)
+def bench_schema_load():
+    Schema.get_schema()
+    Schema.get_compositional_intents()
+
+
+@benchmark('sample_compositional_intent', setup=lambda: (random.Random(0),), number=10)
+def bench_sample_compositional_intent(rng):
+    for _ in range(2000):
+        Schema.sample_compositional_intent(rng)
+
+
+@benchmark('sample_intent', setup=lambda: (Inputs.converted_contexts(), random.Random(0)))
+def bench_sample_intent(contexts, rng):
+    for context in contexts:
+        index = ContextIndex(context)
+        for _ in range(10):
+            sample_intent(context, rng=rng, index=index)
+
+
+@benchmark('plot_none', setup=lambda: fresh_operations('none'))
+def bench_plot_none(samples):
+    for context, operation, rng in samples:
+        with suppress_plot_error():
+            generic_intent_plot_generator(operation['intent_values'][0], context, phenomena='none', rng=rng)
+
+
+@benchmark('plot_compound', setup=lambda: fresh_operations('compound'))
+def bench_plot_compound(samples):
+    for context, operation, rng in samples:
+        with suppress_plot_error():
+            compose_compound_dialog(operation, context, rng)
+
+
+@benchmark('plot_compositional', setup=lambda: fresh_operations('compositional'))
+def bench_plot_compositional(samples):
+    for context, operation, rng in samples:
+        with suppress_plot_error():
+            compose_compositional_dialog(operation, context, rng)
+
+
+@benchmark('realize_actions', setup=lambda: (Inputs.plots(),), number=5)
+def bench_realize_actions(plots):
+    for user_actions, system_actions in plots:
+        for turn in user_actions:
+            for action in turn:
+                action.realize()
+        for turn in system_actions:
+            for meta_action in turn:
+                for style in STYLES:
+                    meta_action.realize(style)
+
+
+@benchmark('convert_from_dict', setup=lambda: (Inputs.records(),), number=10)
+def bench_convert_from_dict(records):
+    for record in records:
+        for turn in record['dialog_action_user']:
+            for action in turn:
+                Action.convert_from_dict(action)
+        for turn in record['dialog_action_system']:
+            for meta_action in turn:
+                MetaAction.convert_from_dict(meta_action)
+
+
+@benchmark('action_from_dict', setup=lambda: (Inputs.records(),), number=10)
+def bench_action_from_dict(records):
+    for record in records:
+        for turn in record['dialog_action_user']:
+            for action in turn:
+                action_from_dict(action)
+        for turn in record['dialog_action_system']:
+            for meta_action in turn:
+                meta_action_from_dict(meta_action)
+
+
+@benchmark('convert_context', setup=lambda: (Inputs.raw_contexts(),))
+def bench_convert_context(contexts):
+    for i, context in enumerate(contexts):
+        convert_context(context, random.Random(i))
+
+
+def seed_census():
+    random.seed(0)  # sample_surname_and_race uses the global generator
+    return Inputs.get('census', make_census)
+
+
+@benchmark('sample_surname_and_race', setup=seed_census)
+def bench_sample_surname_and_race(df_surnames, race_to_count):
+    for _ in range(500):
+        sample_surname_and_race(df_surnames, race_to_count)
+
+
+@benchmark('qc_rule_filters', setup=lambda: (Inputs.records(),), number=5)
+def bench_qc_rule_filters(records):
+    with contextlib.redirect_stdout(io.StringIO()):  # The filters print their counts
+        filter_misformat_data(filter_nan_data(records))
+
+
+def run_benchmark(bench: Benchmark, repeat: int) -> Dict[str, float]:
+    bench.func(*bench.setup())  # Warm-up (and building of the fixtures)
+    times = []
+    for _ in range(repeat):
+        args = bench.setup()
+        gc.collect()
+        gc.disable()  # As timeit does, so that collections triggered by earlier allocations don't add noise
+        try:
+            start = time.perf_counter()
+            for _ in range(bench.number):
+                bench.func(*args)
+            times.append((time.perf_counter() - start) / bench.number)
+        finally:
+            gc.enable()
+    return {'min': min(times), 'median': statistics.median(times)}
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict, threshold: float) -> List[str]:
+    """ Print the timings against the baseline; returns the names of the benchmarks that regressed. """
+    regressions = []
+    print(f"{'benchmark':<28}{'min ms':>10}{'baseline':>10}{'change':>9}")
+    for name, timing in results.items():
+        reference = baseline['benchmarks'].get(name)
+        if reference is None:
+            print(f"{name:<28}{timing['min'] * 1000:>10.2f}{'-':>10}{'new':>9}")
+            continue
+        change = timing['min'] / reference['min'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print(f"{name:<28}{timing['min'] * 1000:>10.2f}{reference['min'] * 1000:>10.2f}{change:>+9.0%}{flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the CPU-bound pipeline components.')
+    parser.add_argument('--filter', type=str, help='Only run the benchmarks whose name contains this.', default=None)
+    parser.add_argument('--repeat', type=int, help='Number of timed repetitions (the best one is compared).', default=15)
+    parser.add_argument('--save_baseline', type=str, help='Write the timings to this JSON file.', default=None)
+    parser.add_argument('--compare', type=str, help='Compare the timings to this baseline JSON file.', default=None)
+    parser.add_argument('--threshold', type=float, help='Relative slowdown flagged as a regression.', default=0.2)
+    args = parser.parse_args()
+
+    use_offline_slot_values()
+    results = {}
+    for bench in BENCHMARKS:
+        if args.filter and args.filter not in bench.name:
+            continue
+        results[bench.name] = run_benchmark(bench, args.repeat)
+        if not args.compare:
+            print(f"{bench.name:<28}{results[bench.name]['min'] * 1000:>10.2f} ms min"
+                  f"{results[bench.name]['median'] * 1000:>10.2f} ms median")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fp:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(), 'repeat': args.repeat,
+                       'benchmarks': results}, fp, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)
+        if baseline.get('python') != platform.python_version():
+            print(f"Warning: the baseline was measured with Python {baseline.get('python')}")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmarks slower than the baseline by more than {args.threshold:.0%}: "
+                  f"{', '.join(regressions)}")
+            sys.exit(1)
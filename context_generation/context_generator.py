@@ -2,17 +2,22 @@
 # For licensing see accompanying LICENSE file.
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
+import argparse
 import json
 import multiprocessing.dummy
+import os
 import random
 from datetime import date, timedelta
 from textwrap import dedent
 from typing import List
 
+from utilities.dry_run import add_dry_run_arguments, enable_dry_run, report_dry_run, sample_evenly
 from utilities.llm_synthesis_utils import call_openai_chat_completion
+from utilities.profiling import add_profile_argument, start_profiler
 from .persona_generator import PERSONAS_FILE, get_pronoun
 
 CONTEXTS_FILE = "data/contexts.jsonl"
+NUM_WORKERS = 5
 
 DATE_FORMAT = "%a %Y-%m-%d"
 
@@ -86,7 +91,7 @@ def generate_seed_data(persona, num_projects: int = 3):
     messages = [
         {"role": "user", "content": "\n\n".join(data)}
     ]
-    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024)
+    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024, stage='app_projects')
     projects = parse_llm_json_list(llm_output)
     return today, projects
 
@@ -99,7 +104,7 @@ def generate_contacts(persona, num_contacts: int = 20):
     messages = [
         {"role": "user", "content": "\n\n".join([persona['intro'], prompt])}
     ]
-    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024)
+    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024, stage='app_contacts')
     contacts = parse_llm_json_list(llm_output)
     return contacts
 
@@ -116,7 +121,7 @@ def generate_alarms(persona):
     messages = [
         {"role": "user", "content": "\n\n".join([persona['intro'], prompt])}
     ]
-    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024)
+    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024, stage='app_alarms')
     contacts = parse_llm_json_list(llm_output)
     return contacts
 
@@ -163,7 +168,7 @@ def generate_calendar_events(persona, min_num: int = 4, max_num: int = 9):
     messages = [
         {"role": "user", "content": "\n\n".join(data)}
     ]
-    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024)
+    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024, stage='app_calendar_events')
     calendar_events = parse_llm_json_list(llm_output)
     return calendar_events
 
@@ -186,7 +191,7 @@ def generate_reminders(persona, min_num: int = 4, max_num: int = 9):
     messages = [
         {"role": "user", "content": "\n\n".join(data)}
     ]
-    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024)
+    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024, stage='app_reminders')
     reminders = parse_llm_json_list(llm_output)
     return reminders
 
@@ -204,7 +209,7 @@ def generate_messages(persona):
     messages = [
         {"role": "user", "content": "\n\n".join([persona['intro'], prompt])}
     ]
-    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024)
+    llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024, stage='app_messages')
     sms_list = parse_llm_json_list(llm_output)
     sms_threads = {obj['sender']: [obj] for obj in sms_list}
     # generate long threads
@@ -217,7 +222,7 @@ def generate_messages(persona):
         messages = [
             {"role": "user", "content": "\n\n".join([persona['intro'], prompt])}
         ]
-        llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024)
+        llm_output, cost = call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024, stage='app_messages')
         sms_list = parse_llm_json_list(llm_output)
         sms_threads[contact['full_name']] = sms_list
     return sms_threads
@@ -234,16 +239,36 @@ def generate_app_data(persona):
     return persona
 
 
-def main():
+def main(dry_run_sample_size: int = None):
+    """ Generate the app data of every persona, or with `dry_run_sample_size`, of a sample of them without writing
+    them (see `utilities.dry_run`); returns the numbers of processed and total personas.
+    """
     personas = load_personas()
     print(f">>> Loaded {len(personas)} personas")
-
-    with open(CONTEXTS_FILE, 'a') as fp:
-        with multiprocessing.dummy.Pool(5) as pool:
+    total = len(personas)
+    output_file = CONTEXTS_FILE
+    if dry_run_sample_size is not None:
+        personas = sample_evenly(personas, dry_run_sample_size)
+        output_file = os.devnull
+
+    with open(output_file, 'a') as fp:
+        with multiprocessing.dummy.Pool(NUM_WORKERS) as pool:
             for p in pool.imap(generate_app_data, personas):
                 fp.write(json.dumps(p, ensure_ascii=False, default=str))
                 fp.write("\n")
+    return len(personas), total
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    add_profile_argument(parser)
+    add_dry_run_arguments(parser)
+    args = parser.parse_args()
+    profiler = start_profiler(args.profile)
+    if args.dry_run is not None:
+        enable_dry_run()
+    processed, total = main(args.dry_run)
+    if args.dry_run is not None:
+        report_dry_run(args, processed, total, concurrency=NUM_WORKERS, unit='persona')
+    if profiler is not None:
+        profiler.stop().save('data/context_generator.profile')
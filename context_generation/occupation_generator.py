@@ -2,11 +2,15 @@
 # For licensing see accompanying LICENSE file.
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
+import argparse
 import json
+import os
 import random
 from textwrap import dedent
 
+from utilities.dry_run import add_dry_run_arguments, enable_dry_run, report_dry_run
 from utilities.llm_synthesis_utils import call_openai_chat_completion
+from utilities.profiling import add_profile_argument, start_profiler
 
 INDUSTRIES_FILE = "resources/NAICS_2022.tsv"
 OCCUPATIONS_FILE = "data/occupations.json"
@@ -38,7 +42,7 @@ def generate_occupations_for_industry(industry: str, n: int):
     messages = [
         {"role": "user", "content": prompt}
     ]
-    return call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024)
+    return call_openai_chat_completion(messages, temperature=0.7, max_tokens=1024, stage='occupations')
 
 
 def load_occupations():
@@ -49,10 +53,19 @@ def load_occupations():
         return {}
 
 
-def add_occupations(num_industries_to_add: int, num_establishments_per_industry: int = 5):
+def add_occupations(num_industries_to_add: int, num_establishments_per_industry: int = 5,
+                    dry_run_sample_size: int = None):
+    """ Generate the occupations of `num_industries_to_add` more industries, or with `dry_run_sample_size`, of a
+    sample of them without writing them (see `utilities.dry_run`); returns the numbers of processed and total industries.
+    """
     occupations = load_occupations()
     all_remaining_industries = load_industries(occupations.keys())
     industries = random.sample(all_remaining_industries, k=min(num_industries_to_add, len(all_remaining_industries)))
+    total = len(industries)
+    output_file = OCCUPATIONS_FILE
+    if dry_run_sample_size is not None:
+        industries = industries[:dry_run_sample_size]  # Already a random sample
+        output_file = os.devnull
     total_cost = 0
     for industry in industries:
         print(f"Generating occupations in industry: {industry}")
@@ -65,9 +78,22 @@ def add_occupations(num_industries_to_add: int, num_establishments_per_industry:
             continue
         occupations[industry] = generated_occupations
     print(f"Synthesis complete. Cost: ${total_cost}")
-    with open(OCCUPATIONS_FILE, "wt") as fp:
+    with open(output_file, "wt") as fp:
         json.dump(occupations, fp, ensure_ascii=False, indent=1)
+    return len(industries), total
 
 
 if __name__ == '__main__':
-    add_occupations(200)  # set the num of occupations you want to append
+    parser = argparse.ArgumentParser()
+    add_profile_argument(parser)
+    add_dry_run_arguments(parser)
+    args = parser.parse_args()
+    profiler = start_profiler(args.profile)
+    if args.dry_run is not None:
+        enable_dry_run()
+    # set the num of occupations you want to append
+    processed, total = add_occupations(200, dry_run_sample_size=args.dry_run)
+    if args.dry_run is not None:  # The industries are processed one at a time
+        report_dry_run(args, processed, total, concurrency=1, unit='industry')
+    if profiler is not None:
+        profiler.stop().save('data/occupation_generator.profile')
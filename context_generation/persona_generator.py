@@ -4,7 +4,9 @@
 #
 import base64
 import hashlib
+import argparse
 import json
+import os
 import random
 from collections import defaultdict
 from typing import Dict, Tuple
@@ -12,7 +14,9 @@ from typing import Dict, Tuple
 import numpy as np
 import pandas as pd
 
+from utilities.dry_run import add_dry_run_arguments, enable_dry_run, report_dry_run
 from utilities.llm_synthesis_utils import call_openai_chat_completion
+from utilities.profiling import add_profile_argument, start_profiler
 from .occupation_generator import INDUSTRIES_FILE, OCCUPATIONS_FILE
 
 NAMES_FILE = "resources/Names_2010Census.csv"
@@ -146,7 +150,7 @@ def complete_persona_by_llm(persona):
     messages = [
         {"role": "user", "content": "\n\n".join([json.dumps(persona, ensure_ascii=False), prompt])}
     ]
-    return call_openai_chat_completion(messages, temperature=1.0, max_tokens=1024)
+    return call_openai_chat_completion(messages, temperature=1.0, max_tokens=1024, stage='persona_intro')
 
 
 def hash_persona(persona) -> str:
@@ -154,14 +158,22 @@ def hash_persona(persona) -> str:
     return base64.b85encode(hashlib.md5(data).digest()).decode()
 
 
-def add_personas(num_personas_to_add: int) -> None:
+def add_personas(num_personas_to_add: int, dry_run_sample_size: int = None) -> Tuple[int, int]:
+    """ Generate `num_personas_to_add` more personas, or with `dry_run_sample_size`, a sample of them without writing
+    them (see `utilities.dry_run`); returns the numbers of generated and requested personas.
+    """
+    total = num_personas_to_add
+    output_file = PERSONAS_FILE
+    if dry_run_sample_size is not None:
+        num_personas_to_add = min(num_personas_to_add, dry_run_sample_size)
+        output_file = os.devnull
     df_surnames, race_to_count = load_surnames()
     with open(OCCUPATIONS_FILE, 'r') as fp:
         industry_to_occupations = json.load(fp)
     hierarchical_occupations = load_hierarchical_occupations(industry_to_occupations)
 
     total_cost = 0
-    with open(PERSONAS_FILE, 'a') as fp:
+    with open(output_file, 'a') as fp:
         for _ in range(num_personas_to_add):
             surname, race = sample_surname_and_race(df_surnames, race_to_count)
             persona = {
@@ -184,7 +196,20 @@ def add_personas(num_personas_to_add: int) -> None:
             fp.write(json.dumps(persona, ensure_ascii=False))
             fp.write("\n")
     print(f"Synthesis complete. Cost: ${total_cost}")
+    return num_personas_to_add, total
 
 
 if __name__ == '__main__':
-    add_personas(500)  # set the num of personas you want to append
+    parser = argparse.ArgumentParser()
+    add_profile_argument(parser)
+    add_dry_run_arguments(parser)
+    args = parser.parse_args()
+    profiler = start_profiler(args.profile)
+    if args.dry_run is not None:
+        enable_dry_run()
+    # set the num of personas you want to append
+    processed, total = add_personas(500, dry_run_sample_size=args.dry_run)
+    if args.dry_run is not None:  # The personas are generated one at a time
+        report_dry_run(args, processed, total, concurrency=1, unit='persona')
+    if profiler is not None:
+        profiler.stop().save('data/persona_generator.profile')
@@ -2,13 +2,21 @@
 # For licensing see accompanying LICENSE file.
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
+import hashlib
 import json
 import logging
+import os
 import random
 from datetime import datetime, timedelta
+from pathlib import Path
 
 from babel.dates import format_timedelta
 
+CONTEXTS_FILE = 'data/contexts.jsonl'
+CONVERTED_CONTEXTS_FILE = 'data/contexts.converted.jsonl'
+# Bump when a converter changes its output, so that cached conversions are redone
+CONVERTER_VERSION = 1
+
 DATETIME_FORMAT = '%a %Y-%m-%d %H:%M'
 DATE_FORMAT = '%a %Y-%m-%d'
 TIME_FORMAT = '%H:%M'
@@ -33,8 +41,7 @@ MESSAGE_KEY_MAP = {
 }
 
 
-def load_contexts():
-    filename = 'data/contexts.jsonl'
+def load_contexts(filename: str = CONTEXTS_FILE):
     with open(filename, 'r') as fp:
         contexts = [json.loads(line) for line in fp]
     return contexts
@@ -91,11 +98,11 @@ def convert_alarms(input_data: list) -> list:
     return output_data
 
 
-def convert_messages(input_data: dict) -> dict:
-    output_data = {'messages': [], 'messages_sent': []}
-    threads = list(input_data.items())
-    random.shuffle(threads)
-    for contact, thread in threads:
+def convert_message_threads(input_data: dict) -> list:
+    """ The converted messages of each thread, as [contact, [[app_name, message], ...]], in the input order. """
+    output_data = []
+    for contact, thread in input_data.items():
+        converted_thread = []
         for message in thread:
             converted = {MESSAGE_KEY_MAP[k]: v for k, v in message.items() if k in MESSAGE_KEY_MAP and v}
             if message['sender'] == 'myself':
@@ -105,43 +112,111 @@ def convert_messages(input_data: dict) -> dict:
                 app_name = 'messages'
             if isinstance(converted.get('contacts'), str):  # convert contacts to list
                 converted['contacts'] = [converted['contacts']]
-            output_data[app_name].append(converted)
+            converted_thread.append([app_name, converted])
+        output_data.append([contact, converted_thread])
+    return output_data
+
+
+def shuffle_message_threads(threads: list, rng: random.Random = random) -> dict:
+    output_data = {'messages': [], 'messages_sent': []}
+    threads = list(threads)
+    rng.shuffle(threads)
+    for contact, thread in threads:
+        for app_name, message in thread:
+            message = dict(message)
+            if 'contacts' in message:
+                message['contacts'] = list(message['contacts'])
+            output_data[app_name].append(message)
     return output_data
 
 
+def convert_messages(input_data: dict, rng: random.Random = random) -> dict:
+    return shuffle_message_threads(convert_message_threads(input_data), rng)
+
+
+# Static conversions, independent of the datapoint. The messages are only shuffled when a context is finalized.
 CONVERTERS = {
     'calendar_events': convert_calendar,
     'reminders': convert_reminders,
     'alarms': convert_alarms,
-    'messages': convert_messages,
+    'messages': convert_message_threads,
     'contacts': lambda x: x.copy(),
     'today': lambda x: datetime.strptime(x, '%Y-%m-%d').strftime(DATE_FORMAT),
 }
 
 
-def sample_time(granularity: int = 1, hours: tuple = (0, 24)) -> str:
-    hour = random.randrange(*hours)
-    minute = random.randrange(60 // granularity) * granularity
+def sample_time(granularity: int = 1, hours: tuple = (0, 24), rng: random.Random = random) -> str:
+    hour = rng.randrange(*hours)
+    minute = rng.randrange(60 // granularity) * granularity
     return f"{hour:0>2}:{minute:0>2}"
 
 
-def convert_context(context: dict) -> dict:
-    """ Make a copy of the context, formatted according to the schema.
+def convert_static_context(context: dict) -> dict:
+    """ The datapoint-independent part of `convert_context`, which can be cached (it is JSON serializable). """
+    apps = {app: CONVERTERS[app](app_data) for app, app_data in context['apps'].items() if app in CONVERTERS}
+    return {'apps': apps, 'intro': context['intro']}
+
+
+def finalize_context(static_context: dict, rng: random.Random = random) -> dict:
+    """ A new context for a datapoint from a static conversion: shuffles the message threads and samples the
+    current time. The static conversion is not modified.
     """
     result = {}
-    for app, app_data in context['apps'].items():
-        converter = CONVERTERS.get(app)
-        if converter:
-            converted_data = converter(app_data)
-            if isinstance(converted_data, dict):
-                result.update(converted_data)
-            else:
-                result[app] = converted_data
-    result['current_time'] = sample_time()
-    result['intro'] = context['intro']
+    for app, app_data in static_context['apps'].items():
+        if app == 'messages':
+            result.update(shuffle_message_threads(app_data, rng))
+        elif isinstance(app_data, list):
+            result[app] = [dict(item) if isinstance(item, dict) else item for item in app_data]
+        else:
+            result[app] = app_data
+    result['current_time'] = sample_time(rng=rng)
+    result['intro'] = static_context['intro']
     return result
 
 
+def convert_context(context: dict, rng: random.Random = random) -> dict:
+    """ Make a copy of the context, formatted according to the schema.
+    """
+    return finalize_context(convert_static_context(context), rng)
+
+
+def load_converted_contexts(filename: str = CONTEXTS_FILE, cache_file: str = CONVERTED_CONTEXTS_FILE) -> list:
+    """ The static conversions of the contexts of `filename`, in file order, to be finalized per datapoint with
+    `finalize_context`. The contexts are read one line at a time, and the conversions are cached in `cache_file`
+    keyed by persona id and `CONVERTER_VERSION` (a context whose content changed is converted again).
+    Set `cache_file` to None to disable the cache.
+    """
+    cache = {}
+    if cache_file and Path(cache_file).is_file():
+        with open(cache_file, 'r') as fp:
+            for line in fp:
+                entry = json.loads(line)
+                cache[(entry['id'], entry['converter_version'])] = entry
+
+    static_contexts, entries, converted = [], [], 0
+    with open(filename, 'r') as fp:
+        for line in fp:
+            digest = hashlib.sha256(line.rstrip('\n').encode('utf8')).hexdigest()
+            context = json.loads(line)
+            key = (context.get('id', digest), CONVERTER_VERSION)
+            entry = cache.get(key)
+            if entry is None or entry['digest'] != digest:
+                entry = {'id': key[0], 'converter_version': CONVERTER_VERSION, 'digest': digest,
+                         'context': convert_static_context(context)}
+                converted += 1
+            static_contexts.append(entry['context'])
+            entries.append(entry)
+
+    if cache_file and (converted or len(entries) != len(cache)):
+        tmp_path = f'{cache_file}.tmp'
+        with open(tmp_path, 'w') as fp:
+            for entry in entries:
+                fp.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, cache_file)
+    logging.info(f"Loaded {len(static_contexts)} contexts ({converted} converted, {len(static_contexts) - converted} cached)")
+    return static_contexts
+
+
 if __name__ == '__main__':
-    for c in load_contexts():
-        convert_context(c)
+    contexts = load_converted_contexts()
+    print(f'Cached the conversions of {len(contexts)} contexts in {CONVERTED_CONTEXTS_FILE}')
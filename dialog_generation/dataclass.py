@@ -2,13 +2,17 @@
 # For licensing see accompanying LICENSE file.
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
-import copy
 import json
+import sys
 from dataclasses import dataclass
+from json.encoder import encode_basestring
 from typing import List, Optional, Union
 
 from dataclasses_json import dataclass_json
 
+# Slotted instances are considerably smaller, which matters with thousands of plots in flight (Python >= 3.10).
+_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
 SYS_ACTION_PRIORITY = {
     'ask_user_for': 6,
     'inform_result': 4,
@@ -25,6 +29,25 @@ SYS_ACTION_EXPECT_USR = {
 }
 
 
+def _dump_value(val) -> str:
+    # Same as json.dumps(val, ensure_ascii=False), but skips the encoder set-up for the common string case.
+    if isinstance(val, str):
+        return encode_basestring(val)
+    return json.dumps(val, ensure_ascii=False)
+
+
+def _realize_arguments(arguments: dict, realize_nested) -> str:
+    kv_list = []
+    for key, val in arguments.items():
+        if isinstance(val, Action):
+            kv_list.append(realize_nested(val) if key == '' else f"{key}={realize_nested(val)}")
+        elif val or val == 0:
+            kv_list.append(f"{key}={_dump_value(val)}")
+        else:   # Should be None
+            kv_list.append(key)
+    return ', '.join(kv_list)
+
+
 def convert_kv_to_string(d):
     if not d:
         return ''
@@ -33,13 +56,14 @@ def convert_kv_to_string(d):
 
 
 class DictInterface:
+    __slots__ = ()
 
     def __getitem__(self, key):
         return getattr(self, key, None)
 
 
 @dataclass_json
-@dataclass(frozen=True)
+@dataclass(frozen=True, **_SLOTS)
 class IntentSchema(DictInterface):
     name: str
     description: str
@@ -59,7 +83,7 @@ class IntentSchema(DictInterface):
 
 
 @dataclass_json
-@dataclass(frozen=True)
+@dataclass(frozen=True, **_SLOTS)
 class SlotSchema(DictInterface):
     name: str
     description: str
@@ -73,7 +97,7 @@ GLOBAL_SLOT_SCHEMA = {
 
 
 @dataclass_json
-@dataclass(frozen=True)
+@dataclass(frozen=True, **_SLOTS)
 class ServiceSchema(DictInterface):
     service_name: str
     intent_operations: List[IntentSchema]
@@ -98,7 +122,7 @@ class ServiceSchema(DictInterface):
 
 
 @dataclass_json
-@dataclass
+@dataclass(**_SLOTS)
 class Action(DictInterface):
     action_name: str
     service_prefix: Optional[str] = None
@@ -109,81 +133,61 @@ class Action(DictInterface):
     arguments: Optional[dict] = None
     max_num_arguments: Optional[int] = None   # Not used
     no_bracket: bool = False
-    
-    def realize(self):
-        if self.arguments:
-            kv_list = []
-            for key, val in self.arguments.items():
-                if isinstance(val, Action):
-                    if key == '':
-                        kv_list.append("{}".format(val.realize()))
-                    else:
-                        kv_list.append("{}={}".format(key, val.realize()))
-                elif val or val==0:
-                    kv_list.append("{}={}".format(key, json.dumps(val, ensure_ascii=False)))
-                else:   # Should be None
-                    kv_list.append("{}".format(key))
-            arguments_expression = ', '.join(kv_list)
-        else:
-            arguments_expression = ''
-        
-        if self.no_bracket:
-            action_string = '{intent}'.format(intent=self.action_name)
-        else:
-            action_string = '{intent}({args})'.format(intent = self.action_name, 
-                                                    args=arguments_expression)
-        if self.service_prefix:
-            action_string = '{prefix}_'.format(prefix=self.service_prefix) + action_string
-        if self.item_index or self.item_index==0:
-            action_string += '[{}]'.format(self.item_index)
-        if self.attribute:
-            if isinstance(self.attribute, Action):
-                action_string += '.{}'.format(self.attribute.realize())
-            else:
-                action_string += '.{}'.format(self.attribute)
+
+    def realize(self, drop_arguments: bool = False, cache: Optional[dict] = None) -> str:
+        """ Realize the action as a string without modifying it.
+        `drop_arguments` realizes the action as if it had no arguments.
+        `cache` memoizes the strings of this action and its sub-actions by object identity; it must only be shared
+        by calls between which the action trees are not modified.
+        """
+        if cache is None or drop_arguments:
+            return self._realize(None if drop_arguments else self.arguments, cache)
+        cached = cache.get(id(self))
+        if cached is None:
+            # Keep a reference to the action so that its id cannot be reused while the cache is alive
+            cached = cache[id(self)] = (self, self._realize(self.arguments, cache))
+        return cached[1]
+
+    def _realize(self, arguments: Optional[dict], cache: Optional[dict]) -> str:
+        action_string = self._realize_core(arguments, lambda action: action.realize(cache=cache))
         if self.referral_action:
-            action_string = self.referral_action.realize() + '.' + action_string
+            action_string = self.referral_action.realize(cache=cache) + '.' + action_string
         return action_string
-    
-    def realize_generic_action(self, context=None):
-        if self.arguments:
-            kv_list = []
-            for key, val in self.arguments.items():
-                if isinstance(val, Action):
-                    if key == '':
-                        kv_list.append("{}".format(val.realize_generic_action(context)))
-                    else:
-                        kv_list.append("{}={}".format(key, val.realize_generic_action(context)))
-                elif val or val==0:
-                    kv_list.append("{}={}".format(key, json.dumps(val, ensure_ascii=False)))
-                else:   # Should be None
-                    kv_list.append("{}".format(key))
-            arguments_expression = ', '.join(kv_list)
-        else:
-            arguments_expression = ''
-        
+
+    def _realize_core(self, arguments: Optional[dict], realize_nested) -> str:
+        """ Realize everything but the referral action, using `realize_nested` for sub-actions.
+        """
         if self.no_bracket:
-            action_string = '{intent}'.format(intent=self.action_name)
+            action_string = self.action_name
         else:
-            action_string = '{intent}({args})'.format(intent = self.action_name, 
-                                                    args=arguments_expression)
+            action_string = f"{self.action_name}({_realize_arguments(arguments, realize_nested) if arguments else ''})"
         if self.service_prefix:
-            action_string = '{prefix}_'.format(prefix=self.service_prefix) + action_string
-        if self.item_index or self.item_index==0:
-            action_string += '[{}]'.format(self.item_index)
+            action_string = f"{self.service_prefix}_{action_string}"
+        if self.item_index or self.item_index == 0:
+            action_string += f"[{self.item_index}]"
         if self.attribute:
             if isinstance(self.attribute, Action):
-                action_string += '.{}'.format(self.attribute.realize_generic_action(context))
+                action_string += '.' + realize_nested(self.attribute)
             else:
-                action_string += '.{}'.format(self.attribute)
+                action_string += f".{self.attribute}"
+        return action_string
+
+    def realize_generic_action(self, context=None, drop_arguments: bool = False, arguments: Optional[dict] = None) -> str:
+        """ Realize the action with its referral action pointing into the context, without modifying it.
+        `arguments` overrides the arguments of this action.
+        """
+        if arguments is None and not drop_arguments:
+            arguments = self.arguments
+        action_string = self._realize_core(arguments, lambda action: action.realize_generic_action(context))
         if self.referral_action:
             # if self.service_prefix in context: # For compositional action, it's difficult to tell which part of the action belows to which service.
             #     context = copy.copy(context[self.service_prefix])
+            referred_context = None
             for key, value in context.items():
                 if key in self.referral_action.action_name:
                     referred_context = value
-            self.referral_action.arguments = {'context': referred_context, 'index': self.referral_action.referral_event_index}
-            action_string = self.referral_action.realize_generic_action(context) + '.' + action_string
+            referral_arguments = {'context': referred_context, 'index': self.referral_action.referral_event_index}
+            action_string = self.referral_action.realize_generic_action(context, arguments=referral_arguments) + '.' + action_string
         return action_string
     
     @staticmethod
@@ -212,7 +216,7 @@ class Action(DictInterface):
 
 
 @dataclass_json
-@dataclass
+@dataclass(**_SLOTS)
 class MetaAction(DictInterface):
     default_action: Action
     special_mirroring_action: Optional[Action] = None
@@ -227,17 +231,19 @@ class MetaAction(DictInterface):
     def priority(self) -> int:
         return SYS_ACTION_PRIORITY[self.default_action.action_name]
 
-    def realize(self, style=(), context=None):
+    def realize(self, style=(), context=None, cache: Optional[dict] = None):
+        """ Realize the action chosen by the style flags, without copying or modifying it.
+        `cache` is passed on to `Action.realize` (it is not used together with `context`).
+        """
         if 'mirroring' in style and self.special_mirroring_action:
-            action_to_realize = copy.deepcopy(self.special_mirroring_action)
+            action_to_realize = self.special_mirroring_action
         else:
-            action_to_realize = copy.deepcopy(self.default_action)
-        if 'verbosity_low' in style and self.special_low_verbosity:
-            action_to_realize.arguments = None
+            action_to_realize = self.default_action
+        drop_arguments = 'verbosity_low' in style and self.special_low_verbosity
         if context:
-            return action_to_realize.realize_generic_action(context)
+            return action_to_realize.realize_generic_action(context, drop_arguments=drop_arguments)
         else:
-            return action_to_realize.realize()
+            return action_to_realize.realize(drop_arguments=drop_arguments, cache=cache)
 
     @staticmethod
     def convert_from_dict(data: dict) -> 'MetaAction':
@@ -256,7 +262,7 @@ class MetaAction(DictInterface):
         )
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class IntentPlot(DictInterface):
     user_actions: List[List[Action]]
     system_actions: List[List[Action]]
@@ -264,7 +270,7 @@ class IntentPlot(DictInterface):
     local_phenomena: Optional[list]
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class IntentValues(DictInterface):
     service: str
     intent: str
@@ -274,12 +280,13 @@ class IntentValues(DictInterface):
     matching_slot: Optional[str] = None
     initial_slot: Optional[list] = None
     summary_further_slot_values: Optional[dict] = None
+    generated_input_examples: Optional[list] = None  # Input value examples generated by the LLM for this intent
 
     def __str__(self):
         return f"{self.service}.{self.intent}({convert_kv_to_string(self.input_slot_values)})"
     
 
-@dataclass
+@dataclass(**_SLOTS)
 class Operation(DictInterface):
     phenomena: str
     intent_values: List[IntentValues]
@@ -302,7 +309,7 @@ system_response_style_prompts: dict = {
 
 
 @dataclass_json
-@dataclass
+@dataclass(**_SLOTS)
 class SystemResponseStyle(DictInterface):
     verbosity: Optional[str] = None
     mirroring: Optional[str] = None
@@ -0,0 +1,78 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Dead-letter records of the datapoints whose generation failed.
+
+Failed datapoints are written to `{phenomena}.failed.jsonl` next to the output instead of the output itself, with the
+stage that failed, the error, the datapoint seed and the partially built buffer. Failures are classified as
+transient (LLM API errors, malformed JSON from the LLM), which are worth retrying, or deterministic (e.g. plot
+generation bugs for a given seed), which would fail again.
+"""
+import json
+import os
+import traceback
+from pathlib import Path
+from typing import Dict, Iterable
+
+import openai
+
+from .serialization import dumps_record, loads_record
+
+FAILED_SUFFIX = '.failed.jsonl'
+
+TRANSIENT_ERRORS = (openai.OpenAIError, json.JSONDecodeError, TimeoutError, ConnectionError)
+
+
+def get_dead_letter_path(output_dir: Path, phenomena: str) -> Path:
+    return Path(output_dir) / f'{phenomena}{FAILED_SUFFIX}'
+
+
+def is_transient(error: BaseException) -> bool:
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    # Raised by the turn generation when the LLM keeps returning malformed JSON
+    return isinstance(error, AssertionError) and 'JSON' in str(error)
+
+
+def describe_failure(stage: str, error: BaseException) -> dict:
+    """ What to record about a failure in `stage` ('plot' or 'dialog'); call from the `except` block. """
+    return {
+        'stage': stage,
+        'error_class': type(error).__name__,
+        'error': repr(error),
+        'transient': is_transient(error),
+        'traceback': traceback.format_exc(),
+    }
+
+
+def load_dead_letters(path: Path) -> Dict[str, dict]:
+    """ The latest dead-letter record of each datapoint id. """
+    records = {}
+    if not Path(path).is_file():
+        return records
+    with open(path, 'r') as fp:
+        for line in fp:
+            try:
+                record = loads_record(line)
+            except ValueError:
+                continue  # e.g. a line truncated by a crash
+            records[record['id']] = record
+    return records
+
+
+def compact_dead_letters(path: Path, succeeded_ids: Iterable[str]) -> Dict[str, dict]:
+    """ Rewrite the dead-letter file with the latest record of each datapoint that still failed. """
+    succeeded_ids = set(succeeded_ids)
+    records = {data_id: record for data_id, record in load_dead_letters(path).items() if data_id not in succeeded_ids}
+    if not Path(path).is_file():
+        return records
+    if records:
+        tmp_path = Path(path).with_name(Path(path).name + '.tmp')
+        with open(tmp_path, 'w') as fp:
+            for record in records.values():
+                fp.write(dumps_record(record) + '\n')
+        os.replace(tmp_path, path)
+    else:
+        Path(path).unlink()
+    return records
@@ -0,0 +1,142 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Event-driven dialog generation: an asyncio scheduler drives the `DialogState` of many dialogs concurrently.
+
+A dialog only takes a slot of the global LLM concurrency limit while one of its requests is running, so the number
+of dialogs in flight is independent of the number of threads. Waiting requests are served to the dialogs with the
+fewest remaining turns first, so started dialogs finish (and are written) early. Plot preparation, which is
+synchronous, runs in a thread pool.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Tuple
+
+from utilities import llm_synthesis_utils
+from utilities.llm_trace import trace_context
+from utilities.metrics import LLM_RETRIES, QUEUE_DEPTH
+from .dead_letter import describe_failure
+from .dialog_generator import DialogState, StyleGenerationStats, TurnRequest, build_messages, get_trace_fields, SYSTEM_GENERATION_PARAMS, TURN_STAGES, USER_GENERATION_PARAMS
+
+
+class PriorityLimiter:
+    """ Allows at most `limit` holders at a time. Waiters are admitted lowest `priority` first, then first come. """
+
+    def __init__(self, limit: int):
+        self.available = limit
+        self.waiters = []
+        self.counter = itertools.count()
+
+    async def acquire(self, priority) -> None:
+        if self.available > 0 and not self.waiters:
+            self.available -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        QUEUE_DEPTH.inc(queue='llm_waiting')
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.cancelled():  # The slot was handed over just before the cancellation
+                self.release()
+            raise
+        finally:
+            QUEUE_DEPTH.dec(queue='llm_waiting')
+
+    def release(self) -> None:
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)  # Hand the slot over
+                return
+        self.available += 1
+
+
+async def request_turn(request: TurnRequest, limiter: PriorityLimiter, priority) -> str:
+    """ Async counterpart of `get_user_response` / `get_system_response`. """
+    params = USER_GENERATION_PARAMS if request.kind == 'user' else SYSTEM_GENERATION_PARAMS
+    stage = TURN_STAGES[request.kind]
+    messages = build_messages(request.prompt)
+    llm_output = None
+    for attempt in range(3):
+        await limiter.acquire(priority)
+        try:
+            llm_output, _ = await llm_synthesis_utils.async_call_openai_chat_completion(messages, **params, stage=stage)
+        finally:
+            limiter.release()
+        try:
+            json.loads(llm_output)
+            return llm_output
+        except ValueError:
+            if attempt < 2:
+                LLM_RETRIES.inc(stage=stage, cause='malformed_json')
+            continue
+    print(llm_output)
+    raise AssertionError("LLM cannot produce output in JSON format.")
+
+
+async def simulate_dialog(buffer: dict, limiter: PriorityLimiter, history_strategy='full', history_turns=4,
+                          style_generation='per_style', style_stats: StyleGenerationStats = None) -> dict:
+    """ Async counterpart of `generate_single_dialog`. The style variants of a system turn are requested concurrently.
+    """
+    state = DialogState(buffer, history_strategy, history_turns, style_generation, style_stats)
+    while not state.done:
+        requests = state.next_requests()
+        with trace_context(**get_trace_fields(buffer, state.cur_turn)):  # Copied into the request tasks
+            responses = await asyncio.gather(*(request_turn(request, limiter, state.remaining_turns) for request in requests))
+        state.advance(list(responses))
+    return buffer
+
+
+async def _run_dialog_engine(prepare, indices, on_result, max_in_flight, llm_concurrency, plot_workers,
+                             history_strategy, history_turns, style_generation, style_stats):
+    loop = asyncio.get_running_loop()
+    limiter = PriorityLimiter(llm_concurrency)
+
+    async def run_one(index):
+        buffer, ready = await loop.run_in_executor(executor, prepare, index)
+        if not ready:
+            return index, buffer, False
+        try:
+            await simulate_dialog(buffer, limiter, history_strategy, history_turns, style_generation, style_stats)
+        except Exception as e:
+            logging.error(f"{buffer['id']} - Dialog generation failed: {repr(e)}")
+            buffer['failure'] = describe_failure('dialog', e)
+            return index, buffer, False
+        logging.warning(f'{buffer["id"]} - Dialog generation finished: {len(buffer["dialog_action_user"])+len(buffer["dialog_action_system"])} turns')
+        return index, buffer, True
+
+    with ThreadPoolExecutor(plot_workers) as executor:
+        items = iter(indices)
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    index = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(run_one(index)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                on_result(*task.result())
+
+
+def run_dialog_engine(prepare: Callable[[int], Tuple[dict, bool]], indices: Iterable[int],
+                      on_result: Callable[[int, dict, bool], None], max_in_flight: int = 100, llm_concurrency: int = 16,
+                      plot_workers: int = 5, history_strategy='full', history_turns=4, style_generation='per_style',
+                      style_stats: StyleGenerationStats = None) -> None:
+    """ Generate the dialogs of `indices` with at most `max_in_flight` dialogs and `llm_concurrency` LLM requests
+    at a time. `prepare(index)` returns the initial buffer of a datapoint and whether it is ready for simulation
+    (see `prepare_datapoint`); `on_result(index, buffer, success)` is called in completion order.
+    """
+    asyncio.run(_run_dialog_engine(prepare, indices, on_result, max_in_flight, llm_concurrency, plot_workers,
+                                   history_strategy, history_turns, style_generation, style_stats))
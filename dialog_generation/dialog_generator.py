@@ -3,16 +3,26 @@
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
 import json
+import threading
+from collections import Counter
 from textwrap import dedent
+from typing import List, NamedTuple
 
-from utilities.llm_synthesis_utils import call_openai_chat_completion, environment
+from utilities.llm_synthesis_utils import call_openai_chat_completion, count_tokens, environment
+from utilities.llm_trace import trace_context
+from utilities.metrics import LLM_RETRIES
 from .dataclass import SystemResponseStyle
 
 
-def conversation_to_text(conversation):
+HISTORY_STRATEGIES = ['full', 'last_k', 'actions']
+STYLE_GENERATION_MODES = ['per_style', 'single_call']
+
+
+def conversation_to_text(conversation, start_index=0):
     # input is a list of string, output should be one string with line breaking.
+    # start_index is the position of the first string in the conversation, which determines its role.
     conversation_with_role = []
-    for idx, conv in enumerate(conversation):
+    for idx, conv in enumerate(conversation, start_index):
         if idx % 2 == 0:
             conversation_with_role.append('user: ' + conv)
         else:
@@ -21,60 +31,168 @@ def conversation_to_text(conversation):
     return "\n".join(conversation_with_role)
 
 
-def get_system_response(prompt=None, messages=None) -> str:
+def render_conversation_history(conversation, strategy='full', history_turns=4, user_actions=None, system_actions=None) -> str:
+    """ The conversation so far as it is shown in the prompts.
+    'full' shows every turn, so the prompt grows with the dialog. 'last_k' shows the last `history_turns` turns,
+    preceded by the first user request that sets the goal of the dialog. 'actions' shows the last `history_turns`
+    turns verbatim and the earlier ones as their realized actions (`user_actions` / `system_actions` per turn).
+    """
+    if strategy not in HISTORY_STRATEGIES:
+        raise ValueError(f"unknown history strategy: {strategy}")
+    if strategy == 'full' or len(conversation) <= max(history_turns, 1):
+        return conversation_to_text(conversation)
+    start = len(conversation) - history_turns
+    if strategy == 'last_k':
+        earlier = conversation_to_text(conversation[:1])
+        if start > 1:
+            earlier += f"\n({start - 1} turns omitted)"
+    else:
+        earlier = conversation_to_text(
+            [json.dumps({'actions': user_actions[idx // 2] if idx % 2 == 0 else system_actions[idx // 2]}, ensure_ascii=False)
+             for idx in range(start)])
+    recent = conversation_to_text(conversation[start:], start_index=start)
+    return "\n".join(part for part in [earlier, recent] if part)
+
+
+USER_PROMPT_TEMPLATE = dedent("""\
+    You are a smartphone user and you are testing your virtual assistant on your phone by engaging in a multi-turn conversations with it. 
+    Here is your personal introduction: {{ user_intro }}
+
+    Instructions:
+    1. You need to communicate with the assistant following the guidance of "actions".
+    2. Based on the introduction, think about what speech habit you should have and communicate with this pattern.
+    3. The "utterance" should be brief.
+    4. You must return in JSON format, following the provided examples.
+
+    The context information is: {{ context }}.
+    
+    You are using these apps: {{ situation }}.
+
+    Example 1:
+    user: {"actions": ["get_reminders(time="09:00").reminders_modify(name=get_calendar_events(ordered_by="date", index=2).calendar_events_check(name).name)"], "utterance": "Please update the name of my 9am reminder to match the title of the 2nd earlist event on my calendar."}
+    Example 2:
+    user: {"actions": ["reminders_create(date=get_reminders(time="09:00").reminders_check(date).date)"], "utterance": "I'd like to create a new reminder same date with my 9 am reminder."}
+    
+    Begin conversation (you are identified as "user").
+    user: {"actions": ["hello()"], "utterance": "Hi."}
+    assistant: {"actions": ["offer_help()"], "utterance": "Hello, how can I help?"}
+    {{ conversation_history }}
+
+    The "actions" you need to follow is {{ dialog_action_user_realized[cur_turn_counter] | tojson }}. Please phrase the action into a realistic utterance. {{ user_style_instruction }}
+    user:\
+    """)
+
+
+SYSTEM_PROMPT_TEMPLATE = dedent("""\
+    You are a virtual assistant. Your goal is to assist the user based on their requests and provide helpful responses. 
+                                
+    Instructions:
+    1. Maintain a friendly and professional personality throughout the conversation.
+    2. Your responses should be simple, natural, and concise, using minimum words necessary.
+    3. Follow the provided context information and adhere to the specified "actions."
+    4. You must return in JSON format, following the provided examples.
+
+    The user is interacting with these apps: {{ situation }}.
+
+    Here is some relevant context: {{ context }}.
+
+    Conversation Example:
+    Begin conversation (you are identified as "assistant").
+    user: {"actions": ["hello()"], "utterance": "Hi."}
+    assistant: {"actions": ["offer_help()"], "utterance": "Hello, how can I help?"}
+    {{ conversation_history }}
+
+    Next Action:
+    Your next actions are {{ system_action_temp | tojson }}. Generate an appropriate response message. {{ system_style_instruction }}
+
+    assistant:\
+    """)
+
+
+ONE_OFF_SYSTEM_PROMPT_TEMPLATE = dedent("""\
+    Instructions:
+    1. You are a virtual assistant. Your goal is to assist the user to accomplish their goal.
+    2. Your responses should strictly follow the given actions and be helpful, natural, professional and concise.
+    3. Your response should strictly follow the corresponding "actions".
+
+    The user is interacting with these apps: {{ situation }}.
+
+    Here is some relevant context: {{ context }}.
+                                        
+    Style instruction:
+    'verbosity_low': Your response must only have a couple of words, such as "when", "how long" or "done".
+    'verbosity_mid': Your response should be a concise but complete sentence and must replace the nouns or noun phrases mentioned by user with pronouns, such as "it", "that" and "its".
+    'verbosity_high': Your response should use full expressions with all the details.
+    'mirroring': Your response should use the user's noun phrase or verb expressions when possible.
+    'no_mirroring': Ignore all previous dialog. Do not affect by user expression.
+    'summary': Your response should be a brief report of the given summary.
+
+    Response Example:
+    assistant actions: {"verbosity_low mirroring": ["notify_done()"], "verbosity_low no_mirroring": ["notify_done()"], "verbosity_mid mirroring": ["notify_done(operation_on_device(operation=\\"turn_off\\", device=\\"heating\\", home_space=\\"bedroom\\"))"], "verbosity_mid no_mirroring": ["notify_done(operation_on_device(operation=\\"turn_off\\", device=\\"heating\\", home_space=\\"bedroom\\"))"], "verbosity_high mirroring": ["notify_done(operation_on_device(operation=\\"turn_off\\", device=\\"heating\\", home_space=\\"bedroom\\"))"], "verbosity_high no_mirroring": ["notify_done(operation_on_device(operation=\\"turn_off\\", device=\\"heating\\", home_space=\\"bedroom\\"))"]}
+    assistant: {"verbosity_low mirroring": "Turned off.", "verbosity_low no_mirroring": "Done.", "verbosity_mid mirroring": "I have turned off the heating in that room.", "verbosity_mid no_mirroring": "I have turned it off in that room.", "verbosity_high mirroring": "I have turned off the bedroom heating.", "verbosity_high no_mirroring": "Sure, I have turned off the heating in the bedroom."}
+
+    Conversation history:
+    {{ conversation_history }}
+    
+    New turn:
+    You should return in JSON format with 6 keys: ["verbosity_low mirroring", "verbosity_low no_mirroring", "verbosity_mid mirroring", "verbosity_mid no_mirroring", "verbosity_high mirroring", "verbosity_high no_mirroring"]. {{ additional_style_instruction }}
+    assistant actions: {{ style_action_cur | tojson }}.
+    assistant: \
+    """)
+
+
+environment.filters['conversation_to_text'] = conversation_to_text
+user_prompt_template = environment.from_string(USER_PROMPT_TEMPLATE)
+system_prompt_template = environment.from_string(SYSTEM_PROMPT_TEMPLATE)
+one_off_system_prompt_template = environment.from_string(ONE_OFF_SYSTEM_PROMPT_TEMPLATE)
+
+
+# frequency_penalty: 1 encourages diverse response, 0 allows repeating frequently.
+# presence_penalty: 1 encourages using more provided keywords, 0 allows less constrained by the given context.
+SYSTEM_GENERATION_PARAMS = dict(max_tokens=750, temperature=0.2, top_p=0.9, frequency_penalty=0.3, presence_penalty=0.2)
+USER_GENERATION_PARAMS = dict(max_tokens=512, temperature=0.3, top_p=0.9, frequency_penalty=0.3, presence_penalty=0.5)
+
+
+def build_messages(prompt):
+    return [
+        {'role': 'system',
+         'content': "You are a helpful assistant. Please follow the user's instructions and examples' format."},
+        {'role': 'user', 'content': prompt},
+    ]
+
+
+def get_system_response(prompt=None, messages=None, stage='system_turn') -> str:
     if not messages:
-        messages = [
-            {'role': 'system',
-             'content': "You are a helpful assistant. Please follow the user's instructions and examples' format."},
-            {'role': 'user', 'content': prompt},
-        ]
+        messages = build_messages(prompt)
     max_retries, retry_count = 3, 0
     while retry_count < max_retries:
         try:
-            llm_output, _ = call_openai_chat_completion(
-                messages,
-                max_tokens=750,
-                temperature=0.2,
-                top_p=0.9,
-                frequency_penalty=0.3,
-                # 1 encourages diverse response, 0 allows repeating frequently.
-                presence_penalty=0.2
-                # 1 encourages using more provided keywords, 0 allows less constrained by the given context.
-            )
+            llm_output, _ = call_openai_chat_completion(messages, **SYSTEM_GENERATION_PARAMS, stage=stage)
             json.loads(llm_output)
             break
         except:
             retry_count += 1
+            if retry_count < max_retries:
+                LLM_RETRIES.inc(stage=stage, cause='malformed_json')
     if retry_count == max_retries:
         print(llm_output)
         raise AssertionError("LLM cannot produce output in JSON format.")
     return llm_output
 
 
-def get_user_response(prompt=None, messages=None):
+def get_user_response(prompt=None, messages=None, stage='user_turn'):
     if not messages:
-        messages = [
-            {'role': 'system',
-             'content': "You are a helpful assistant. Please follow the user's instructions and examples' format."},
-            {'role': 'user', 'content': prompt},
-        ]
+        messages = build_messages(prompt)
     max_retries, retry_count = 3, 0
     while retry_count<max_retries:
         try:
-            llm_output, _ = call_openai_chat_completion(
-                messages,
-                max_tokens=512,
-                temperature=0.3,
-                top_p=0.9,
-                frequency_penalty=0.3,
-                # 1 encourages diverse response, 0 allows repeating frequently.
-                presence_penalty=0.5
-                # 1 encourages using more provided keywords, 0 allows less constrained by the given context.
-            )
+            llm_output, _ = call_openai_chat_completion(messages, **USER_GENERATION_PARAMS, stage=stage)
             json.loads(llm_output)
             break
         except:
             retry_count += 1
+            if retry_count < max_retries:
+                LLM_RETRIES.inc(stage=stage, cause='malformed_json')
     if retry_count == max_retries:
         print(llm_output)
         raise AssertionError("LLM cannot produce output in JSON format.")
@@ -82,226 +200,262 @@ def get_user_response(prompt=None, messages=None):
     return llm_output
 
 
-def generate_single_dialog(buffer):
-    user_prompt_template = dedent("""\
-        You are a smartphone user and you are testing your virtual assistant on your phone by engaging in a multi-turn conversations with it. 
-        Here is your personal introduction: {{ user_intro }}
-
-        Instructions:
-        1. You need to communicate with the assistant following the guidance of "actions".
-        2. Based on the introduction, think about what speech habit you should have and communicate with this pattern.
-        3. The "utterance" should be brief.
-        4. You must return in JSON format, following the provided examples.
-
-        The context information is: {{ context }}.
-        
-        You are using these apps: {{ situation }}.
-
-        Example 1:
-        user: {"actions": ["get_reminders(time="09:00").reminders_modify(name=get_calendar_events(ordered_by="date", index=2).calendar_events_check(name).name)"], "utterance": "Please update the name of my 9am reminder to match the title of the 2nd earlist event on my calendar."}
-        Example 2:
-        user: {"actions": ["reminders_create(date=get_reminders(time="09:00").reminders_check(date).date)"], "utterance": "I'd like to create a new reminder same date with my 9 am reminder."}
-        
-        Begin conversation (you are identified as "user").
-        user: {"actions": ["hello()"], "utterance": "Hi."}
-        assistant: {"actions": ["offer_help()"], "utterance": "Hello, how can I help?"}
-        {% if conversation | length>0 %}{{ conversation | conversation_to_text }}{% endif %}
-
-        The "actions" you need to follow is {{ dialog_action_user_realized[cur_turn_counter] | tojson }}. Please phrase the action into a realistic utterance. {{ user_style_instruction }}
-        user:\
-    """)
-    system_prompt_template = dedent("""\
-        You are a virtual assistant. Your goal is to assist the user based on their requests and provide helpful responses. 
-                                    
-        Instructions:
-        1. Maintain a friendly and professional personality throughout the conversation.
-        2. Your responses should be simple, natural, and concise, using minimum words necessary.
-        3. Follow the provided context information and adhere to the specified "actions."
-        4. You must return in JSON format, following the provided examples.
-
-        The user is interacting with these apps: {{ situation }}.
-
-        Here is some relevant context: {{ context }}.
-
-        Conversation Example:
-        Begin conversation (you are identified as "assistant").
-        user: {"actions": ["hello()"], "utterance": "Hi."}
-        assistant: {"actions": ["offer_help()"], "utterance": "Hello, how can I help?"}
-        {% if conversation | length>0 %}{{ conversation | conversation_to_text }}{% endif %}
-
-        Next Action:
-        Your next actions are {{ system_action_temp | tojson }}. Generate an appropriate response message. {{ system_style_instruction }}
-
-        assistant:\
-    """)
-
-    environment.filters['conversation_to_text'] = conversation_to_text
-    user_prompt_template = environment.from_string(user_prompt_template)
-    system_prompt_template = environment.from_string(system_prompt_template)
-
-    system_response_style_prompts = {
-        'verbosity_low': 'The message must only have a couple of words, such as "when", "how long" or "done".',
-        'verbosity_mid': 'The message must replace the nouns or noun phrases mentioned by user with pronouns, such as "it", "that" and "its".',
-        'verbosity_high': 'The message should use full expression with name if available rather than pronouns.',
-        'mirroring': "Use the user's noun phrase or verb expressions when possible.",  # It should refer to the event or verbs by the same user's expression.",
-        'no_mirroring': "Ignore all previous dialog.",  # Do not use the expression used by the user.
-        'summarisation': 'Please respond with a coherent summary.',
-        'complex': 'Please respond with a sentence using complex sentence structure.',
-        'kid_friendly': "The message should use simple words with less syllables and safe language as if talking to a children."
-    }
-    system_grounding_options = ['verbosity_low', 'verbosity_mid', 'verbosity_high']
-    system_mirroring_option = ['mirroring', 'no_mirroring']
-
-    buffer['dialog_action_user_realized'] = [[act.realize() for act in actions] for actions in buffer['dialog_action_user']]
-    buffer['response_options'] = []
-    total_turn = len(buffer['dialog_action_user']) + len(buffer['dialog_action_system'])
-    cur_turn = 0
-    for i in range(10):
-        user_prompt = user_prompt_template.render(buffer)
-        response = get_user_response(user_prompt)
-        buffer['conversation'].append(response)
-
-        cur_turn += 1
-        if cur_turn >= total_turn:
-            break
-
+class TurnRequest(NamedTuple):
+    kind: str  # 'user', 'system', or 'system_styles' (all the style variants of a system turn in one response)
+    prompt: str
+    fields: dict  # The dialog-specific inputs of the prompt, for turn batching
+
+
+SYSTEM_STYLE_OPTIONS = [(grounding_option, mirroring_option)
+                        for grounding_option in ['verbosity_low', 'verbosity_mid', 'verbosity_high']
+                        for mirroring_option in ['mirroring', 'no_mirroring']]
+MAX_DIALOG_ROUNDS = 10  # Rounds of user turn + system turn
+TURN_STAGES = {'user': 'user_turn', 'system': 'system_turn', 'system_styles': 'system_styles'}  # For the metrics
+
+
+def get_trace_fields(buffer: dict, turn: int) -> dict:
+    """ The fields the LLM calls of a dialog turn are attributed to in the LLM trace. """
+    intents = [f'{service}.{intent}' for service, intent in zip(buffer.get('services', []), buffer.get('intents', []))]
+    return {'data_id': buffer.get('id'), 'intents': intents, 'turn': turn}
+
+
+def get_turn_response(request: TurnRequest) -> str:
+    if request.kind == 'user':
+        return get_user_response(request.prompt, stage=TURN_STAGES[request.kind])
+    return get_system_response(request.prompt, stage=TURN_STAGES[request.kind])
+
+
+def parse_style_options(llm_output: str, style_actions: dict) -> dict:
+    """ The valid style variants of a single-call system response, keyed by style tuple. Each variant must be a
+    non-empty message (or a message object with an "utterance"), and is stored like a per-style response.
+    """
+    try:
+        parsed = json.loads(llm_output)
+    except ValueError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    options = {}
+    for style in SYSTEM_STYLE_OPTIONS:
+        key = ' '.join(style)
+        message = parsed.get(key)
+        if isinstance(message, dict):
+            message = message.get('utterance')
+        if isinstance(message, str) and message.strip():
+            options[style] = json.dumps({'actions': style_actions[key], 'utterance': message}, ensure_ascii=False)
+    return options
+
+
+class StyleGenerationStats:
+    """ Thread-safe counts of the system turn requests and prompt tokens of single-call style generation, against
+    what per-style generation would have used.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def add(self, **counts) -> None:
+        with self.lock:
+            self.counts.update(counts)
+
+    def summary(self) -> str:
+        c = self.counts
+        calls = c['single_calls'] + c['fallback_calls']
+        per_style_calls = len(SYSTEM_STYLE_OPTIONS) * c['system_turns']
+        tokens = c['single_call_tokens'] + c['fallback_tokens']
+        return (f"{c['system_turns']} system turns with {calls} calls ({c['fallback_calls']} per-style fallbacks) "
+                f"instead of {per_style_calls} ({per_style_calls - calls} saved); "
+                f"{tokens} prompt tokens instead of {c['per_style_tokens']} ({c['per_style_tokens'] - tokens} saved)")
+
+
+class DialogState:
+    """ The turn loop of a dialog as a state machine, so it can be driven by a blocking loop or an event loop.
+    The phase goes 'user' (next user turn) -> 'system' (the system turn, or all its style variants in full response
+    options mode) -> 'user' ... -> 'done'. `next_requests()` renders the prompts of the current phase and
+    `advance()` takes their responses.
+    """
+
+    def __init__(self, buffer, history_strategy='full', history_turns=4, style_generation='per_style',
+                 style_stats: StyleGenerationStats = None):
+        if style_generation not in STYLE_GENERATION_MODES:
+            raise ValueError(f"unknown style generation mode: {style_generation}")
+        self.buffer = buffer
+        # The context shown in the prompts (see `select_context_within_budget`); the record keeps the full one
+        self.prompt_context = buffer.pop('prompt_context', buffer['context'])
+        self.history_strategy = history_strategy
+        self.history_turns = history_turns
+        # In full response options mode, 'single_call' asks for all the style variants of a system turn in one request
+        # and only requests the variants missing from its response separately.
+        self.style_generation = style_generation
+        self.style_stats = style_stats
+        self.style_actions = None
+        self.partial_options = None
+        self.missing_styles = None
+        # The plot is not modified anymore, so the realized strings of shared sub-actions can be reused across turns and styles
+        self.realization_cache = {}
+        buffer['dialog_action_user_realized'] = [[act.realize(cache=self.realization_cache) for act in actions] for actions in buffer['dialog_action_user']]
+        buffer['response_options'] = []
+        self.system_actions_realized = []  # The system actions of the responses the dialog carried on with
+        self.total_turn = len(buffer['dialog_action_user']) + len(buffer['dialog_action_system'])
+        self.cur_turn = 0
+        self.rounds = 0
+        self.phase = 'user'
+
+    @property
+    def done(self) -> bool:
+        return self.phase == 'done'
+
+    @property
+    def remaining_turns(self) -> int:
+        return self.total_turn - self.cur_turn
+
+    def _history(self) -> str:
+        return render_conversation_history(self.buffer['conversation'], self.history_strategy, self.history_turns,
+                                           self.buffer['dialog_action_user_realized'], self.system_actions_realized)
+
+    def _system_request(self, conversation_history) -> TurnRequest:
+        buffer = self.buffer
+        fields = {
+            'apps': buffer['situation'],
+            'context': self.prompt_context,
+            'conversation': conversation_history,
+            'actions': buffer['system_action_temp'],
+            'instruction': buffer['system_style_instruction'],
+        }
+        return TurnRequest('system', system_prompt_template.render(buffer, context=self.prompt_context, conversation_history=conversation_history), fields)
+
+    def _style_requests(self, styles, conversation_history) -> List[TurnRequest]:
+        buffer = self.buffer
+        optimal_style: SystemResponseStyle = buffer['system_optimal_style'][buffer['cur_turn_counter']]
+        current_sys_actions = buffer['dialog_action_system'][buffer['cur_turn_counter']]
+        requests = []
+        for grounding_option, mirroring_option in styles:
+            temp_style = SystemResponseStyle(verbosity=grounding_option, mirroring=mirroring_option, additional=optimal_style.additional)
+            buffer['system_style_instruction'] = temp_style.realize()
+            buffer['system_action_temp'] = [meta_action.realize((grounding_option, mirroring_option), cache=self.realization_cache) for meta_action in current_sys_actions]
+            requests.append(self._system_request(conversation_history))
+        return requests
+
+    def _estimate_per_style_tokens(self, conversation_history, optimal_style: SystemResponseStyle) -> int:
+        """ The prompt tokens per-style generation would use for the current system turn: the shared part of the
+        prompt, rendered once without actions and style instruction, plus those of each style.
+        """
+        shared_tokens = count_tokens(system_prompt_template.render(self.buffer, context=self.prompt_context,
+                                                                   conversation_history=conversation_history,
+                                                                   system_action_temp=[], system_style_instruction=''))
+        style_tokens = sum(count_tokens(json.dumps(self.style_actions[' '.join(style)]))
+                           + count_tokens(SystemResponseStyle(verbosity=style[0], mirroring=style[1], additional=optimal_style.additional).realize())
+                           for style in SYSTEM_STYLE_OPTIONS)
+        return len(SYSTEM_STYLE_OPTIONS) * shared_tokens + style_tokens
+
+    def _single_call_request(self, conversation_history) -> TurnRequest:
+        buffer = self.buffer
+        current_sys_actions = buffer['dialog_action_system'][buffer['cur_turn_counter']]
+        self.style_actions = {' '.join(style): [meta_action.realize(style, cache=self.realization_cache) for meta_action in current_sys_actions]
+                              for style in SYSTEM_STYLE_OPTIONS}
+        optimal_style: SystemResponseStyle = buffer['system_optimal_style'][buffer['cur_turn_counter']]
+        additional_style_instruction = SystemResponseStyle(additional=optimal_style.additional).realize()
+        prompt = one_off_system_prompt_template.render(buffer, context=self.prompt_context, conversation_history=conversation_history, style_action_cur=self.style_actions,
+                                                       additional_style_instruction=additional_style_instruction)
+        if self.style_stats:
+            self.style_stats.add(single_call_tokens=count_tokens(prompt),
+                                 per_style_tokens=self._estimate_per_style_tokens(conversation_history, optimal_style))
+        fields = {'apps': buffer['situation'], 'context': self.prompt_context, 'conversation': conversation_history,
+                  'actions': self.style_actions, 'instruction': additional_style_instruction}
+        return TurnRequest('system_styles', prompt, fields)
+
+    def next_requests(self) -> List[TurnRequest]:
+        buffer = self.buffer
+        conversation_history = self._history()
+        if self.phase == 'user':
+            fields = {
+                'introduction': buffer['user_intro'],
+                'apps': buffer['situation'],
+                'context': self.prompt_context,
+                'conversation': conversation_history,
+                'actions': buffer['dialog_action_user_realized'][buffer['cur_turn_counter']],
+                'instruction': buffer['user_style_instruction'],
+            }
+            return [TurnRequest('user', user_prompt_template.render(buffer, context=self.prompt_context, conversation_history=conversation_history), fields)]
+
+        optimal_style: SystemResponseStyle = buffer['system_optimal_style'][buffer['cur_turn_counter']]
+        current_sys_actions = buffer['dialog_action_system'][buffer['cur_turn_counter']]
         if buffer['if_full_response_options']:      # Generate all combinations of verbosity and mirroring
-            system_response_options = {}
-            optimal_style: SystemResponseStyle = buffer['system_optimal_style'][buffer['cur_turn_counter']]
-            additional_styles = optimal_style.additional
-            for grounding_option in system_grounding_options:
-                # buffer['system_style_instruction'] = grounding_option
-                for mirroring_option in system_mirroring_option:
-                    temp_style = SystemResponseStyle(verbosity=grounding_option, mirroring=mirroring_option, additional=additional_styles)
-                    buffer['system_style_instruction'] = temp_style.realize()  #' '.join([system_response_style_prompts[style] for style in system_response_style])
-
-                    current_sys_actions = buffer['dialog_action_system'][buffer['cur_turn_counter']]
-                    buffer['system_action_temp'] = [meta_action.realize((grounding_option, mirroring_option)) for meta_action in current_sys_actions]
-                    system_prompt = system_prompt_template.render(buffer)
-                    response = get_system_response(system_prompt)
-                    system_response_options[(grounding_option, mirroring_option)] = response
+            if self.style_generation == 'single_call':
+                if self.missing_styles is None:
+                    return [self._single_call_request(conversation_history)]
+                requests = self._style_requests(self.missing_styles, conversation_history)
+                if self.style_stats:
+                    self.style_stats.add(fallback_tokens=sum(count_tokens(request.prompt) for request in requests))
+                return requests
+            return self._style_requests(SYSTEM_STYLE_OPTIONS, conversation_history)
+        buffer['system_style_instruction'] = optimal_style.realize()
+        buffer['system_action_temp'] = [meta_action.realize(optimal_style.get_style_tuple(), cache=self.realization_cache) for meta_action in current_sys_actions]
+        return [self._system_request(conversation_history)]
+
+    def advance(self, responses: List[str]) -> None:
+        """ Record the responses to the requests of the current phase and move on to the next phase. """
+        buffer = self.buffer
+        if self.phase == 'user':
+            buffer['conversation'].append(responses[0])
+            self.cur_turn += 1
+            self.phase = 'done' if self.cur_turn >= self.total_turn else 'system'
+            return
+
+        if buffer['if_full_response_options']:
+            if self.style_generation == 'single_call':
+                if self.missing_styles is None:
+                    self.partial_options = parse_style_options(responses[0], self.style_actions)
+                    self.missing_styles = [style for style in SYSTEM_STYLE_OPTIONS if style not in self.partial_options]
+                    if self.style_stats:
+                        self.style_stats.add(system_turns=1, single_calls=1, fallback_calls=len(self.missing_styles))
+                    if self.missing_styles:
+                        return  # Stay in the system phase to request the missing styles
+                else:
+                    self.partial_options.update(zip(self.missing_styles, responses))
+                system_response_options = {style: self.partial_options[style] for style in SYSTEM_STYLE_OPTIONS}
+                self.partial_options = self.missing_styles = None
+            else:
+                system_response_options = dict(zip(SYSTEM_STYLE_OPTIONS, responses))
             buffer['response_options'].append(system_response_options)
+            optimal_style: SystemResponseStyle = buffer['system_optimal_style'][buffer['cur_turn_counter']]
             cur_optimal_style = (optimal_style.verbosity, "no_mirroring")  # (Optimal) verbosity and mirroring style to carry on the dialog.
+            current_sys_actions = buffer['dialog_action_system'][buffer['cur_turn_counter']]
+            self.system_actions_realized.append([meta_action.realize(cur_optimal_style, cache=self.realization_cache) for meta_action in current_sys_actions])
             buffer['conversation'].append(system_response_options[cur_optimal_style])
-            cur_turn += 1
-
         else:
-            buffer['system_style_instruction'] =  buffer['system_optimal_style'][buffer['cur_turn_counter']].realize()
-            current_sys_actions = buffer['dialog_action_system'][buffer['cur_turn_counter']]
-            current_sys_style = buffer['system_optimal_style'][buffer['cur_turn_counter']].get_style_tuple()
-            buffer['system_action_temp'] = [meta_action.realize(current_sys_style) for meta_action in current_sys_actions]
-            system_prompt = system_prompt_template.render(buffer)
-            response = get_system_response(system_prompt)
-            buffer['conversation'].append(response)
-            cur_turn += 1
-
-        if cur_turn >= total_turn:
-            break
+            self.system_actions_realized.append(buffer['system_action_temp'])
+            buffer['conversation'].append(responses[0])
+        self.cur_turn += 1
+        if self.cur_turn >= self.total_turn:
+            self.phase = 'done'
+            return
         buffer['cur_turn_counter'] += 1
-
+        self.rounds += 1
+        self.phase = 'done' if self.rounds >= MAX_DIALOG_ROUNDS else 'user'
+
+
+def generate_single_dialog(buffer, history_strategy='full', history_turns=4, batcher=None, style_generation='per_style',
+                           style_stats: StyleGenerationStats = None):
+    """ Simulate the dialog of the buffer turn by turn. `history_strategy` and `history_turns` set how the
+    conversation so far is shown in the prompts (see `render_conversation_history`).
+    With a `TurnBatcher`, the turns are generated in batches together with those of other dialogs.
+    `style_generation` sets how the style variants are generated in full response options mode (see `DialogState`).
+    """
+    state = DialogState(buffer, history_strategy, history_turns, style_generation, style_stats)
+    while not state.done:
+        responses = []
+        with trace_context(**get_trace_fields(buffer, state.cur_turn)):
+            for request in state.next_requests():
+                if batcher is not None:
+                    responses.append(batcher.request(request))
+                else:
+                    responses.append(get_turn_response(request))
+        state.advance(responses)
     return buffer
 
 
-def generate_dialog_one_off(buffer):
-    user_prompt_template = dedent("""\
-        Instructions:
-        1. You are a smartphone user and you need to communicate with your virtual assistant by engaging in a multi-turn conversations.
-        2. Based on your personal introduction, think about what speech habit you should have and speak with this pattern.
-        3. Your response should strictly follow the given actions. Take the nesting action as a clause and the slot value as an antecedent to generate a coherent and complex user query.
-
-        Personal introduction: {{ user_intro }}
-        
-        You are using these apps: {{ situation }}.
-
-        Conversation Example (you are identified as "user" and talking to "assistant").
-        user actions: ["operation_on_device(operation=\\"turn_off\\", device=\\"heating\\")"]
-        user: Can you please turn up the heating?
-        assistant actions: ["request_information(home_space)"]
-        assistant: Which room would that be?
-        user action: ["inform_information(home_space=\\"study room\\")"]
-        user: {"message": " In the study room"}
-
-        New conversation:
-        {% if conversation | length>0 %}{{ conversation | conversation_to_text }}{% endif %}
-                                  
-        You must return in JSON format and response base on the following action:
-        user action: {{ dialog_action_user_realized[cur_turn_counter] | tojson }}.
-        user: \
-    """)
-                                
-
-    system_prompt_template_speedup = dedent("""\
-        Instructions:
-        1. You are a virtual assistant. Your goal is to assist the user to accomplish their goal.
-        2. Your responses should strictly follow the given actions and be helpful, natural, professional and concise.
-        3. Your response should strictly follow the corresponding "actions".
-
-        The user is interacting with these apps: {{ situation }}.
-                                            
-        Style instruction:
-        'verbosity_low': Your response must only have a couple of words, such as "when", "how long" or "done".
-        'verbosity_mid': Your response should be a concise but complete sentence and must replace the nouns or noun phrases mentioned by user with pronouns, such as "it", "that" and "its".
-        'verbosity_high': Your response should use full expressions with all the details.
-        'mirroring': Your response should use the user's noun phrase or verb expressions when possible.
-        'no_mirroring': Ignore all previous dialog. Do not affect by user expression.
-        'summary': Your response should be a brief report of the given summary.
-
-        Response Example:
-        assistant actions: {"verbosity_low mirroring": ["notify_done()"], "verbosity_low no_mirroring": ["notify_done()"], "verbosity_mid mirroring": ["notify_done(operation_on_device(operation=\\"turn_off\\", device=\\"heating\\", home_space=\\"bedroom\\"))"], "verbosity_mid no_mirroring": ["notify_done(operation_on_device(operation=\\"turn_off\\", device=\\"heating\\", home_space=\\"bedroom\\"))"], "verbosity_high mirroring": ["notify_done(operation_on_device(operation=\\"turn_off\\", device=\\"heating\\", home_space=\\"bedroom\\"))"], "verbosity_high no_mirroring": ["notify_done(operation_on_device(operation=\\"turn_off\\", device=\\"heating\\", home_space=\\"bedroom\\"))"]}
-        assistant: {"verbosity_low mirroring": "Turned off.", "verbosity_low no_mirroring": "Done.", "verbosity_mid mirroring": "I have turned off the heating in that room.", "verbosity_mid no_mirroring": "I have turned it off in that room.", "verbosity_high mirroring": "I have turned off the bedroom heating.", "verbosity_high no_mirroring": "Sure, I have turned off the heating in the bedroom."}
-
-        Conversation history:
-        {% if conversation | length>0 %}{{ conversation | conversation_to_text }}{% endif %}
-        
-        New turn:
-        You should return in JSON format with 6 keys: ["verbosity_low mirroring", "verbosity_low no_mirroring", "verbosity_mid mirroring", "verbosity_mid no_mirroring", "verbosity_high mirroring", "verbosity_high no_mirroring"].
-        assistant actions: {{ style_action_cur | tojson }}.
-        assistant: \
-    """)
-    environment.filters['conversation_to_text'] = conversation_to_text
-    user_prompt_template = environment.from_string(user_prompt_template)
-    system_prompt_template = environment.from_string(system_prompt_template_speedup)
-
-    system_grounding_options = ['verbosity_low', 'verbosity_mid', 'verbosity_high']
-    system_mirroring_options = ['mirroring', 'no_mirroring']
-
-    buffer['dialog_action_user_realized'] = [[act.realize() for act in actions] for actions in buffer['dialog_action_user']]
-    buffer['response_options'] = []
-    total_turn = len(buffer['dialog_action_user']) + len(buffer['dialog_action_system'])
-    cur_turn = 0
-    for i in range(10):
-        user_prompt = user_prompt_template.render(buffer)
-        response = get_user_response(user_prompt)
-        # print(user_prompt)
-        user_msg = json.loads(response)['message']
-        buffer['conversation'].append(user_msg)
-        # print('---------------------------------------------------')
-        cur_turn += 1
-        if cur_turn >= total_turn:
-            break
-
-        current_optimal_style = buffer['system_optimal_style'][buffer['cur_turn_counter']].realize_to_key()
-        current_sys_actions = buffer['dialog_action_system'][buffer['cur_turn_counter']]
-        style_actions = {}
-        for v in system_grounding_options:
-            for m in system_mirroring_options:
-                key = v + ' ' + m
-                style_actions[key] = [meta_action.realize(key) for meta_action in current_sys_actions]
-        buffer['style_action_cur'] = style_actions
-
-        system_prompt = system_prompt_template.render(buffer)
-        # print(system_prompt)
-        response = get_system_response(system_prompt)
-        parsed_response = json.loads(response)
-        buffer['conversation'].append(parsed_response[current_optimal_style])
-        buffer['response_options'].append(parsed_response)
-        cur_turn += 1
-
-        if cur_turn >= total_turn:
-            break
-        buffer['cur_turn_counter'] += 1
-    
-
 def buffer_filter(buffer):
     contents = ['phenomena', 'local_phenomena', 'context', 'situation', 'services', 'intents', 'dialog_action_user',\
                 'dialog_action_system', 'system_optimal_style', 'conversation', 'response_options', 'user_intro']
@@ -3,9 +3,9 @@
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
 import random
-from typing import Dict
+from typing import Dict, List, Optional
 
-from .dataclass import IntentValues
+from .dataclass import IntentValues, IntentSchema, ServiceSchema
 from .schema_utils import Schema
 
 
@@ -13,10 +13,60 @@ class IncompatibleContext(RuntimeError):
     pass
 
 
-def sample_intent(context: Dict, service: str = None, intent: str = None, input_slot: str = None, output_slot: str = None) -> IntentValues:
+def resolve_input_slot(intent_schema: IntentSchema, input_slot: Optional[str], output_slot: Optional[str]) -> Optional[str]:
+    """ The input slot that an intent must have for `output_slot` to be satisfied. """
+    if output_slot and output_slot != 'summary':
+        assert not input_slot
+        if intent_schema.check_on_input:
+            return output_slot
+        assert output_slot in intent_schema.result_slots
+    return input_slot
+
+
+class ContextIndex:
+    """ The feasible (service, intent, input_slot) triples of a context. For each intent that interacts with the
+    context, it lists the entities that have each of its optional slots (`input_slot=None`: the entities with enough
+    slots for the intent), so that sampling never picks an entity the intent cannot operate on.
+    """
+
+    def __init__(self, context: Dict):
+        self.entities = {}
+        for service_schema, intent_schema in Schema.iter_intents():
+            if not intent_schema.require_context:
+                continue
+            key = (service_schema.service_name, intent_schema.name)
+            for entity_index, entity in enumerate(context.get(service_schema.service_name, [])):
+                available_slots = set(intent_schema.optional_slots) & entity.keys()
+                if len(available_slots) >= intent_schema.minimum_input_slot_number:
+                    self.entities.setdefault(key + (None,), []).append(entity_index)
+                for slot in available_slots:
+                    self.entities.setdefault(key + (slot,), []).append(entity_index)
+
+    def candidate_entities(self, service: str, intent: str, input_slot: str = None) -> List[int]:
+        return self.entities.get((service, intent, input_slot), [])
+
+    def is_feasible(self, service_schema: ServiceSchema, intent_schema: IntentSchema, input_slot: str = None,
+                    output_slot: str = None) -> bool:
+        if not intent_schema.require_context:
+            return True
+        input_slot = resolve_input_slot(intent_schema, input_slot, output_slot)
+        return bool(self.candidate_entities(service_schema.service_name, intent_schema.name, input_slot))
+
+    def feasible_intents(self, service: str = None):
+        """ The feasible (service schema, intent schema) pairs, optionally of a single service. """
+        return [(service_schema, intent_schema) for service_schema, intent_schema in Schema.iter_intents()
+                if (not service or service_schema.service_name == service) and self.is_feasible(service_schema, intent_schema)]
+
+
+def sample_intent(context: Dict, service: str = None, intent: str = None, input_slot: str = None, output_slot: str = None,
+                  rng: random.Random = random, index: ContextIndex = None) -> IntentValues:
     """ Get an intent with slot keys but empty slot values.
+    Service and intent are sampled among those feasible for the context (see `ContextIndex`), unless specified.
+    Raises IncompatibleContext if the specified ones are impossible for the context.
     """
     schema = Schema.get_schema()
+    if index is None:
+        index = ContextIndex(context)
 
     # Randomly sample service & intent, or use the specified given ones
     if service:
@@ -26,10 +76,10 @@ def sample_intent(context: Dict, service: str = None, intent: str = None, input_
                 break
         else:
             raise ValueError(f"undefined service: {service}")
-    else:
-        service_schema = random.sample(schema, k=1)[0]
 
     if intent:
+        if not service:
+            raise ValueError("an intent can only be specified together with its service")
         for i in service_schema.intent_operations:
             if i.name == intent:
                 intent_schema = i
@@ -37,24 +87,26 @@ def sample_intent(context: Dict, service: str = None, intent: str = None, input_
         else:
             raise ValueError(f"undefined intent: {intent}")
     else:
-        intent_schema = random.sample(service_schema.intent_operations, k=1)[0]
+        candidates = index.feasible_intents(service)
+        if not candidates:
+            raise IncompatibleContext(f"no intent of {service or 'any service'} is feasible for the context")
+        # Same distribution as sampling a service, then one of its intents, and retrying until feasible
+        weights = [1 / len(s.intent_operations) for s, _ in candidates]
+        service_schema, intent_schema = rng.choices(candidates, weights=weights)[0]
 
     # Make sure output_slot is satisfied
-    if output_slot and output_slot != 'summary':
-        assert not input_slot
-        if intent_schema.check_on_input:
-            input_slot = output_slot
-        else:
-            assert output_slot in intent_schema.result_slots
+    input_slot = resolve_input_slot(intent_schema, input_slot, output_slot)
 
     # Create input & output slots
     output_slot_values = [{slot: None for slot in intent_schema.result_slots}]
     if intent_schema.require_context:
         # When the sampled intent needs interaction with the context.
-        num_entities = len(context.get(service_schema.service_name, []))
-        if not num_entities:
-            raise IncompatibleContext(f"context lacks data for {service_schema.service_name}")
-        context_entity_index = random.randrange(num_entities)
+        entity_indices = index.candidate_entities(service_schema.service_name, intent_schema.name, input_slot)
+        if not entity_indices:
+            if input_slot:
+                raise IncompatibleContext(f"no {service_schema.service_name} entity of the context has attribute {input_slot}")
+            raise IncompatibleContext(f"context lacks data for {service_schema.service_name}.{intent_schema.name}")
+        context_entity_index = rng.choice(entity_indices)
         context_entity = context[service_schema.service_name][context_entity_index]
         # We dont check the necessary slots here, cuz we assume
         # if intent needs interacting with context, then it can only operate upto 1 slot.
@@ -63,12 +115,10 @@ def sample_intent(context: Dict, service: str = None, intent: str = None, input_
         assert not intent_schema.required_slots
         available_slots = set(intent_schema.optional_slots) & context_entity.keys()
         if input_slot: # If input_slot is specified, we only sample that slot.
-            if input_slot not in available_slots:
-                raise IncompatibleContext(f"context entity doesn't have attribute {input_slot}")
             sampled_input_slots = [input_slot]
         else:
-            num_input_slots = random.randint(intent_schema.minimum_input_slot_number, 1)
-            sampled_input_slots = random.sample(list(available_slots), k=num_input_slots)
+            num_input_slots = rng.randint(intent_schema.minimum_input_slot_number, min(len(available_slots), 1))
+            sampled_input_slots = rng.sample(sorted(available_slots), k=num_input_slots)
         if intent_schema.check_on_input:
             assert not intent_schema.result_slots
             output_slot_values = [{slot: context_entity[slot] for slot in sampled_input_slots}]
@@ -83,8 +133,8 @@ def sample_intent(context: Dict, service: str = None, intent: str = None, input_
             optional_slots.remove(input_slot)
         max_num_extra_slots = len(intent_schema.required_slots) + len(intent_schema.optional_slots) - len(sampled_input_slots)
         min_num_extra_slots = max(intent_schema.minimum_input_slot_number - len(sampled_input_slots), 0)
-        num_extra_slots = random.randint(min_num_extra_slots, max_num_extra_slots)
-        sampled_input_slots.extend(random.sample(optional_slots, k=num_extra_slots))
+        num_extra_slots = rng.randint(min_num_extra_slots, max_num_extra_slots)
+        sampled_input_slots.extend(rng.sample(optional_slots, k=num_extra_slots))
     input_slot_values = {slot: None for slot in sampled_input_slots}
 
     return IntentValues(
@@ -3,59 +3,196 @@
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
 import argparse
+import hashlib
 import json
 import logging
-import math
-import multiprocessing.dummy
+import os
+import random
+import sys
 import traceback
 import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 
-from .context_loader import load_contexts, convert_context
-from .dialog_generator import generate_single_dialog
+from utilities.dry_run import add_dry_run_arguments, enable_dry_run, report_dry_run, sample_evenly
+from utilities.llm_trace import TRACE_SUFFIX, start_trace, stop_trace, trace_context
+from utilities.profiling import add_profile_argument, start_profiler
+from utilities.metrics import DATAPOINTS, QUEUE_DEPTH, MetricsExporter, format_stage_summary, track_throughput
+from utilities.sharded_jsonl import COMPRESSION_SUFFIXES, ShardedJsonlWriter, iter_jsonl_lines, sort_shards
+
+from .context_loader import CONTEXTS_FILE, load_converted_contexts, finalize_context
+from .dialog_generator import HISTORY_STRATEGIES, STYLE_GENERATION_MODES, StyleGenerationStats, generate_single_dialog
+from .turn_batching import TurnBatcher
+from .dialog_engine import run_dialog_engine
+from .dead_letter import compact_dead_letters, describe_failure, get_dead_letter_path, load_dead_letters
 from .operation_sampler import get_operation
 from .plot_generator import get_initial_buffer
+from .serialization import encode_buffer, dumps_record, loads_record
+from .slot_value_bank import SLOT_VALUE_BANK_FILE
 from .slot_value_sampler import populate_operation_slot_values
 
 
-def generate_single_datapoint(setup, context, phenomena, if_full_response_options, service=None, intent=None):
-    data_id = uuid.uuid4()
-    buffer = {'id': str(data_id)}
+RUN_ID_NAMESPACE = uuid.UUID('8f4b6a2e-4c1d-5b7e-9a3f-2d6c8e0b1a57')
+
+
+def derive_seed(base_seed: int, index: int) -> int:
+    """ The seed of a single datapoint, which only depends on the run's base seed and the datapoint index.
+    """
+    digest = hashlib.sha256(f'{base_seed}:{index}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def get_data_id(base_seed: int, phenomena: str, index: int) -> str:
+    return str(uuid.uuid5(RUN_ID_NAMESPACE, f'{phenomena}:{base_seed}:{index}'))
+
+
+def hash_file(path) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_run_manifest(manifest_path: Path):
     try:
-        operation = get_operation(context, phenomena, service=service, intent=intent)
-        populate_operation_slot_values(operation, context)
-        logging.warning(f'{data_id} - Intent and parameters ready: {operation}')
-        # Construct buffer
-        buffer = get_initial_buffer(setup, context, operation=operation)
-        buffer['if_full_response_options'] = if_full_response_options
-        logging.warning(f'{data_id} - Intent plots ready.')
+        with open(manifest_path, 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def save_run_manifest(manifest_path: Path, manifest: dict) -> None:
+    tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_completed_ids(output_path: Path) -> set:
+    """ Ids of the datapoints that were fully generated by previous runs (failure stubs don't count).
+    """
+    completed = set()
+    if not output_path.exists():
+        return completed
+    for line in iter_jsonl_lines(output_path):
+        try:
+            d = loads_record(line)
+        except ValueError:
+            continue  # e.g. a line truncated by a crash
+        if len(d) > 2 and 'id' in d:
+            completed.add(d['id'])
+    return completed
+
+
+def prepare_datapoint(setup, context, phenomena, if_full_response_options, service=None, intent=None,
+                      data_id=None, rng: random.Random = random):
+    """ Sample the operation and the plot of a datapoint. Returns the initial buffer of the dialog and whether this
+    succeeded (otherwise the buffer only holds the id and the `failure`, see `describe_failure`).
+    """
+    data_id = data_id or str(uuid.uuid4())
+    buffer = {'id': data_id}
+    try:
+        with trace_context(data_id=data_id):
+            operation = get_operation(context, phenomena, service=service, intent=intent, rng=rng)
+            populate_operation_slot_values(operation, context, rng)
+            logging.warning(f'{data_id} - Intent and parameters ready: {operation}')
+            # Construct buffer
+            buffer = {'id': data_id, **get_initial_buffer(setup, context, operation=operation, rng=rng)}
+            buffer['if_full_response_options'] = if_full_response_options
+            logging.warning(f'{data_id} - Intent plots ready.')
     except Exception as e:
         logging.error(f"{data_id} - Plot generation failed: {repr(e)}")
         # Get the traceback object
         tb = traceback.format_exc()
         # Print the traceback information
         logging.error("Traceback: "+tb)
+        buffer = {'id': data_id, 'failure': describe_failure('plot', e)}
+        return buffer, False
+    return buffer, True
+
+
+def generate_single_datapoint(setup, context, phenomena, if_full_response_options, service=None, intent=None,
+                              data_id=None, rng: random.Random = random, batcher: TurnBatcher = None,
+                              style_stats: StyleGenerationStats = None):
+    buffer, ready = prepare_datapoint(setup, context, phenomena, if_full_response_options, service=service,
+                                      intent=intent, data_id=data_id, rng=rng)
+    if not ready:
         return buffer
 
     # Simulation
     try:
-        generate_single_dialog(buffer)
-        logging.warning(f'{data_id} - Dialog generation finished: {len(buffer["dialog_action_user"])+len(buffer["dialog_action_system"])} turns')
+        generate_single_dialog(buffer, history_strategy=setup.get('history_strategy', 'full'),
+                               history_turns=setup.get('history_turns', 4), batcher=batcher,
+                               style_generation=setup.get('style_generation', 'per_style'), style_stats=style_stats)
+        logging.warning(f'{buffer["id"]} - Dialog generation finished: {len(buffer["dialog_action_user"])+len(buffer["dialog_action_system"])} turns')
     except Exception as e:
-        logging.error(f"{data_id} - Dialog generation failed: {repr(e)}")
+        logging.error(f"{buffer['id']} - Dialog generation failed: {repr(e)}")
+        buffer['failure'] = describe_failure('dialog', e)
         return buffer
 
     # Convert data into JSON-able format
-    if buffer.get('dialog_action_user'):
-        buffer['dialog_action_user'] = [[action.to_dict() for action in turn] for turn in buffer['dialog_action_user']]
-    if buffer.get('dialog_action_system'):
-        buffer['dialog_action_system'] = [[action.to_dict() for action in turn] for turn in buffer['dialog_action_system']]
-    if buffer.get('system_optimal_style'):
-        buffer['system_optimal_style'] = [style.to_dict() for style in buffer['system_optimal_style']]
-    if buffer.get('response_options'):
-        buffer['response_options'] = [{' '.join(k): v for k, v in turn.items()} for turn in buffer['response_options']]
+    return encode_buffer(buffer)
+
+
+def imap_unordered_bounded(func, iterable, num_workers: int, max_in_flight: int):
+    """ Yield `(seq_id, result)` pairs in completion order, where `seq_id` is the position of the input item.
+    At most `max_in_flight` items are submitted but not yet consumed, so a slow item never blocks the ones behind it
+    and finished results don't pile up in memory.
+    """
+    items = enumerate(iterable)
+    with ThreadPoolExecutor(num_workers) as executor:
+        pending = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    seq_id, item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(func, item)] = seq_id
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
 
-    return buffer
+
+def seq_id_key(line: str) -> int:
+    try:
+        return loads_record(line).get('seq_id', -1)
+    except ValueError:
+        return -1
+
+
+def sort_output_by_seq_id(output_path: Path, start_offset: int = 0) -> None:
+    """ Reorder the records written after `start_offset` by their `seq_id`, leaving earlier content untouched.
+    Only the (seq_id, offset) index is kept in memory; the records themselves are copied line by line.
+    """
+    index = []
+    with open(output_path, 'rb') as fp:
+        fp.seek(start_offset)
+        offset = start_offset
+        for line in fp:
+            if line.strip():
+                index.append((seq_id_key(line), offset))
+            offset += len(line)
+    index.sort(key=lambda x: x[0])
+
+    tmp_path = output_path.with_name(output_path.name + '.sorting')
+    with open(output_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        remaining = start_offset
+        while remaining > 0:
+            chunk = src.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+        for _, offset in index:
+            src.seek(offset)
+            dst.write(src.readline())
+    os.replace(tmp_path, output_path)
 
 
 if __name__ == '__main__':
@@ -66,38 +203,268 @@ if __name__ == '__main__':
     parser.add_argument('--erase_previous_data', action="store_true", help="Enable erasing previously saved data.")
     parser.add_argument('--full_options_mode', action='store_true', help="Enable generation all system response options.")
     parser.add_argument('--thread_num', type=int, help="Number of threads to use.", default=5)
+    parser.add_argument('--max_in_flight', type=int, help="Maximum number of datapoints submitted but not yet written (default: 2 * thread_num).", default=None)
+    parser.add_argument('--sort_output', action='store_true', help="Reorder the records written by this run by input order when finished.")
+    parser.add_argument('--seed', type=int, help="Base seed of the run (default: taken from the run manifest, or random for a new run).", default=None)
+    parser.add_argument('--shard_max_records', type=int, help="Start a new output shard after this many records.", default=None)
+    parser.add_argument('--shard_max_bytes', type=int, help="Start a new output shard after this many (uncompressed) bytes.", default=None)
+    parser.add_argument('--compression', type=str, choices=list(COMPRESSION_SUFFIXES), help="Compression of the output shards.", default='none')
+    parser.add_argument('--context_token_budget', type=int, help="Approximate number of tokens of the context shown in the prompts (default: the full relevant context).", default=None)
+    parser.add_argument('--history_strategy', type=str, choices=HISTORY_STRATEGIES, help="How the conversation so far is shown in the prompts.", default='full')
+    parser.add_argument('--history_turns', type=int, help="Number of most recent turns shown verbatim by the `last_k` and `actions` history strategies.", default=4)
+    parser.add_argument('--style_generation', type=str, choices=STYLE_GENERATION_MODES, help="With --full_options_mode, `single_call` generates all the style variants of a system turn in one request (missing variants are requested separately).", default='per_style')
+    parser.add_argument('--turn_batch_size', type=int, help="Generate the next turns of up to this many dialogs in one LLM request (needs --thread_num at least as large; 1 disables batching).", default=1)
+    parser.add_argument('--turn_batch_wait', type=float, help="Seconds a turn waits for its batch to fill up before the batch is sent.", default=0.5)
+    parser.add_argument('--engine', type=str, choices=['threads', 'async'], help="`threads` runs each dialog in a worker thread; `async` drives all dialogs from an event loop, with --thread_num threads for plot preparation only.", default='threads')
+    parser.add_argument('--llm_concurrency', type=int, help="Maximum number of concurrent LLM requests of the async engine.", default=16)
+    parser.add_argument('--retry_failed', action='store_true', help="Only regenerate the datapoints of the dead-letter file ({phenomena}.failed.jsonl) with transient failures.")
+    parser.add_argument('--retry_deterministic', action='store_true', help="With --retry_failed, also retry the datapoints with deterministic failures.")
+    parser.add_argument('--metrics_file', type=Path, help="Export the pipeline metrics to this Prometheus textfile (rewritten every --metrics_interval seconds).", default=None)
+    parser.add_argument('--metrics_port', type=int, help="Serve the pipeline metrics on http://127.0.0.1:<port>/metrics.", default=None)
+    parser.add_argument('--metrics_interval', type=float, help="Seconds between two writes of --metrics_file.", default=10)
+    parser.add_argument('--llm_trace', action='store_true', help="Append a record per LLM call to {phenomena}.llm_trace.jsonl in the output directory (analyze it with `python -m utilities.llm_trace`).")
+    add_profile_argument(parser)
+    add_dry_run_arguments(parser)
+    parser.add_argument('--reproduce', type=int, nargs='+', help="Regenerate the datapoints of these indices and print them instead of writing the output.", default=None)
     args = parser.parse_args()
     logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING)
+    profiler = start_profiler(args.profile)  # Written to {phenomena}.profile.txt / .pstats in the output directory
 
     phenomena = args.phenomena
-    contexts = load_contexts()
-    expanded_contexts = (contexts * math.ceil(args.number_of_data / len(contexts)))[:args.number_of_data]
+    contexts = load_converted_contexts()
     seeded_setup = {
         'event_execute_count': 5,
         'user_speaking_speed': 'slow',
         'system_mirror_switch': False,
         'system_kid_switch': False,
     }
+    if args.context_token_budget is not None:  # Only recorded when set, so earlier run manifests stay valid
+        seeded_setup['context_token_budget'] = args.context_token_budget
+    if args.history_strategy != 'full':
+        seeded_setup['history_strategy'] = args.history_strategy
+        seeded_setup['history_turns'] = args.history_turns
+    if args.style_generation != 'per_style':
+        if not args.full_options_mode:
+            parser.error("--style_generation=single_call needs --full_options_mode.")
+        seeded_setup['style_generation'] = args.style_generation
 
-    def _generate_data_point(context):
-        context = convert_context(context)
+    # The run manifest pins everything that determines the datapoint of a given index.
+    args.output_dir.mkdir(exist_ok=True)
+    # Sharding or compression switches the output from a single file to a directory of shards with a manifest
+    sharded_output = bool(args.shard_max_records or args.shard_max_bytes or args.compression != 'none')
+    output_path = args.output_dir / (phenomena if sharded_output else f'{phenomena}.jsonl')
+    manifest_path = args.output_dir / f'{phenomena}.manifest.json'
+    config = {
+        'phenomena': phenomena,
+        'full_options_mode': args.full_options_mode,
+        'setup': seeded_setup,
+    }
+    if sharded_output:  # Only recorded when sharded, so earlier run manifests stay valid
+        config['output_layout'] = 'sharded'
+    context_file_hash = hash_file(CONTEXTS_FILE)
+    # Slot values are sampled from the bank, which a resumed bank build extends
+    slot_value_bank_hash = hash_file(SLOT_VALUE_BANK_FILE) if os.path.isfile(SLOT_VALUE_BANK_FILE) else None
+    dry_run = args.dry_run is not None
+    manifest = None if args.erase_previous_data or dry_run else load_run_manifest(manifest_path)
+    if manifest is None:
+        if args.reproduce:
+            parser.error(f"--reproduce needs an existing run manifest: {manifest_path}")
+        base_seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2 ** 32)
+        manifest = {
+            'base_seed': base_seed,
+            'config': config,
+            'context_file': CONTEXTS_FILE,
+            'context_file_hash': context_file_hash,
+            'slot_value_bank_file': SLOT_VALUE_BANK_FILE,
+            'slot_value_bank_hash': slot_value_bank_hash,
+        }
+        if not dry_run:
+            save_run_manifest(manifest_path, manifest)
+    else:
+        if args.seed is not None and args.seed != manifest['base_seed']:
+            parser.error(f"--seed={args.seed} conflicts with the base seed {manifest['base_seed']} of the existing run; use --erase_previous_data to start a new run.")
+        if manifest['config'].get('output_layout', 'single_file') != config.get('output_layout', 'single_file'):
+            parser.error(f"The existing run was written {'as shards' if manifest['config'].get('output_layout') else 'to a single file'}; "
+                         f"resume it with the same --shard_max_records/--shard_max_bytes/--compression use, or use --erase_previous_data to start a new run.")
+        if manifest['config'] != config:
+            parser.error(f"Configuration differs from the existing run {manifest['config']}; use --erase_previous_data to start a new run.")
+        if manifest['context_file_hash'] != context_file_hash:
+            parser.error(f"{CONTEXTS_FILE} has changed since the existing run; use --erase_previous_data to start a new run.")
+        # Manifests written before the bank was hashed don't record it
+        if 'slot_value_bank_hash' in manifest and manifest['slot_value_bank_hash'] != slot_value_bank_hash:
+            parser.error(f"{SLOT_VALUE_BANK_FILE} has changed since the existing run; use --erase_previous_data to start a new run.")
+    base_seed = manifest['base_seed']
+    if args.engine == 'async' and args.turn_batch_size > 1:
+        parser.error("--turn_batch_size is only supported by the threads engine.")
+    batcher = TurnBatcher(args.turn_batch_size, args.turn_batch_wait) if args.turn_batch_size > 1 else None
+    style_stats = StyleGenerationStats() if args.style_generation == 'single_call' else None
+
+    def _start_data_point():
+        QUEUE_DEPTH.dec(queue='pending')
+        QUEUE_DEPTH.inc(queue='in_flight')
+
+    def _prepare_data_point(index):
+        _start_data_point()
+        rng = random.Random(derive_seed(base_seed, index))
+        context = finalize_context(contexts[index % len(contexts)], rng)
+        return prepare_datapoint(seeded_setup, context, phenomena, if_full_response_options=args.full_options_mode,
+                                 data_id=get_data_id(base_seed, phenomena, index), rng=rng)
+
+    def _generate_data_point(index):
+        _start_data_point()
+        rng = random.Random(derive_seed(base_seed, index))
+        context = finalize_context(contexts[index % len(contexts)], rng)
         buffer = generate_single_datapoint(seeded_setup, context, phenomena,
-                                           if_full_response_options=args.full_options_mode)
+                                           if_full_response_options=args.full_options_mode,
+                                           data_id=get_data_id(base_seed, phenomena, index), rng=rng, batcher=batcher,
+                                           style_stats=style_stats)
+        buffer['seq_id'] = index
         return buffer
 
-    args.output_dir.mkdir(exist_ok=True)
-    output_path = args.output_dir / f'{phenomena}.jsonl'
-    mode = 'w' if args.erase_previous_data else 'a'
+    def _save_profile():
+        if profiler is not None:
+            profiler.stop().save(args.output_dir / f'{phenomena}.profile')
 
-    num_completed = 0
-    with open(output_path, mode) as fp:
-        with multiprocessing.dummy.Pool(args.thread_num) as pool:
-            for d in pool.imap(_generate_data_point, expanded_contexts):
-                try:
-                    fp.write(json.dumps(d, ensure_ascii=False))
-                    fp.write("\n")
-                except Exception as e:
-                    logging.error(e)
-                    logging.error(f"Failed to save data: {d}")
-                fp.flush()
-                num_completed += 1
+    if args.reproduce:
+        for index in args.reproduce:
+            print(dumps_record(_generate_data_point(index)))
+        _save_profile()
+        sys.exit()
+
+    if dry_run:
+        # Both engines send the same requests for a datapoint, the sample runs in threads whatever the engine
+        enable_dry_run()
+        sample = sample_evenly(range(args.number_of_data), args.dry_run)
+        QUEUE_DEPTH.set(len(sample), queue='pending')
+        failed = sum('failure' in d for _, d in imap_unordered_bounded(_generate_data_point, sample, args.thread_num,
+                                                                         2 * args.thread_num))
+        worker_weights = {}  # A batched request keeps the threads of all its dialogs waiting
+        for kind in ['user', 'system']:
+            batches = batcher.stats[f'{kind}_batches'] if batcher is not None else 0
+            if batches:
+                worker_weights[f'batch_{kind}_turn'] = batcher.stats[f'{kind}_batched_turns'] / batches
+        if failed:
+            logging.warning(f"{failed} of the {len(sample)} sampled datapoints failed (their requests are counted).")
+        if batcher is not None:
+            logging.warning(f"Turn batching: {batcher.summary()}")
+        if style_stats is not None:
+            logging.warning(f"Single-call style generation: {style_stats.summary()}")
+        report_dry_run(args, len(sample), args.number_of_data,
+                       args.llm_concurrency if args.engine == 'async' else args.thread_num, worker_weights)
+        _save_profile()
+        sys.exit()
+
+    if args.erase_previous_data:
+        completed_ids = set()
+        mode = 'w'
+    else:
+        completed_ids = load_completed_ids(output_path)
+        mode = 'a'
+    dead_letter_path = get_dead_letter_path(args.output_dir, phenomena)
+    dead_letters = {} if args.erase_previous_data else load_dead_letters(dead_letter_path)
+    if args.erase_previous_data and dead_letter_path.exists():
+        dead_letter_path.unlink()
+    if args.retry_failed:
+        retried = [record for record in dead_letters.values() if record['id'] not in completed_ids
+                   and (record['failure']['transient'] or args.retry_deterministic)]
+        pending_indices = sorted(record['seq_id'] for record in retried)
+        logging.warning(f"Retrying {len(pending_indices)} of the {len(dead_letters)} failed datapoints in {dead_letter_path}.")
+    else:
+        pending_indices = [i for i in range(args.number_of_data) if get_data_id(base_seed, phenomena, i) not in completed_ids]
+        logging.warning(f"Base seed {base_seed}: {args.number_of_data - len(pending_indices)} datapoints already exist, generating {len(pending_indices)}.")
+    if args.engine == 'async':
+        max_in_flight = args.max_in_flight or 4 * args.llm_concurrency
+    else:
+        max_in_flight = args.max_in_flight or 2 * args.thread_num
+
+    if sharded_output:
+        writer = ShardedJsonlWriter(output_path, max_records=args.shard_max_records, max_bytes=args.shard_max_bytes,
+                                    compression=args.compression, erase=args.erase_previous_data)
+        start_offset = None
+    else:
+        writer = open(output_path, mode)
+        start_offset = writer.tell()
+
+    succeeded_ids = set()
+    QUEUE_DEPTH.set(len(pending_indices), queue='pending')
+    track_throughput()
+    exporter = MetricsExporter(args.metrics_file, args.metrics_port, interval=args.metrics_interval).start()
+    if args.llm_trace:
+        start_trace(args.output_dir / f'{phenomena}{TRACE_SUFFIX}', erase=args.erase_previous_data)
+
+    def _write(d):
+        QUEUE_DEPTH.dec(queue='in_flight')
+        DATAPOINTS.inc(outcome='generated')
+        try:
+            writer.write(dumps_record(d) + "\n")
+        except Exception as e:
+            logging.error(e)
+            logging.error(f"Failed to save data: {d}")
+        writer.flush()
+        succeeded_ids.add(d['id'])
+
+    def _write_failure(index, buffer):
+        QUEUE_DEPTH.dec(queue='in_flight')
+        DATAPOINTS.inc(outcome='failed')
+        failure = buffer.pop('failure')
+        previous = dead_letters.get(buffer['id'])
+        record = {
+            'id': buffer['id'],
+            'seq_id': index,
+            'phenomena': phenomena,
+            'base_seed': base_seed,
+            'seed': derive_seed(base_seed, index),
+            'attempts': previous['attempts'] + 1 if previous else 1,
+            'failure': failure,
+            'buffer': encode_buffer(buffer),  # The partially built buffer
+        }
+        try:
+            line = dumps_record(record)
+        except Exception as e:
+            logging.error(f"{buffer['id']} - Failed to save the partial buffer: {repr(e)}")
+            record['buffer'] = None
+            line = dumps_record(record)
+        with open(dead_letter_path, 'a') as fp:
+            fp.write(line + "\n")
+
+    def _on_dialog_result(index, buffer, success):
+        if 'failure' in buffer:
+            _write_failure(index, buffer)
+            return
+        if success:
+            encode_buffer(buffer)
+        buffer['seq_id'] = index
+        _write(buffer)
+
+    with writer:
+        if args.engine == 'async':
+            run_dialog_engine(_prepare_data_point, pending_indices, _on_dialog_result, max_in_flight=max_in_flight,
+                              llm_concurrency=args.llm_concurrency, plot_workers=args.thread_num,
+                              history_strategy=seeded_setup.get('history_strategy', 'full'),
+                              history_turns=seeded_setup.get('history_turns', 4),
+                              style_generation=args.style_generation, style_stats=style_stats)
+        else:
+            for _, d in imap_unordered_bounded(_generate_data_point, pending_indices, args.thread_num, max_in_flight):
+                if 'failure' in d:
+                    _write_failure(d['seq_id'], d)
+                else:
+                    _write(d)
+    exporter.stop()
+    stop_trace()
+    logging.warning(f"LLM requests by stage: {format_stage_summary()}")
+    failed = compact_dead_letters(dead_letter_path, succeeded_ids)
+    if failed:
+        transient = sum(record['failure']['transient'] for record in failed.values())
+        logging.warning(f"{len(failed)} datapoints failed ({transient} transient) and are listed in {dead_letter_path}; "
+                        f"regenerate the transient failures with --retry_failed.")
+    if batcher is not None:
+        logging.warning(f"Turn batching: {batcher.summary()}")
+    if style_stats is not None:
+        logging.warning(f"Single-call style generation: {style_stats.summary()}")
+
+    if args.sort_output:
+        if sharded_output:
+            sort_shards(writer, key=seq_id_key)
+        else:
+            sort_output_by_seq_id(output_path, start_offset)
+    _save_profile()
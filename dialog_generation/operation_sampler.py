@@ -2,54 +2,70 @@
 # For licensing see accompanying LICENSE file.
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
-import logging
+import random
+from typing import List
 
 from .dataclass import Operation
-from .intent_sampler import sample_intent, IncompatibleContext
-from .schema_utils import Schema
+from .intent_sampler import ContextIndex, sample_intent, IncompatibleContext
+from .schema_utils import CompositionalIntent, Schema
 
 
-def get_operation(context: dict, phenomenon: str, service: str = None, intent: str = None) -> Operation:
+def get_feasible_compositional_intents(index: ContextIndex) -> List[CompositionalIntent]:
+    """ The compositional intents whose inner and outer intents are both feasible for the context of `index`. """
+    return [
+        compositional_intent for compositional_intent in Schema.get_compositional_intents()
+        if index.is_feasible(*compositional_intent.inner, output_slot=compositional_intent.inner_slot)
+        and index.is_feasible(*compositional_intent.outer, input_slot=compositional_intent.outer_slot)
+    ]
+
+
+def get_operation(context: dict, phenomenon: str, service: str = None, intent: str = None,
+                  rng: random.Random = random) -> Operation:
     """ Get an Operation (which consists of one or more IntentValues).
     (`service` only works when phenomenon is 'none'.)
+    Intents are sampled among those feasible for the context; raises IncompatibleContext when there are none
+    (e.g. the requested service/intent needs context data that the context lacks).
     """
-    while True:
-        try:
-            if phenomenon == 'compound':  # For phenomenon that requires two intents
-                sampled_intent_1 = sample_intent(context)
-                sampled_intent_2 = sample_intent(context)
-                operation = Operation(
-                    phenomena=phenomenon,
-                    intent_values=[sampled_intent_1, sampled_intent_2]
-                )
-            elif phenomenon == 'compositional':
-                compositional_intent = Schema.sample_compositional_intent()
-                inner_intent = sample_intent(
-                    context,
-                    service=compositional_intent.inner[0].service_name,
-                    intent=compositional_intent.inner[1].name,
-                    output_slot=compositional_intent.inner_slot,
-                )
-                outer_intent = sample_intent(
-                    context,
-                    service=compositional_intent.outer[0].service_name,
-                    intent=compositional_intent.outer[1].name,
-                    input_slot=compositional_intent.outer_slot,
-                )
-                outer_intent.matching_slot = compositional_intent.outer_slot
-                outer_intent.initial_slot = [compositional_intent.outer_slot]
-                inner_intent.matching_slot = compositional_intent.inner_slot
-                operation = Operation(
-                    phenomena=phenomenon,
-                    intent_values=[outer_intent, inner_intent]
-                )
-            else:  # For single intent case
-                sampled_intent = sample_intent(context, service, intent)
-                operation = Operation(
-                    phenomena=phenomenon,
-                    intent_values=[sampled_intent],
-                )
-            return operation
-        except IncompatibleContext as e:
-            logging.warning(f"Retrying due to: {e}")
-            pass
+    index = ContextIndex(context)
+    if phenomenon == 'compound':  # For phenomenon that requires two intents
+        sampled_intent_1 = sample_intent(context, rng=rng, index=index)
+        sampled_intent_2 = sample_intent(context, rng=rng, index=index)
+        operation = Operation(
+            phenomena=phenomenon,
+            intent_values=[sampled_intent_1, sampled_intent_2]
+        )
+    elif phenomenon == 'compositional':
+        compositional_intents = get_feasible_compositional_intents(index)
+        if not compositional_intents:
+            raise IncompatibleContext("no compositional intent is feasible for the context")
+        compositional_intent = rng.choice(compositional_intents)
+        inner_intent = sample_intent(
+            context,
+            service=compositional_intent.inner[0].service_name,
+            intent=compositional_intent.inner[1].name,
+            output_slot=compositional_intent.inner_slot,
+            rng=rng,
+            index=index,
+        )
+        outer_intent = sample_intent(
+            context,
+            service=compositional_intent.outer[0].service_name,
+            intent=compositional_intent.outer[1].name,
+            input_slot=compositional_intent.outer_slot,
+            rng=rng,
+            index=index,
+        )
+        outer_intent.matching_slot = compositional_intent.outer_slot
+        outer_intent.initial_slot = [compositional_intent.outer_slot]
+        inner_intent.matching_slot = compositional_intent.inner_slot
+        operation = Operation(
+            phenomena=phenomenon,
+            intent_values=[outer_intent, inner_intent]
+        )
+    else:  # For single intent case
+        sampled_intent = sample_intent(context, service, intent, rng=rng, index=index)
+        operation = Operation(
+            phenomena=phenomenon,
+            intent_values=[sampled_intent],
+        )
+    return operation
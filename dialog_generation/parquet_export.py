@@ -0,0 +1,160 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Export generated (or quality controlled) dialogs to a Parquet dataset, and read it back.
+
+The dataset is hive-partitioned by `phenomena` and `service` (the `+`-joined sorted services of the dialog), so
+readers can prune partitions and project columns instead of parsing every JSON line. Action trees are stored as
+their realized strings, with the full trees kept as JSON strings in the `*_json` columns.
+Requires `pyarrow` (pip install pyarrow).
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from .dataclass import SystemResponseStyle
+from .dead_letter import FAILED_SUFFIX
+from .serialization import meta_action_from_dict, loads_record
+from utilities.llm_trace import TRACE_SUFFIX
+from utilities.sharded_jsonl import iter_jsonl_lines, is_sharded_directory
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet export requires the `pyarrow` package (pip install pyarrow)")
+    return pyarrow
+
+
+def get_schema():
+    pa = _import_pyarrow()
+    string_list = pa.list_(pa.string())
+    return pa.schema([
+        ('id', pa.string()),
+        ('seq_id', pa.int64()),
+        ('phenomena', pa.string()),
+        ('service', pa.string()),
+        ('services', string_list),
+        ('intents', string_list),
+        ('local_phenomena', string_list),
+        ('situation', pa.string()),
+        ('conversation', string_list),
+        ('response_options', pa.list_(pa.map_(pa.string(), pa.string()))),
+        ('system_optimal_style', pa.list_(pa.struct([('verbosity', pa.string()),
+                                                     ('mirroring', pa.string()),
+                                                     ('additional', string_list)]))),
+        ('dialog_action_user', pa.list_(string_list)),
+        ('dialog_action_system', pa.list_(string_list)),
+        ('dialog_action_user_json', pa.string()),
+        ('dialog_action_system_json', pa.string()),
+        ('user_intro', pa.string()),
+        ('context', pa.string()),
+    ])
+
+
+def record_to_row(record: dict) -> dict:
+    """ Flatten a dialog record into a row of the export schema.
+    The system actions are realized in the optimal style of their turn.
+    """
+    system_actions = []
+    for turn, style in zip(record['dialog_action_system'], record['system_optimal_style']):
+        style_tuple = SystemResponseStyle(**style).get_style_tuple()
+        system_actions.append([meta_action_from_dict(meta_action).realize(style_tuple) for meta_action in turn])
+    return {
+        'id': record.get('id'),
+        'seq_id': record.get('seq_id'),
+        'phenomena': record['phenomena'],
+        'service': '+'.join(sorted(record['services'])),
+        'services': record['services'],
+        'intents': record['intents'],
+        'local_phenomena': record.get('local_phenomena'),
+        'situation': record.get('situation'),
+        'conversation': record['conversation'],
+        'response_options': [list(options.items()) for options in record.get('response_options') or []],
+        'system_optimal_style': record['system_optimal_style'],
+        'dialog_action_user': record.get('dialog_action_user_realized'),
+        'dialog_action_system': system_actions,
+        'dialog_action_user_json': json.dumps(record['dialog_action_user'], ensure_ascii=False),
+        'dialog_action_system_json': json.dumps(record['dialog_action_system'], ensure_ascii=False),
+        'user_intro': record.get('user_intro'),
+        'context': json.dumps(record.get('context'), ensure_ascii=False),
+    }
+
+
+def expand_inputs(paths: List[Path]) -> List[Path]:
+    """ JSONL files (optionally compressed) and sharded directories given directly or found in the given directories
+    (except dead-letter files and LLM traces).
+    """
+    expanded = []
+    for path in map(Path, paths):
+        if path.is_dir() and not is_sharded_directory(path):
+            expanded += sorted(p for p in path.iterdir()
+                               if (p.name.endswith(('.jsonl', '.jsonl.gz', '.jsonl.zst')) and not p.name.endswith((FAILED_SUFFIX, TRACE_SUFFIX)))
+                               or is_sharded_directory(p))
+        else:
+            expanded.append(path)
+    return expanded
+
+
+def iter_record_batches(paths: List[Path], batch_size: int) -> Iterator:
+    pa = _import_pyarrow()
+    schema = get_schema()
+    rows = []
+    for path in paths:
+        skipped = 0
+        for line in iter_jsonl_lines(path):
+            if not line.strip():
+                continue
+            record = loads_record(line)
+            if len(record) <= 2 or 'conversation' not in record:
+                skipped += 1  # Failure stubs and partial buffers of failed dialogs
+                continue
+            rows.append(record_to_row(record))
+            if len(rows) >= batch_size:
+                yield pa.RecordBatch.from_pylist(rows, schema=schema)
+                rows = []
+        if skipped:
+            print(f'Skipped {skipped} failed datapoints in {path}')
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+
+def export_dialogs(paths: List[Path], output_dir: Path, batch_size: int = 10000, overwrite: bool = False) -> None:
+    """ Stream the records of `paths` into a Parquet dataset under `output_dir`, one batch at a time. """
+    pa = _import_pyarrow()
+    schema = get_schema()
+    partitioning = pa.dataset.partitioning(pa.schema([schema.field('phenomena'), schema.field('service')]), flavor='hive')
+    pa.dataset.write_dataset(
+        iter_record_batches(expand_inputs(paths), batch_size), output_dir, schema=schema, format='parquet',
+        partitioning=partitioning, basename_template='part-{i}.parquet',
+        existing_data_behavior='delete_matching' if overwrite else 'error',
+        max_rows_per_group=batch_size,
+    )
+
+
+def read_dialog_dataset(path: Path, columns: Optional[List[str]] = None, filters=None):
+    """ Read an exported dataset as a `pyarrow.Table`.
+    `columns` selects the columns to load, `filters` (a `pyarrow.dataset.Expression` or DNF list such as
+    `[('phenomena', '=', 'compound')]`) is pushed down to skip partitions and row groups.
+    Use `.to_pandas()` on the result for a DataFrame.
+    """
+    pa = _import_pyarrow()
+    return pa.parquet.read_table(path, columns=columns, filters=filters, partitioning='hive')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=Path, nargs='+', help='JSONL files, sharded directories, or directories containing them.', default=[Path('data/dialogs')])
+    parser.add_argument('--output', type=Path, help='Output directory of the Parquet dataset.', default=Path('data/dialogs_parquet'))
+    parser.add_argument('--batch_size', type=int, help='Number of dialogs per record batch and row group.', default=10000)
+    parser.add_argument('--overwrite', action='store_true', help='Replace the partitions that already exist in the output.')
+    args = parser.parse_args()
+
+    export_dialogs(args.input, args.output, batch_size=args.batch_size, overwrite=args.overwrite)
+    table = read_dialog_dataset(args.output, columns=['id'])
+    print(f'Exported dataset {args.output} now has {table.num_rows} dialogs')
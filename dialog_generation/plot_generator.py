@@ -3,11 +3,12 @@
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
 import random
-from typing import List, Union
+from typing import Dict, Iterator, List, Optional, Set, Union
 
 from .dataclass import Operation, IntentPlot, SystemResponseStyle, Action, MetaAction, IntentValues
 from .plot_generator_utils import generic_intent_plot_generator
 from .schema_utils import Schema
+from utilities.llm_synthesis_utils import count_tokens
 
 
 def add_service_prefix_to_actions(service_prefix: str, action_list: List[Union[Action,MetaAction]]) -> None:
@@ -20,14 +21,14 @@ def add_service_prefix_to_actions(service_prefix: str, action_list: List[Union[A
                 act.special_mirroring_action.service_prefix = service_prefix
 
 
-def filter_relevant_context(full_context, operation):
+def filter_relevant_context(full_context, operation, rng: random.Random = random):
     relevant_service = [intent_value['service'] for intent_value in operation['intent_values']]
 
     filtered_context = {} 
     default_context_key = ['today']
     for contexet in default_context_key:
         if isinstance(full_context[contexet], list) and len(full_context[contexet]) >5:
-            filtered_context[contexet] = random.sample(full_context[contexet], k=5)
+            filtered_context[contexet] = rng.sample(full_context[contexet], k=5)
         else:
             filtered_context[contexet] = full_context[contexet]
 
@@ -39,6 +40,69 @@ def filter_relevant_context(full_context, operation):
     return filtered_context, user_intro
 
 
+def iter_nested_actions(action: Action) -> Iterator[Action]:
+    yield action
+    for value in (action.arguments or {}).values():
+        if isinstance(value, Action):
+            yield from iter_nested_actions(value)
+    if isinstance(action.attribute, Action):
+        yield from iter_nested_actions(action.attribute)
+    if action.referral_action:
+        yield from iter_nested_actions(action.referral_action)
+
+
+def get_pinned_context_entities(context, operation: Operation, plot_msg: IntentPlot) -> Dict[str, Set[int]]:
+    """ Indices of the context entities the dialog depends on, per service: the entities the intents operate on,
+    the entities referred to by the actions, and all the entities a complex referral is ranked among
+    (since dropping any of them would change the ranking index).
+    """
+    pinned = {service: set() for service, entities in context.items() if isinstance(entities, list)}
+    for intent_values in operation.intent_values:
+        if intent_values.service in pinned and Schema.get_intent_schema(intent_values.service, intent_values.intent).require_context:
+            pinned[intent_values.service].add(intent_values.context_entity_index)
+
+    actions = [action for turn in plot_msg.user_actions for action in turn]
+    for turn in plot_msg.system_actions:
+        for meta_action in turn:
+            actions += [a for a in [meta_action.default_action, meta_action.special_mirroring_action] if a is not None]
+    for action in (nested for action in actions for nested in iter_nested_actions(action)):
+        service = action.action_name[len('get_'):] if action.action_name.startswith('get_') else None
+        if service not in pinned:
+            continue
+        if action.referral_event_index is not None:
+            pinned[service].add(action.referral_event_index)
+        ranking_slot = (action.arguments or {}).get('ordered_by')
+        if ranking_slot:
+            pinned[service].update(i for i, entity in enumerate(context[service]) if ranking_slot in entity)
+    return pinned
+
+
+def select_context_within_budget(context, operation: Operation, plot_msg: IntentPlot, token_budget: Optional[int],
+                                 rng: random.Random = random):
+    """ Reduce the context rendered into the prompts to about `token_budget` tokens (no limit if None).
+    `today` and the pinned entities (see `get_pinned_context_entities`) are always kept, the remaining budget is
+    filled with other entities in random order. Entities keep their relative order, and services their key order.
+    """
+    if token_budget is None:
+        return context
+    pinned = get_pinned_context_entities(context, operation, plot_msg)
+    used_tokens = sum(count_tokens(str(value)) for value in context.values() if not isinstance(value, list))
+    selected = {}
+    candidates = []
+    for service, indices in pinned.items():
+        selected[service] = set(indices)
+        used_tokens += sum(count_tokens(str(context[service][i])) for i in indices)
+        candidates += [(service, i) for i in range(len(context[service])) if i not in indices]
+    rng.shuffle(candidates)
+    for service, i in candidates:
+        tokens = count_tokens(str(context[service][i]))
+        if used_tokens + tokens <= token_budget:
+            selected[service].add(i)
+            used_tokens += tokens
+    return {key: [entity for i, entity in enumerate(value) if i in selected[key]] if key in selected else value
+            for key, value in context.items()}
+
+
 def time_date_sort_key(data_str):
     """ The time and date in the context has canonical format. For example: '09:00' and 'Thu 2024-10-17'.
     We only need to remove the day to perform sorting.
@@ -46,17 +110,19 @@ def time_date_sort_key(data_str):
     return data_str.split(' ')[-1]
 
 
-def compose_compound_dialog(operation, context) -> IntentPlot:
+def compose_compound_dialog(operation, context, rng: random.Random = random) -> IntentPlot:
     service_1 = operation['intent_values'][0]['service']
     service_2 = operation['intent_values'][1]['service']
     plot_msg_1 = generic_intent_plot_generator(
         operation.intent_values[0],
         context,
-        phenomena=operation['phenomena'])  # fot now, only consider this operation
+        phenomena=operation['phenomena'],
+        rng=rng)  # fot now, only consider this operation
     plot_msg_2 = generic_intent_plot_generator(
         operation.intent_values[1],
         context,
-        phenomena=operation['phenomena'])  # fot now, only consider this operation
+        phenomena=operation['phenomena'],
+        rng=rng)  # fot now, only consider this operation
     # The first turn of two intents should be the main commands.
     user_actions = []
     system_actions = []
@@ -133,14 +199,14 @@ def compose_compound_dialog(operation, context) -> IntentPlot:
     return plot_msg
 
 
-def compose_compositional_dialog(operation, context) -> IntentPlot:
+def compose_compositional_dialog(operation, context, rng: random.Random = random) -> IntentPlot:
     inner_intent_values: IntentValues = operation['intent_values'][1]
     outer_intent_values: IntentValues = operation['intent_values'][0]
     if_summary = inner_intent_values['matching_slot'] == 'summary'
 
     # The slot value for outer intent maching slot has been modified by populate_operation_slot_values
-    plot_outer: IntentPlot = generic_intent_plot_generator(outer_intent_values, context, phenomena=operation['phenomena'])
-    plot_inner: IntentPlot = generic_intent_plot_generator(inner_intent_values, context, phenomena=operation['phenomena'])
+    plot_outer: IntentPlot = generic_intent_plot_generator(outer_intent_values, context, phenomena=operation['phenomena'], rng=rng)
+    plot_inner: IntentPlot = generic_intent_plot_generator(inner_intent_values, context, phenomena=operation['phenomena'], rng=rng)
     
     user_actions, system_actions, system_response_style = [], [], []
     l, r = 0, 0
@@ -220,21 +286,21 @@ def compose_compositional_dialog(operation, context) -> IntentPlot:
 
 
 
-def get_dialog_plot(operation: Operation, context: dict) -> IntentPlot:
+def get_dialog_plot(operation: Operation, context: dict, rng: random.Random = random) -> IntentPlot:
     """ Get the entire dialog plot, which may be a merger of two plots for individual intents.
     """
     if operation['phenomena'] == 'compound':
-        plot_msg = compose_compound_dialog(operation, context)
+        plot_msg = compose_compound_dialog(operation, context, rng)
     elif operation['phenomena'] == 'compositional':
-        plot_msg = compose_compositional_dialog(operation, context)
+        plot_msg = compose_compositional_dialog(operation, context, rng)
     elif operation['phenomena'] == 'none':  
-        plot_msg = generic_intent_plot_generator(operation['intent_values'][0], context, phenomena=operation['phenomena'])
+        plot_msg = generic_intent_plot_generator(operation['intent_values'][0], context, phenomena=operation['phenomena'], rng=rng)
     else: 
         raise ValueError(f"unknown phenomenon: {operation['phenomena']}")
     return plot_msg
 
 
-def get_initial_buffer(setup, context, operation: Operation):
+def get_initial_buffer(setup, context, operation: Operation, rng: random.Random = random):
     """
     The input are sampled context and setup parameters, service, api and phenomena to simulate.
     The service should be one of ['alarm', 'calendar'].
@@ -242,7 +308,7 @@ def get_initial_buffer(setup, context, operation: Operation):
     The phenomena should be one of ['None', ]
     This function returns the initial buffer for the given plot of dialog.
     """
-    relevant_context, usr_intro = filter_relevant_context(context, operation)
+    relevant_context, usr_intro = filter_relevant_context(context, operation, rng)
 
     user_style_instruction_list = {
         'slow': 'Please take the nesting action as a clause and the slot value as an antecedent. Generate a coherent and complex user query.',
@@ -264,7 +330,10 @@ def get_initial_buffer(setup, context, operation: Operation):
         user_style_instruction = user_style_instruction_list['normal']
         system_style_instruction = system_style_instruction_list['high_grounding']
 
-    plot_msg = get_dialog_plot(operation, relevant_context)
+    plot_msg = get_dialog_plot(operation, relevant_context, rng)
+    # The plot is composed on the full context, only what the prompts show is reduced. The record keeps the full
+    # context, which the context indices of the actions and intents refer to.
+    prompt_context = select_context_within_budget(relevant_context, operation, plot_msg, setup.get('context_token_budget'), rng)
 
     services = ', '.join(intent['service'] for intent in operation.intent_values)
 
@@ -276,6 +345,7 @@ def get_initial_buffer(setup, context, operation: Operation):
         'phenomena': operation.phenomena,
         'local_phenomena': plot_msg.local_phenomena,
         'context': relevant_context,
+        'prompt_context': prompt_context,
         'situation': services,
         'services': [intent['service'] for intent in operation.intent_values],
         'intents': [intent['intent'] for intent in operation.intent_values],
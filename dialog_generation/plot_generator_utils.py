@@ -7,7 +7,7 @@ import random
 
 from .dataclass import IntentPlot, SystemResponseStyle, Action, IntentValues, MetaAction
 from .schema_utils import Schema
-from .slot_value_sampler import populate_intent_slot_values
+from .slot_value_sampler import generate_input_slot_values, get_alternative_slot_values, populate_intent_output_values
 
 # There might be a better way to record them, e.g. saved in the schema file
 FULL_RANKABLE_SLOTS = ["date", "start_time", "time", "song_year"]
@@ -25,16 +25,17 @@ def slot_ranking_criteria(item, necessary_slots):
     return 0 if item in necessary_slots else 1
 
 
-def prepare_slots_for_dialog(intent_input_values, intent_schema, context_entity=None, initial_slot=None, phenomena=None):
+def prepare_slots_for_dialog(intent_input_values, intent_schema, context_entity=None, initial_slot=None, phenomena=None,
+                             rng: random.Random = random):
     '''This function return 3 slot-value dictionaries.'''
     if context_entity:  # For context interaction, only sample a referring slot. Don't touch the input slot.
         context_entity_slots = list(context_entity.keys())
         if intent_schema['can_refer_to_input_slot']:
-            referring_slot = random.choice(context_entity_slots)
+            referring_slot = rng.choice(context_entity_slots)
         else:
             for slot in list(intent_input_values.keys()):  # Should be either 0 or 1 slot in input
                 context_entity_slots.remove(slot)
-            referring_slot = random.choice(context_entity_slots)
+            referring_slot = rng.choice(context_entity_slots)
         referring_slot_value = {referring_slot: context_entity[referring_slot]}
         return intent_input_values, None, referring_slot_value
 
@@ -47,14 +48,14 @@ def prepare_slots_for_dialog(intent_input_values, intent_schema, context_entity=
             initial_input_slots += initial_slot
 
         # Sample from the rest of the available slots, based on the minimum_input_slot_number
-        available_slots = list(set(intent_input_values.keys()) - set(initial_input_slots))
+        available_slots = [slot for slot in intent_input_values.keys() if slot not in initial_input_slots]
         minimum_optional_slot_number = max(intent_schema['minimum_input_slot_number'] - len(initial_input_slots), 0)
-        sample_initial_slot_size = random.randint(minimum_optional_slot_number, len(available_slots))
+        sample_initial_slot_size = rng.randint(minimum_optional_slot_number, len(available_slots))
         if phenomena != 'compositional':
-            initial_input_slots += random.sample(available_slots, sample_initial_slot_size)
+            initial_input_slots += rng.sample(available_slots, sample_initial_slot_size)
         initial_input_slot_values = {key: intent_input_values[key] for key in initial_input_slots}
         # The rest of slots (The intent sampler has made sure it fully contain all necessary slots)
-        remaining_necessary_slots = list(set(intent_input_values.keys()) - set(initial_input_slots))
+        remaining_necessary_slots = [slot for slot in intent_input_values.keys() if slot not in initial_input_slots]
         # Re-order the remaining slots such that the assistant always ask the more important slots first
         necessary_slots = intent_schema['required_slots']
         remaining_necessary_slots.sort(key=lambda item: slot_ranking_criteria(item, necessary_slots))
@@ -70,13 +71,13 @@ def check_service_rankable(service):
     return len(rankable_slots)!=0
 
 
-def get_complex_referral_action(intent, context) -> Action:
+def get_complex_referral_action(intent, context, rng: random.Random = random) -> Action:
     service = intent.service
     context_entity_index = intent.context_entity_index
     service_schema = Schema.get_service_schema(service)
     rankable_slots = [slot['name'] for slot in service_schema['slots'] if slot['name'] in FULL_RANKABLE_SLOTS]
     full_slots = [slot['name'] for slot in service_schema['slots']]
-    ranking_slot = random.choice(rankable_slots)
+    ranking_slot = rng.choice(rankable_slots)
     checking_slot = list(intent.input_slot_values.keys())[0] if intent.input_slot_values else None
 
     full_slots.remove(ranking_slot)
@@ -97,25 +98,36 @@ def get_complex_referral_action(intent, context) -> Action:
                 #   item_index=str(ranking_index))
     
 
-def sample_revised_intent(original_intent: IntentValues, context):
-    revised_input_slot = random.choice(list(original_intent.input_slot_values.keys()))
+def sample_revised_intent(original_intent: IntentValues, context, rng: random.Random = random):
+    """ A copy of the intent with another value for one of its input slots (which the user revises to).
+    The new value is drawn from the alternatives available locally (see `get_alternative_slot_values`) and only
+    generated by the LLM when there are none. Only the outputs that depend on the revised slot are regenerated.
+    """
+    revised_input_slot = rng.choice(list(original_intent.input_slot_values.keys()))
     original_input_value = original_intent.input_slot_values[revised_input_slot]
     revised_intent = copy.deepcopy(original_intent)
-    cnt = 0
-    while revised_intent.input_slot_values[revised_input_slot] == original_input_value:
+    alternatives = get_alternative_slot_values(original_intent, revised_input_slot, context, rng)
+    if alternatives:
+        revised_intent.input_slot_values[revised_input_slot] = rng.choice(alternatives)
+    else:
         revised_intent.input_slot_values[revised_input_slot] = None
-        populate_intent_slot_values(revised_intent, context=context)
-        cnt += 1
-        if cnt >1:    # When it cannot find new value from context, try to find one in schema potential_values 
-            service_schema = Schema.get_service_schema(original_intent.service)
-            potential_values = copy.copy(service_schema.get_slot(revised_input_slot).potential_values)
-            if original_input_value in potential_values and len(potential_values)>=2:
-                potential_values.remove(original_input_value)
-                revised_intent.input_slot_values[revised_input_slot] = random.choice(potential_values)
-                populate_intent_slot_values(revised_intent, context=context)
-        if cnt == 3:    # If still same slot value, then just give up, as user can make mistake as well.
-            break
-
+        service_schema = Schema.get_service_schema(original_intent.service)
+        intent_schema = Schema.get_intent_schema(original_intent.service, original_intent.intent)
+        generate_input_slot_values(service_schema, intent_schema, revised_intent, context, rng)
+    revised_value = revised_intent.input_slot_values[revised_input_slot]
+    if revised_value is None or revised_value == original_input_value:
+        # No other value; keep the original, as user can make mistake as well.
+        revised_intent.input_slot_values[revised_input_slot] = original_input_value
+        return revised_input_slot, revised_intent
+
+    intent_schema = Schema.get_intent_schema(original_intent.service, original_intent.intent)
+    if revised_input_slot in intent_schema.result_slots and not intent_schema.return_list:
+        # The output is the input value itself (the summary of a returned list would still mention the old value)
+        for output_slot_values in revised_intent.output_slot_values:
+            if revised_input_slot in output_slot_values:
+                output_slot_values[revised_input_slot] = revised_value
+    elif intent_schema.result_slots:
+        populate_intent_output_values(revised_intent, rng)
     return revised_input_slot, revised_intent
 
 
@@ -126,12 +138,12 @@ def check_if_target_slot_included(target_slot, slots):
         return target_slot == slots
 
 
-def get_referring_action(plot, intent, context, referring_slot_value):
+def get_referring_action(plot, intent, context, referring_slot_value, rng: random.Random = random):
     '''Ideally should be called only once'''
     # <--Local Phenomena-->: Complex referral
-    if check_service_rankable(intent.service) and random.random() > 0.7:   
+    if check_service_rankable(intent.service) and rng.random() > 0.7:   
             plot.local_phenomena.append('complex_referral')   
-            referral_action = get_complex_referral_action(intent, context)
+            referral_action = get_complex_referral_action(intent, context, rng)
     # Normal referral
     else:   
         referral_action = Action(
@@ -160,6 +172,7 @@ def get_self_correction_action(intent, revised_intent, revised_input_slot):
     revised_input_slot_values = {revised_input_slot: revised_intent.input_slot_values[revised_input_slot]}
     correction_action = Action(action_name='self_correction', arguments=copy.deepcopy(revised_input_slot_values))
     intent.output_slot_values = revised_intent.output_slot_values
+    intent.summary_further_slot_values = revised_intent.summary_further_slot_values
     intent.input_slot_values = revised_intent.input_slot_values
     eligible_for_revision = False
     return correction_action, eligible_for_revision
@@ -173,14 +186,14 @@ def insert_summarise_dialog_turn(plot, intent):
     plot.system_response_style.append(SystemResponseStyle(verbosity='verbosity_high', additional=['summarisation']))
 
 
-def insert_summarise_further_dialog_turn(plot, intent, intent_schema):
+def insert_summarise_further_dialog_turn(plot, intent, intent_schema, rng: random.Random = random):
     # select_index = random.randint(0, len(intent.output_slot_values) - 1)
     # request should refer with a emphasis slot
     emphasis_slots = copy.copy(intent_schema['summary_emphasis_slots'])
-    random.shuffle(emphasis_slots)
+    rng.shuffle(emphasis_slots)
 
     dict_items = list(intent.summary_further_slot_values['slot_values'].items())
-    random_key, random_value = random.choice(dict_items)
+    random_key, random_value = rng.choice(dict_items)
     refer_slot_value = {random_key: random_value}
     for slot in emphasis_slots:
         if slot in intent.summary_further_slot_values['slot_values']:
@@ -237,7 +250,7 @@ def insert_notify_dialog_turn(plot, intent, context, referral_action=None):
         SystemResponseStyle(verbosity='verbosity_low' if intent_schema['require_confirmation'] else 'verbosity_high', additional=[]))
 
 
-def generic_intent_plot_generator(intent: IntentValues, context: dict, phenomena=None) -> IntentPlot:
+def generic_intent_plot_generator(intent: IntentValues, context: dict, phenomena=None, rng: random.Random = random) -> IntentPlot:
     """ Generate a dialog plot resolving a single plot. This plot may be later combined with other plots.
     """
     plot = IntentPlot(
@@ -250,9 +263,9 @@ def generic_intent_plot_generator(intent: IntentValues, context: dict, phenomena
     intent_schema = Schema.get_intent_schema(intent.service, intent.intent)
     # <--Local Phenomena-->: Self-revision
     eligible_for_revision, revised_input_slot = False, None
-    if intent_schema.require_input_values and random.random()>0.9:
+    if intent_schema.require_input_values and rng.random()>0.9:
         plot.local_phenomena.append('self-revision')
-        revised_input_slot, revised_intent = sample_revised_intent(intent, context)
+        revised_input_slot, revised_intent = sample_revised_intent(intent, context, rng)
 
     # Check if the intent needs context interaction 
     if intent_schema['require_context']:  
@@ -265,19 +278,20 @@ def generic_intent_plot_generator(intent: IntentValues, context: dict, phenomena
         intent_schema=intent_schema,
         context_entity=sampled_context_entity,
         initial_slot=intent.initial_slot,
-        phenomena=phenomena
+        phenomena=phenomena,
+        rng=rng,
     )
     eligible_for_revision = check_if_target_slot_included(revised_input_slot, initial_input_slot_values)
 
     # Dialog Part 1: Start with the main intent action 
     initial_user_action = Action(action_name=intent.intent, arguments=copy.deepcopy(initial_input_slot_values)) 
     # Self-correction check
-    if eligible_for_revision and random.random()>0.8:  
+    if eligible_for_revision and rng.random()>0.8:  
         correction_action, eligible_for_revision = get_self_correction_action(intent, revised_intent, revised_input_slot)
         initial_user_action.attribute = correction_action
 
     if referring_slot_value:
-        referral_action = get_referring_action(plot, intent, context, referring_slot_value)
+        referral_action = get_referring_action(plot, intent, context, referring_slot_value, rng)
         initial_user_action.referral_action = referral_action
     else: referral_action = None
     plot.user_actions.append([initial_user_action])
@@ -290,7 +304,7 @@ def generic_intent_plot_generator(intent: IntentValues, context: dict, phenomena
             plot.system_response_style.append(SystemResponseStyle(verbosity='verbosity_mid', additional=[]))
             user_act = Action(action_name="inform_value", arguments=copy.copy({slot: value}))
             # Self-correction check
-            if eligible_for_revision and random.random() >0.8: 
+            if eligible_for_revision and rng.random() >0.8: 
                 correction_action, eligible_for_revision = get_self_correction_action(intent, revised_intent, revised_input_slot)
                 user_act.attribute = correction_action             
             plot.user_actions.append([user_act])
@@ -299,8 +313,8 @@ def generic_intent_plot_generator(intent: IntentValues, context: dict, phenomena
     if intent_schema['return_list']:  
         insert_summarise_dialog_turn(plot, intent)
         # Optional turn: requesting more information on a specific result
-        if random.random() > 0.5:
-            insert_summarise_further_dialog_turn(plot, intent, intent_schema)
+        if rng.random() > 0.5:
+            insert_summarise_further_dialog_turn(plot, intent, intent_schema, rng)
         if eligible_for_revision:
             correction_action, eligible_for_revision = get_self_correction_action(intent, revised_intent, revised_input_slot)
             plot.user_actions.append([correction_action])
@@ -55,7 +55,11 @@ class Schema:
                 yield service_schema, intent_schema
 
     @classmethod
-    def sample_compositional_intent(cls) -> CompositionalIntent:
+    def sample_compositional_intent(cls, rng: random.Random = random) -> CompositionalIntent:
+        return rng.choice(cls.get_compositional_intents())
+
+    @classmethod
+    def get_compositional_intents(cls) -> List[CompositionalIntent]:
         if not cls._compositional:
             for inner_serv, inner_intent in cls.iter_intents():
                 if inner_intent.check_on_input:
@@ -79,12 +83,13 @@ class Schema:
                         continue  # outer intent must require an input slot value
                     outer_input_slots = outer_intent.required_slots + outer_intent.optional_slots
                     matching_slots = set(outer_input_slots) & alias_to_slot.keys()
-                    for outer_slot in matching_slots:
-                        for inner_slot in alias_to_slot[outer_slot]:
+                    # Sorted so that the list (and hence seeded sampling from it) doesn't depend on the hash seed
+                    for outer_slot in sorted(matching_slots):
+                        for inner_slot in sorted(alias_to_slot[outer_slot]):
                             cls._compositional.append(CompositionalIntent(
                                 inner=(inner_serv, inner_intent),
                                 outer=(outer_serv, outer_intent),
                                 inner_slot=inner_slot,
                                 outer_slot=outer_slot,
                             ))
-        return random.choice(cls._compositional)
+        return cls._compositional
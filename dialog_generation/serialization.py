@@ -0,0 +1,134 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Hand-written encoder/decoder for the actions and styles of dialog records.
+
+They produce and accept the same JSON shape as `to_dict()` of dataclasses_json and `Action.convert_from_dict`,
+without the reflection. `orjson` is used for the JSON text when installed.
+"""
+import json
+
+from .dataclass import Action, MetaAction, SystemResponseStyle
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _value_to_dict(value):
+    if isinstance(value, Action):
+        return action_to_dict(value)
+    if isinstance(value, dict):
+        return {k: _value_to_dict(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_value_to_dict(v) for v in value]
+    return value
+
+
+def action_to_dict(action: Action) -> dict:
+    attribute = action.attribute
+    return {
+        'action_name': action.action_name,
+        'service_prefix': action.service_prefix,
+        'attribute': action_to_dict(attribute) if isinstance(attribute, Action) else attribute,
+        'referral_action': action_to_dict(action.referral_action) if action.referral_action is not None else None,
+        'referral_event_index': action.referral_event_index,
+        'item_index': action.item_index,
+        'arguments': _value_to_dict(action.arguments) if action.arguments is not None else None,
+        'max_num_arguments': action.max_num_arguments,
+        'no_bracket': action.no_bracket,
+    }
+
+
+def meta_action_to_dict(meta_action: MetaAction) -> dict:
+    return {
+        'default_action': action_to_dict(meta_action.default_action),
+        'special_mirroring_action': action_to_dict(meta_action.special_mirroring_action) if meta_action.special_mirroring_action is not None else None,
+        'generic_action': action_to_dict(meta_action.generic_action) if meta_action.generic_action is not None else None,
+        'special_low_verbosity': meta_action.special_low_verbosity,
+    }
+
+
+def style_to_dict(style: SystemResponseStyle) -> dict:
+    return {
+        'verbosity': style.verbosity,
+        'mirroring': style.mirroring,
+        'additional': list(style.additional) if style.additional is not None else None,
+    }
+
+
+def action_from_dict(data) -> Action:
+    """ Same result as `Action.convert_from_dict`. Non-dict values are returned unchanged.
+    """
+    if not isinstance(data, dict):
+        return data
+    arguments = data.get('arguments')
+    attribute = data.get('attribute')
+    referral_action = data.get('referral_action')
+    return Action(
+        action_name=data.get('action_name'),
+        service_prefix=data.get('service_prefix'),
+        attribute=action_from_dict(attribute) if isinstance(attribute, dict) else attribute,
+        referral_action=action_from_dict(referral_action) if referral_action is not None else None,
+        referral_event_index=data.get('referral_event_index'),
+        item_index=data.get('item_index'),
+        arguments={k: action_from_dict(v) if isinstance(v, dict) else v for k, v in arguments.items()} if arguments else {},
+        max_num_arguments=data.get('max_num_arguments'),
+        no_bracket=data.get('no_bracket', False),
+    )
+
+
+def meta_action_from_dict(data: dict) -> MetaAction:
+    """ Same result as `MetaAction.convert_from_dict`.
+    """
+    return MetaAction(
+        default_action=action_from_dict(data['default_action']),
+        special_mirroring_action=action_from_dict(data['special_mirroring_action']) if 'special_mirroring_action' in data else None,
+        special_low_verbosity=data.get('special_low_verbosity', False),
+    )
+
+
+def encode_buffer(buffer: dict) -> dict:
+    """ Convert the actions, styles and response options of a dialog buffer into their JSON-able form (in place).
+    """
+    if buffer.get('dialog_action_user'):
+        buffer['dialog_action_user'] = [[action_to_dict(action) for action in turn] for turn in buffer['dialog_action_user']]
+    if buffer.get('dialog_action_system'):
+        buffer['dialog_action_system'] = [[meta_action_to_dict(action) for action in turn] for turn in buffer['dialog_action_system']]
+    if buffer.get('system_optimal_style'):
+        buffer['system_optimal_style'] = [style_to_dict(style) for style in buffer['system_optimal_style']]
+    if buffer.get('response_options'):
+        buffer['response_options'] = [{' '.join(k): v for k, v in turn.items()} for turn in buffer['response_options']]
+    return buffer
+
+
+def _default(obj):
+    # Lets partially converted buffers (e.g. of failed dialogs) be dumped as well
+    if isinstance(obj, Action):
+        return action_to_dict(obj)
+    if isinstance(obj, MetaAction):
+        return meta_action_to_dict(obj)
+    if isinstance(obj, SystemResponseStyle):
+        return style_to_dict(obj)
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_record(record: dict) -> str:
+    """ Serialize a record as a single JSON line (without the newline).
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(record, default=_default).decode('utf8')
+        except orjson.JSONEncodeError:
+            pass  # e.g. lone surrogates in LLM output, which the json module tolerates
+    return json.dumps(record, ensure_ascii=False, default=_default)
+
+
+def loads_record(line):
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
@@ -0,0 +1,212 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" An offline bank of realistic slot values, generated in bulk from the schema.
+
+For each intent that returns results from its input values (e.g. `restaurant_booking.find_restaurant`), the bank
+holds deduplicated records with values for all the input and result slots of the intent. At dialog time,
+`slot_value_sampler` fills the input slots from a record and looks up the results of the records matching the input
+values, instead of generating them with the LLM.
+Build (or extend) the bank with `python -m dialog_generation.slot_value_bank`; the build is resumable.
+"""
+import argparse
+import json
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from textwrap import dedent
+from typing import Dict, List, Tuple
+
+from utilities.llm_synthesis_utils import call_openai_chat_completion, environment
+from .dataclass import IntentSchema, ServiceSchema
+from .schema_utils import Schema
+
+SLOT_VALUE_BANK_FILE = 'data/slot_value_bank.jsonl'
+
+BANK_PROMPT_TEMPLATE = dedent("""\
+    Please generate examples with realistic real-world slot values for the given slots.
+
+    Example:
+    Premise: {"service": "restaurant_booking", "operation": "find_restaurant"}
+    Slots: ["location", "cuisine_type", "restaurant_name", "contact_number", "restaurant_address", "menu_price_range"]
+    Response: [{"location": "San Francisco", "cuisine_type": "Japanese", "restaurant_name": "Akiko's Restaurant", "contact_number": "(415) 123-4567", "restaurant_address": "431 Bush St, San Francisco, CA 94108", "menu_price_range": "$$ - $$$"}]
+
+    Now please generate a list of {{ num_examples }} realistic and diverse examples for the following slots, with a value for every slot. Please return in list of JSON format.
+    {{ "Here are some suggested slot values {}.".format(example_slot_values) if example_slot_values }}
+    {{ "Do not repeat these {}: {}.".format(key_slot, covered_values) if covered_values }}
+    Premise: {{ premise }}
+    Slots: {{ slots }}
+    Response list:\
+""")
+bank_prompt_template = environment.from_string(BANK_PROMPT_TEMPLATE)
+
+
+def normalize_value(value) -> str:
+    if isinstance(value, list):
+        return json.dumps(sorted(normalize_value(v) for v in value))
+    return str(value).strip().lower()
+
+
+def get_bank_intents() -> List[Tuple[ServiceSchema, IntentSchema]]:
+    """ The intents whose results are generated from their input values. """
+    return [(service_schema, intent_schema) for service_schema, intent_schema in Schema.iter_intents()
+            if intent_schema.require_input_values and intent_schema.result_slots and not intent_schema.require_context]
+
+
+def _record_key(record: dict) -> str:
+    return json.dumps({slot: normalize_value(value) for slot, value in sorted(record.items())})
+
+
+class SlotValueBank:
+    """ The records of the bank by (service, intent), indexed by the normalized value of each slot (`None` for the
+    records without a value for the slot). Loaded once from SLOT_VALUE_BANK_FILE; an absent file gives an empty bank.
+    """
+    _records: Dict[Tuple[str, str], List[dict]] = {}
+    _index: Dict[Tuple[str, str, str, str], List[int]] = {}
+    _loaded = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str = SLOT_VALUE_BANK_FILE) -> None:
+        records, index, keys = defaultdict(list), defaultdict(list), set()
+        if Path(path).is_file():
+            with open(path, 'r') as fp:
+                for line in fp:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    key = (entry['service'], entry['intent'])
+                    record = entry['record']
+                    if (key, _record_key(record)) in keys:
+                        continue
+                    keys.add((key, _record_key(record)))
+                    for slot, value in record.items():
+                        index[key + (slot, normalize_value(value))].append(len(records[key]))
+                    records[key].append(record)
+        for key, intent_records in records.items():
+            for slot in set().union(*intent_records):
+                index[key + (slot, None)] = [i for i, record in enumerate(intent_records) if slot not in record]
+        cls._records, cls._index, cls._loaded = dict(records), dict(index), True
+
+    @classmethod
+    def get_records(cls, service: str, intent: str) -> List[dict]:
+        if not cls._loaded:
+            with cls._lock:
+                if not cls._loaded:
+                    cls.load()
+        return cls._records.get((service, intent), [])
+
+    @classmethod
+    def find_records(cls, service: str, intent: str, constraints: Dict) -> List[dict]:
+        """ The records of the intent that match all the `constraints` (slot -> value), or have no value for the slot.
+        """
+        records = cls.get_records(service, intent)
+        candidates = None
+        for slot, value in constraints.items():
+            matches = set(cls._index.get((service, intent, slot, normalize_value(value)), []))
+            matches.update(cls._index.get((service, intent, slot, None), range(len(records))))
+            candidates = matches if candidates is None else candidates & matches
+            if not candidates:
+                return []
+        if candidates is None:
+            return records
+        return [records[i] for i in sorted(candidates)]
+
+
+def _request_records(service_schema: ServiceSchema, intent_schema: IntentSchema, num_examples: int,
+                     covered_values: List[str]) -> List[dict]:
+    input_slots = intent_schema.required_slots + intent_schema.optional_slots
+    slots = input_slots + [slot for slot in intent_schema.result_slots if slot not in input_slots]
+    example_slot_values = {slot.name: slot.potential_values for slot in service_schema.slots
+                           if slot.potential_values and slot.name in slots}
+    prompt = bank_prompt_template.render(
+        num_examples=num_examples,
+        example_slot_values=json.dumps(example_slot_values) if example_slot_values else None,
+        key_slot=intent_schema.result_slots[0],
+        covered_values=json.dumps(covered_values) if covered_values else None,
+        premise=json.dumps({'service': service_schema.service_name, 'operation': intent_schema.name}),
+        slots=json.dumps(slots),
+    )
+    messages = [
+        {'role': 'system',
+         'content': "You are a helpful assistant. Please follow the user's instructions and examples' format."},
+        {'role': 'user', 'content': prompt},
+    ]
+    llm_output, _ = call_openai_chat_completion(messages, max_tokens=100 * num_examples, temperature=0.9, top_p=0.9,
+                                                stage='slot_value_bank')
+    try:
+        records = json.loads(llm_output.replace('```json', '').replace('```', ''))
+    except ValueError:
+        logging.warning(f"LLM generated malformed JSON: {llm_output}")
+        return []
+    if not isinstance(records, list):
+        return []
+    # Every required input slot and result slot must have a value; unknown slots are dropped
+    needed = intent_schema.required_slots + intent_schema.result_slots
+    return [{slot: value for slot, value in record.items() if slot in slots and value not in (None, '', [])}
+            for record in records
+            if isinstance(record, dict) and all(record.get(slot) not in (None, '', []) for slot in needed)]
+
+
+def build_slot_value_bank(path: str = SLOT_VALUE_BANK_FILE, records_per_intent: int = 200, batch_size: int = 10,
+                          thread_num: int = 5, max_requests_per_intent: int = None) -> Dict[str, int]:
+    """ Generate records until every bank intent has `records_per_intent` distinct records in the bank file.
+    New records are appended as they arrive, so an interrupted build resumes where it stopped.
+    Returns the number of records per intent.
+    """
+    SlotValueBank.load(path)
+    max_requests_per_intent = max_requests_per_intent or 3 * -(-records_per_intent // batch_size)
+    lock = threading.Lock()
+    counts = {}
+
+    with open(path, 'a') as fp:
+        def _build_intent(service_schema: ServiceSchema, intent_schema: IntentSchema):
+            service, intent = service_schema.service_name, intent_schema.name
+            records = SlotValueBank.get_records(service, intent)
+            keys = {_record_key(record) for record in records}
+            covered = [str(record[intent_schema.result_slots[0]]) for record in records]
+            requests = 0
+            while len(keys) < records_per_intent and requests < max_requests_per_intent:
+                requests += 1
+                num_examples = min(batch_size, records_per_intent - len(keys))
+                try:
+                    new_records = _request_records(service_schema, intent_schema, num_examples, covered[-50:])
+                except Exception as e:
+                    logging.warning(f"{service}.{intent} - Request failed: {repr(e)}")
+                    continue
+                lines = []
+                for record in new_records:
+                    key = _record_key(record)
+                    if key in keys:
+                        continue
+                    keys.add(key)
+                    covered.append(str(record[intent_schema.result_slots[0]]))
+                    lines.append(json.dumps({'service': service, 'intent': intent, 'record': record}, ensure_ascii=False) + '\n')
+                with lock:
+                    fp.writelines(lines)
+                    fp.flush()
+            if len(keys) < records_per_intent:
+                logging.warning(f"{service}.{intent} - Only {len(keys)} distinct records after {requests} requests")
+            counts[f'{service}.{intent}'] = len(keys)
+
+        with ThreadPoolExecutor(thread_num) as executor:
+            list(executor.map(lambda pair: _build_intent(*pair), get_bank_intents()))
+    SlotValueBank.load(path)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str, help='The bank file (extended if it exists).', default=SLOT_VALUE_BANK_FILE)
+    parser.add_argument('--records_per_intent', type=int, help='Number of distinct records to reach per intent.', default=200)
+    parser.add_argument('--batch_size', type=int, help='Number of records requested per LLM call.', default=10)
+    parser.add_argument('--thread_num', type=int, help='Number of threads to use.', default=5)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING)
+
+    counts = build_slot_value_bank(args.output, args.records_per_intent, args.batch_size, args.thread_num)
+    for name, count in counts.items():
+        print(f'{name}: {count} records')
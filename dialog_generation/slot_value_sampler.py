@@ -10,13 +10,18 @@ from datetime import datetime, timedelta
 from textwrap import dedent
 from typing import Dict
 
+from babel.dates import format_timedelta
+
 from utilities.llm_synthesis_utils import call_openai_chat_completion, environment
+from utilities.llm_trace import trace_context
+from utilities.metrics import LLM_RETRIES
 from .context_loader import DATE_FORMAT, sample_time
 from .dataclass import Operation, IntentValues, ServiceSchema, IntentSchema
 from .schema_utils import Schema
+from .slot_value_bank import SlotValueBank, normalize_value
 
 
-def _request_openai_response(prompt: str):
+def _request_openai_response(prompt: str, stage: str):
     messages = [
         {'role': 'system',
          'content': "You are a helpful assistant. Please follow the user's instructions and examples' format."},
@@ -30,13 +35,15 @@ def _request_openai_response(prompt: str):
             top_p=0.8,
             frequency_penalty=0,
             # 1 encourages diverse response, 0 allows repeating frequently.
-            presence_penalty=0
+            presence_penalty=0,
             # 1 encourages using more provided keywords, 0 allows less constrained by the given context.
+            stage=stage,
         )
         try:
             return json.loads(llm_output.replace('```json', '').replace('```', ''))
         except json.decoder.JSONDecodeError:
             logging.warning(f"LLM generated malformed JSON: {llm_output}")
+            LLM_RETRIES.inc(stage=stage, cause='malformed_json')
             time.sleep(1)
 
 
@@ -54,46 +61,135 @@ def _prepare_prompt_params(service_schema: ServiceSchema, intent_schema: IntentS
     return result
 
 
-def _sample_input_slot_values(intent_schema: IntentSchema, intent: IntentValues, context: Dict) -> None:
-    # Steal slot values from a 'donor entity' in the same app's context (as input values for e.g. creating new events)
+def fill_from_donor_entity(service_schema: ServiceSchema, intent_schema: IntentSchema, intent: IntentValues, context: Dict,
+                           rng: random.Random = random) -> None:
+    """ Steal slot values from a 'donor entity' in the same app's context (as input values for e.g. creating new events). """
     donor_entities = context.get(intent.service if intent.service != 'messages' else 'messages_sent', [])
     if len(donor_entities) > 1:
         if intent_schema.require_context:
             donor_entities = donor_entities[:intent.context_entity_index] + donor_entities[intent.context_entity_index + 1:]
-        donor_entity = random.choice(donor_entities)
+        donor_entity = rng.choice(donor_entities)
     else:
-        donor_entity = None
-
-    # Fill in slot values
+        return
     for k, v in intent.input_slot_values.items():
-        if v is not None:
-            continue
-        if donor_entity and k in donor_entity:
+        if v is None and k in donor_entity:
             intent.input_slot_values[k] = donor_entity[k]
-        elif k in ['contacts', 'attendees']:
-            if k == 'contacts':
-                num = 1
-            else:
-                num = random.randint(1, 3)
-            contacts = random.sample(context['contacts'], k=num)
-            intent.input_slot_values[k] = [x['full_name'] for x in contacts]
-        elif k in ['date', 'start_date']:
-            today = datetime.strptime(context['today'], DATE_FORMAT)
-            date = today + timedelta(days=random.randint(1, 14))
-            intent.input_slot_values[k] = date.strftime(DATE_FORMAT)
-        elif k in ['time', 'start_time']:
-            granularity = random.choice([1, 5, 10, 15, 30])
-            if intent.service == 'restaurant_booking':
-                hours = random.choice([(10, 23), (11, 14), (17, 21)])
-            else:
-                hours = random.choice([(0, 24), (8, 23), (9, 21), (9, 18)])
-            intent.input_slot_values[k] = sample_time(granularity, hours)
-
-
-def generate_input_slot_values(service_schema: ServiceSchema, intent_schema: IntentSchema, intent: IntentValues, context: Dict) -> None:
+
+
+def _sample_contacts(intent: IntentValues, context: Dict, rng: random.Random):
+    if not context.get('contacts'):
+        return None
+    num = min(rng.randint(1, 3), len(context['contacts']))
+    return [x['full_name'] for x in rng.sample(context['contacts'], k=num)]
+
+
+def _sample_contact(intent: IntentValues, context: Dict, rng: random.Random):
+    if not context.get('contacts'):
+        return None
+    return [rng.choice(context['contacts'])['full_name']]
+
+
+def _sample_date(intent: IntentValues, context: Dict, rng: random.Random):
+    if 'today' not in context:
+        return None
+    today = datetime.strptime(context['today'], DATE_FORMAT)
+    date = today + timedelta(days=rng.randint(1, 14))
+    return date.strftime(DATE_FORMAT)
+
+
+def _sample_time(intent: IntentValues, context: Dict, rng: random.Random):
+    granularity = rng.choice([1, 5, 10, 15, 30])
+    if intent.service == 'restaurant_booking':
+        hours = rng.choice([(10, 23), (11, 14), (17, 21)])
+    elif intent.service == 'movie_booking':
+        hours = (11, 23)
+        granularity = max(granularity, 5)
+    else:
+        hours = rng.choice([(0, 24), (8, 23), (9, 21), (9, 18)])
+    return sample_time(granularity, hours, rng)
+
+
+def _sample_duration(intent: IntentValues, context: Dict, rng: random.Random):
+    minutes = rng.choice([15, 30, 45, 60, 90, 120, 180])
+    return format_timedelta(timedelta(minutes=minutes), locale='en_US')
+
+
+def _money_generator(low: int, high: int, step: int):
+    def generator(intent: IntentValues, context: Dict, rng: random.Random):
+        return f"${rng.randrange(low, high + 1, step)}"
+    return generator
+
+
+def _count_generator(low: int, high: int):
+    def generator(intent: IntentValues, context: Dict, rng: random.Random):
+        return str(rng.randint(low, high))
+    return generator
+
+
+# Typed generators of input slot values, by slot name: `generator(intent, context, rng)` returns a value, or None
+# if it cannot produce one for this context.
+SLOT_VALUE_GENERATORS = {
+    'contacts': _sample_contact,
+    'attendees': _sample_contacts,
+    'date': _sample_date,
+    'start_date': _sample_date,
+    'time': _sample_time,
+    'start_time': _sample_time,
+    'showtime': _sample_time,
+    'duration_time': _sample_duration,
+    'funds_amount': _money_generator(10, 2000, 10),
+    'ticket_price': _money_generator(8, 25, 1),
+    'rate_per_night': _money_generator(80, 400, 10),
+    'ticket_quantity': _count_generator(1, 6),
+    'amount_of_days': _count_generator(1, 7),
+}
+
+
+def fill_from_generators(service_schema: ServiceSchema, intent_schema: IntentSchema, intent: IntentValues, context: Dict,
+                         rng: random.Random = random) -> None:
+    for k, v in intent.input_slot_values.items():
+        if v is None and k in SLOT_VALUE_GENERATORS:
+            intent.input_slot_values[k] = SLOT_VALUE_GENERATORS[k](intent, context, rng)
+
+
+def fill_from_potential_values(service_schema: ServiceSchema, intent_schema: IntentSchema, intent: IntentValues, context: Dict,
+                               rng: random.Random = random) -> None:
+    potential_values = {slot.name: slot.potential_values for slot in service_schema.slots if slot.potential_values}
+    for k, v in intent.input_slot_values.items():
+        if v is None and k in potential_values:
+            intent.input_slot_values[k] = rng.choice(potential_values[k])
+
+
+def get_bank_constraints(intent: IntentValues) -> Dict:
+    """ The input values that select the slot value bank records of an intent (typed values such as dates are
+    independent of the records).
+    """
+    return {k: v for k, v in intent.input_slot_values.items() if v is not None and k not in SLOT_VALUE_GENERATORS}
+
+
+def fill_from_value_bank(service_schema: ServiceSchema, intent_schema: IntentSchema, intent: IntentValues, context: Dict,
+                         rng: random.Random = random) -> None:
+    """ Take the input values from a record of the slot value bank that matches the values already filled. """
+    records = SlotValueBank.find_records(intent.service, intent.intent, get_bank_constraints(intent))
+    if not records:
+        return
+    record = rng.choice(records)
+    for k, v in intent.input_slot_values.items():
+        if v is None and k in record:
+            intent.input_slot_values[k] = record[k]
+
+
+# Fill input slots locally, in this order, before the remaining ones are generated by the LLM.
+# A filler sets what it can of the `None` values in `intent.input_slot_values`.
+LOCAL_SLOT_FILLERS = [fill_from_donor_entity, fill_from_generators, fill_from_value_bank, fill_from_potential_values]
+
+
+def generate_input_slot_values(service_schema: ServiceSchema, intent_schema: IntentSchema, intent: IntentValues, context: Dict,
+                               rng: random.Random = random) -> None:
     """ Populate values for input slots that are currently `None`.
     """
-    # _sample_input_slot_values(intent_schema, intent, context)
+    for filler in LOCAL_SLOT_FILLERS:
+        filler(service_schema, intent_schema, intent, context, rng)
     unfilled_slots = [k for k, v in intent.input_slot_values.items() if v is None]
     if not unfilled_slots:
         return
@@ -118,8 +214,11 @@ def generate_input_slot_values(service_schema: ServiceSchema, intent_schema: Int
     prompt_params = _prepare_prompt_params(service_schema, intent_schema, intent.input_slot_values)
     prompt_params['input_slots'] = json.dumps(unfilled_slots)
     input_value_sample_prompt = input_value_sample_template.render(prompt_params)
-    response_object = _request_openai_response(input_value_sample_prompt)
-    input_slot_values = random.choice(response_object)
+    with trace_context(intents=[f'{intent.service}.{intent.intent}']):
+        response_object = _request_openai_response(input_value_sample_prompt, 'slot_input')
+    intent.generated_input_examples = (intent.generated_input_examples or []) + \
+        [example for example in response_object if isinstance(example, dict)]
+    input_slot_values = rng.choice(response_object)
     try:
         intent.input_slot_values.update(input_slot_values)
     except ValueError as e:
@@ -127,8 +226,10 @@ def generate_input_slot_values(service_schema: ServiceSchema, intent_schema: Int
         print(input_slot_values)
         assert False
 
-def generate_output_slot_values(service_schema: ServiceSchema, intent_schema: IntentSchema, intent: IntentValues) -> None:
+def generate_output_slot_values(service_schema: ServiceSchema, intent_schema: IntentSchema, intent: IntentValues,
+                                rng: random.Random = random) -> None:
     """ Overwrite the entire output slot values.
+    The values are taken from the slot value bank records matching the input values when there are any.
     """
     output_value_sample_template = dedent("""\
         Please generate examples with random real-world slot values for the given slots list. The slot values should follow the specifications in the premise.
@@ -147,13 +248,20 @@ def generate_output_slot_values(service_schema: ServiceSchema, intent_schema: In
     output_value_sample_template = environment.from_string(output_value_sample_template)
     # Separate the result slots that are covered by the input slots -> We would like them fiexed for all examples in the returned list.
     # 22/08/2023 This might not be needed anymore, as the latest result_slots schema exclude all input_slots.
-    non_overlapping_output_slots = list(set(intent_schema['result_slots']) - intent.input_slot_values.keys())
-    overlapping_output_slots = list(set(intent_schema['result_slots']).intersection(intent.input_slot_values.keys()))
+    # In schema order, so that the prompt (and what is sampled from the result) doesn't depend on the hash seed
+    non_overlapping_output_slots = [slot for slot in intent_schema['result_slots'] if slot not in intent.input_slot_values]
+    overlapping_output_slots = [slot for slot in intent_schema['result_slots'] if slot in intent.input_slot_values]
 
-    prompt_params = _prepare_prompt_params(service_schema, intent_schema, intent.input_slot_values)
-    prompt_params['output_slots'] = json.dumps(non_overlapping_output_slots)
-    output_value_sample_prompt = output_value_sample_template.render(prompt_params)
-    output_slot_values = _request_openai_response(output_value_sample_prompt)
+    records = SlotValueBank.find_records(intent.service, intent.intent, get_bank_constraints(intent))
+    records = [record for record in records if all(slot in record for slot in non_overlapping_output_slots)]
+    if records:
+        records = rng.sample(records, k=min(5, len(records)))
+        output_slot_values = [{slot: record[slot] for slot in non_overlapping_output_slots} for record in records]
+    else:
+        prompt_params = _prepare_prompt_params(service_schema, intent_schema, intent.input_slot_values)
+        prompt_params['output_slots'] = json.dumps(non_overlapping_output_slots)
+        output_value_sample_prompt = output_value_sample_template.render(prompt_params)
+        output_slot_values = _request_openai_response(output_value_sample_prompt, 'slot_output')
     for output_slot_values_option in output_slot_values:
         output_slot_values_option.update({slot: intent.input_slot_values[slot] for slot in overlapping_output_slots})
     intent.output_slot_values = output_slot_values
@@ -170,31 +278,63 @@ def get_output_summary(data, emphasis_slots):
     prompt_params = {'data': data, 'emphasis_slots': emphasis_slots}
     summarisation_prompt = summarisation_prompt.render(prompt_params)
     while True:
-        summary_values = _request_openai_response(summarisation_prompt)
+        summary_values = _request_openai_response(summarisation_prompt, 'summary')
         if 'summary' in summary_values:
             break
     return summary_values
 
 
-def populate_intent_slot_values(intent: IntentValues, context: Dict) -> None:
+def populate_intent_slot_values(intent: IntentValues, context: Dict, rng: random.Random = random) -> None:
     service_schema = Schema.get_service_schema(intent.service)
     intent_schema = Schema.get_intent_schema(intent.service, intent.intent)
     if intent_schema.require_input_values:
-        generate_input_slot_values(service_schema, intent_schema, intent, context)
+        generate_input_slot_values(service_schema, intent_schema, intent, context, rng)
+        populate_intent_output_values(intent, rng)
+
+
+def populate_intent_output_values(intent: IntentValues, rng: random.Random = random) -> None:
+    """ (Re)generate the output values of an intent from its input values. """
+    service_schema = Schema.get_service_schema(intent.service)
+    intent_schema = Schema.get_intent_schema(intent.service, intent.intent)
+    with trace_context(intents=[f'{intent.service}.{intent.intent}']):
         if intent_schema.result_slots:
             assert not intent_schema.check_on_input # 'check' intent shouldn't require input values. It shouldn't be here.
-            generate_output_slot_values(service_schema, intent_schema, intent)
+            generate_output_slot_values(service_schema, intent_schema, intent, rng)
         if intent_schema.return_list:   # For intents that performs research and returns a list of search results
-            selection_idx = random.randint(0, len(intent.output_slot_values)-1)
+            selection_idx = rng.randint(0, len(intent.output_slot_values)-1)
             intent.summary_further_slot_values = {'selection_idx': selection_idx,
                                                   'slot_values': intent.output_slot_values[selection_idx]}
             intent.output_slot_values = [get_output_summary(intent.output_slot_values, intent_schema['summary_emphasis_slots'])]
         else:
-            intent.output_slot_values = [random.choice(intent.output_slot_values)]
+            intent.output_slot_values = [rng.choice(intent.output_slot_values)]
+
+
+def get_alternative_slot_values(intent: IntentValues, slot: str, context: Dict, rng: random.Random = random) -> list:
+    """ Values other than the current one that the input `slot` of the intent could take, found without the LLM:
+    schema potential values, values of the app's context entities, typed generators, slot value bank records
+    matching the other input values, and the examples the LLM generated along with the intent's own input values.
+    """
+    service_schema = Schema.get_service_schema(intent.service)
+    candidates = [value for s in service_schema.slots if s.name == slot for value in s.potential_values]
+    entities = context.get(intent.service if intent.service != 'messages' else 'messages_sent', [])
+    candidates += [entity[slot] for entity in entities if slot in entity]
+    if slot in SLOT_VALUE_GENERATORS:
+        candidates += [SLOT_VALUE_GENERATORS[slot](intent, context, rng) for _ in range(5)]
+    constraints = {k: v for k, v in get_bank_constraints(intent).items() if k != slot}
+    candidates += [record[slot] for record in SlotValueBank.find_records(intent.service, intent.intent, constraints) if slot in record]
+    candidates += [example[slot] for example in intent.generated_input_examples or [] if example.get(slot) is not None]
+
+    excluded = {normalize_value(intent.input_slot_values[slot])}
+    alternatives = []
+    for value in candidates:
+        if value is not None and normalize_value(value) not in excluded:
+            excluded.add(normalize_value(value))
+            alternatives.append(value)
+    return alternatives
 
 
-def populate_operation_slot_values(operation: Operation, context: Dict) -> None:
-    populate_intent_slot_values(operation.intent_values[-1], context)
+def populate_operation_slot_values(operation: Operation, context: Dict, rng: random.Random = random) -> None:
+    populate_intent_slot_values(operation.intent_values[-1], context, rng)
 
     if operation.phenomena == 'compositional':
         outer_intent, inner_intent = operation.intent_values
@@ -211,4 +351,4 @@ def populate_operation_slot_values(operation: Operation, context: Dict) -> None:
             pass
 
     for iv in operation.intent_values[:-1]:
-        populate_intent_slot_values(iv, context)
+        populate_intent_slot_values(iv, context, rng)
@@ -0,0 +1,181 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Generate the next turns of several in-flight dialogs with a single LLM request.
+
+Dialog threads hand their next user or system turn to a shared `TurnBatcher`, which packs the pending turns of the
+same kind into one prompt with a keyed JSON object per dialog, and splits the keyed JSON result. Turns whose entry is
+missing or malformed are generated individually with the regular prompt.
+"""
+import json
+import logging
+import threading
+from collections import Counter
+from textwrap import dedent
+
+from utilities.llm_synthesis_utils import call_openai_chat_completion, environment
+from utilities.llm_trace import trace_context
+from utilities.metrics import QUEUE_DEPTH
+from . import dialog_generator
+from .dialog_generator import TurnRequest, build_messages
+
+
+BATCH_USER_PROMPT_TEMPLATE = dedent("""\
+    You are simulating several smartphone users. Each of them is testing the virtual assistant on their phone in a separate multi-turn conversation.
+
+    Instructions:
+    1. Each user communicates with the assistant following the guidance of the "actions" of their dialog.
+    2. Based on the "introduction" of the user, think about what speech habit they should have and communicate with this pattern.
+    3. The "utterance" should be brief.
+    4. The dialogs are independent: only use the "introduction", "apps", "context" and "conversation" of the same dialog.
+    5. You must return one JSON object with the keys of the dialogs, each mapped to the next user message in JSON format, following the provided examples.
+
+    Example user messages:
+    {"actions": ["get_reminders(time="09:00").reminders_modify(name=get_calendar_events(ordered_by="date", index=2).calendar_events_check(name).name)"], "utterance": "Please update the name of my 9am reminder to match the title of the 2nd earlist event on my calendar."}
+    {"actions": ["reminders_create(date=get_reminders(time="09:00").reminders_check(date).date)"], "utterance": "I'd like to create a new reminder same date with my 9 am reminder."}
+
+    Every conversation begins with:
+    user: {"actions": ["hello()"], "utterance": "Hi."}
+    assistant: {"actions": ["offer_help()"], "utterance": "Hello, how can I help?"}
+
+    Dialogs:
+    {{ dialogs }}
+
+    Return {{ return_format }}
+    """)
+
+BATCH_SYSTEM_PROMPT_TEMPLATE = dedent("""\
+    You are a virtual assistant in several separate conversations. Your goal is to assist each user based on their requests and provide helpful responses.
+
+    Instructions:
+    1. Maintain a friendly and professional personality throughout the conversations.
+    2. Your responses should be simple, natural, and concise, using minimum words necessary.
+    3. Follow the context information and adhere to the "actions" of each dialog, and follow its "instruction".
+    4. The dialogs are independent: only use the "apps", "context" and "conversation" of the same dialog.
+    5. You must return one JSON object with the keys of the dialogs, each mapped to the next assistant message in JSON format, following the provided examples.
+
+    Every conversation begins with:
+    user: {"actions": ["hello()"], "utterance": "Hi."}
+    assistant: {"actions": ["offer_help()"], "utterance": "Hello, how can I help?"}
+
+    Dialogs:
+    {{ dialogs }}
+
+    Return {{ return_format }}
+    """)
+
+batch_prompt_templates = {
+    'user': environment.from_string(BATCH_USER_PROMPT_TEMPLATE),
+    'system': environment.from_string(BATCH_SYSTEM_PROMPT_TEMPLATE),
+}
+generation_params = {
+    'user': dialog_generator.USER_GENERATION_PARAMS,
+    'system': dialog_generator.SYSTEM_GENERATION_PARAMS,
+}
+
+
+class _TurnJob:
+    def __init__(self, fields: dict, prompt: str):
+        self.fields = fields
+        self.prompt = prompt
+        self.response = None
+        self.done = threading.Event()
+
+
+def parse_batch_response(llm_output: str, keys) -> dict:
+    """ The valid entries of a batch response: a JSON message with an "utterance" per key, re-serialized like the
+    output of a single-turn request.
+    """
+    try:
+        results = json.loads(llm_output)
+    except ValueError:
+        return {}
+    if not isinstance(results, dict):
+        return {}
+    responses = {}
+    for key in keys:
+        entry = results.get(key)
+        if isinstance(entry, dict) and isinstance(entry.get('utterance'), str):
+            responses[key] = json.dumps(entry, ensure_ascii=False)
+    return responses
+
+
+class TurnBatcher:
+    """ Collects the pending turns of the dialog threads and generates up to `max_batch_size` turns of the same kind
+    per request. A batch is sent once it is full, or after `max_wait` seconds by the thread that has waited longest,
+    so the batch size adapts to the number of dialogs in flight.
+    """
+
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.5):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.pending = {kind: [] for kind in batch_prompt_templates}
+        self.stats = Counter()
+
+    def request(self, turn: TurnRequest) -> str:
+        """ The response to a turn request, generated in a batch when possible (blocks until it is available). """
+        kind = turn.kind
+        if kind not in batch_prompt_templates:
+            return dialog_generator.get_turn_response(turn)  # e.g. single-call style variants are not batched
+        job = _TurnJob(turn.fields, turn.prompt)
+        batch = None
+        with self.lock:
+            pending = self.pending[kind]
+            pending.append(job)
+            QUEUE_DEPTH.inc(queue='turn_batch')
+            if len(pending) >= self.max_batch_size:
+                batch, self.pending[kind] = pending, []
+        if batch is None and not job.done.wait(self.max_wait):
+            with self.lock:
+                pending = self.pending[kind]
+                if any(pending_job is job for pending_job in pending):  # Not taken by another thread yet
+                    batch, self.pending[kind] = pending, []
+        if batch is not None:
+            self._send(kind, batch)
+        job.done.wait()
+
+        if job.response is None:
+            # Missing from the batch response: generate the turn on its own (in this dialog's thread)
+            with self.lock:
+                self.stats[f'{kind}_fallback_turns'] += 1
+            return dialog_generator.get_turn_response(turn)
+        return job.response
+
+    def _send(self, kind: str, batch: list) -> None:
+        QUEUE_DEPTH.dec(len(batch), queue='turn_batch')
+        if len(batch) == 1:
+            batch[0].done.set()  # Falls back to the regular prompt
+            return
+        keys = [f'dialog_{i}' for i in range(len(batch))]
+        prompt = batch_prompt_templates[kind].render(
+            dialogs=json.dumps({key: job.fields for key, job in zip(keys, batch)}, ensure_ascii=False, indent=1, default=str),
+            return_format='{' + ', '.join(f'"{key}": <{kind} message>' for key in keys) + '}',
+        )
+        messages = build_messages(prompt)
+        params = dict(generation_params[kind])
+        params['max_tokens'] = params['max_tokens'] * len(batch)
+        try:
+            # The request serves several dialogs: not attributed to the one of the sending thread
+            with trace_context(data_id=None, intents=None, turn=None, batch_size=len(batch)):
+                llm_output, _ = call_openai_chat_completion(messages, **params, stage=f'batch_{kind}_turn')
+            responses = parse_batch_response(llm_output, keys)
+        except Exception as e:
+            logging.warning(f"Batch of {len(batch)} {kind} turns failed: {repr(e)}")
+            responses = {}
+        with self.lock:
+            self.stats[f'{kind}_batches'] += 1
+            self.stats[f'{kind}_batched_turns'] += len(responses)
+        for key, job in zip(keys, batch):
+            job.response = responses.get(key)
+            job.done.set()
+
+    def summary(self) -> str:
+        parts = []
+        for kind in batch_prompt_templates:
+            batched = self.stats[f'{kind}_batched_turns']
+            batches = self.stats[f'{kind}_batches']
+            parts.append(f"{kind}: {batched} turns in {batches} batch requests, "
+                         f"{self.stats[f'{kind}_fallback_turns']} turns generated individually")
+        return '; '.join(parts)
@@ -3,34 +3,59 @@
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
 import argparse
-import json
+import itertools
+import multiprocessing
 import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from textwrap import dedent
 from pathlib import Path
 
-from dialog_generation.dataclass import MetaAction, Action
+from dialog_generation.dataclass import Action
+from dialog_generation.serialization import action_from_dict, meta_action_from_dict, dumps_record, loads_record
 from utilities.async_openai_api import OpenAIRequestManager
+from utilities.dry_run import add_dry_run_arguments, enable_dry_run, report_dry_run
 from utilities.llm_synthesis_utils import environment
+from utilities.llm_trace import TRACE_SUFFIX, start_trace, stop_trace
+from utilities.metrics import MetricsExporter, format_stage_summary
+from utilities.profiling import add_profile_argument, start_profiler
+from utilities.sharded_jsonl import iter_jsonl_lines, resolve_jsonl_path
 
 
-def load_jsonl(file_path):
-    data = []
-    with open(file_path, 'r') as file:
-        for line in file:
-            if line!='\n':
-                try:
-                    data.append(json.loads(line))
-                except:
-                    print('Error in loading line:')
-                    print(line)
-    print('Loading raw data length: {} from {}'.format(len(data), file_path))
-    return data
+def parse_jsonl_lines(lines):
+    for line in lines:
+        if line!='\n':
+            try:
+                yield loads_record(line)
+            except:
+                print('Error in loading line:')
+                print(line)
+
+
+def iter_jsonl(file_path):
+    """ The records of a JSONL file, which may also be compressed (.gz/.zst) or a directory of shards, parsed one
+    at a time.
+    """
+    return parse_jsonl_lines(iter_jsonl_lines(file_path))
+
+
+def iter_chunks(iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def is_nan_data(d):
+    return len(d) <= 2
 
 
 def filter_nan_data(data):
     filtered_data = []
     for d in data:
-        if len(d) <= 2:
+        if is_nan_data(d):
             continue
         filtered_data.append(d)
     print('Filtered {} nan data; {} examples left.'.format(len(data)-len(filtered_data) , len(filtered_data)))
@@ -82,34 +107,55 @@ def fuzzy_match_slot_values(val, utterance):
         return False
 
 
+def is_well_formatted(datapoint):
+    good_data = True
+    for turn in range(len(datapoint['dialog_action_user'])):
+        values = []
+        for action in datapoint['dialog_action_user'][turn]:
+            a = action_from_dict(action)
+            values += extract_slot_values_from_action(a)
+        cur_utterance = datapoint['conversation'][turn*2]
+        for val in values:
+            if not fuzzy_match_slot_values(val, cur_utterance):
+                good_data = False
+
+    for turn in range(len(datapoint['dialog_action_system'])):
+        values = []
+        for meta_action in datapoint['dialog_action_system'][turn]:
+            a = action_from_dict(meta_action['default_action'])
+            values += extract_slot_values_from_action(a)
+        # cur_utterance = datapoint['conversation'][turn*2+1]
+        cur_utterance_1 = datapoint['response_options'][turn]['verbosity_high no_mirroring']
+        cur_utterance_2 = datapoint['response_options'][turn]['verbosity_high mirroring']
+        for val in values:
+            if not fuzzy_match_slot_values(val, cur_utterance_1) and not fuzzy_match_slot_values(val, cur_utterance_2):
+                good_data = False
+    return good_data
+
+
+def filter_rule_based_chunk(lines):
+    """ The datapoints of a chunk of JSONL lines that pass the rule-based filters (in order), and the counts of each
+    outcome. Run by the worker processes of `--rule_workers`.
+    """
+    counts = Counter()
+    filtered_data = []
+    for datapoint in parse_jsonl_lines(lines):
+        counts['loaded'] += 1
+        if is_nan_data(datapoint):
+            counts['nan'] += 1
+        elif not is_well_formatted(datapoint):
+            counts['misformatted'] += 1
+        else:
+            filtered_data.append(datapoint)
+    return filtered_data, counts
+
+
 def filter_misformat_data(data):
     filtered_data = []
-    for idx, datapoint in enumerate(data):
-        good_data = True
-        for turn in range(len(datapoint['dialog_action_user'])):
-            values = []
-            for action in datapoint['dialog_action_user'][turn]:
-                a = Action.convert_from_dict(action)
-                values += extract_slot_values_from_action(a)
-            cur_utterance = datapoint['conversation'][turn*2]
-            for val in values:
-                if not fuzzy_match_slot_values(val, cur_utterance):
-                    good_data = False
-
-        for turn in range(len(datapoint['dialog_action_system'])):
-            values = []
-            for meta_action in datapoint['dialog_action_system'][turn]:
-                a = Action.convert_from_dict(meta_action['default_action'])
-                values += extract_slot_values_from_action(a)
-            # cur_utterance = datapoint['conversation'][turn*2+1]
-            cur_utterance_1 = datapoint['response_options'][turn]['verbosity_high no_mirroring']
-            cur_utterance_2 = datapoint['response_options'][turn]['verbosity_high mirroring']
-            for val in values:
-                if not fuzzy_match_slot_values(val, cur_utterance_1) and not fuzzy_match_slot_values(val, cur_utterance_2):
-                    good_data = False
-        if good_data:
+    for datapoint in data:
+        if is_well_formatted(datapoint):
             filtered_data.append(datapoint)
-    
+
     print('Filtered {} mis-formated data; {} examples left.'.format(len(data)-len(filtered_data) , len(filtered_data)))
     return filtered_data
 
@@ -121,14 +167,14 @@ def extract_plot_from_datapoint(datapoint):
     for line in datapoint['dialog_action_user']:
         actions_line = []
         for action in line:
-            act = Action.convert_from_dict(action)
+            act = action_from_dict(action)
             actions_line.append(act.realize())
         user_actions.append(actions_line)
 
     for line in datapoint['dialog_action_system']:
         actions_line = []
         for action in line:
-            act = MetaAction.convert_from_dict(action)
+            act = meta_action_from_dict(action)
             actions_line.append(act.realize())
         system_actions.append(actions_line)
 
@@ -146,77 +192,161 @@ def combine_act_utt_pairs(datapoint, user_actions, system_actions):
     return user_act_utt_pairs, system_act_utt_pairs
 
 
-def filter_inconsistent_data_by_llm(data):
-    '''
-    Will produce a temp_buffer.jsonl file to store the results.
-    '''
-    prompts = []
-    for id in range(len(data)):
-        user_actions, system_actions = extract_plot_from_datapoint(data[id])
-        user_act_utt_pairs, system_act_utt_pairs = combine_act_utt_pairs(data[id], user_actions, system_actions)
-        template_str = dedent("""\
-            Please check the consistency between the actions and the corresponding utterances for the following dialog. They might refer to the context below.
-            
-            Context: {{ context }}
-            {% for usr_turn in usr_turn_pairs %}
-            User: {{ usr_turn }}
-                            
-            System: {{ sys_turn_pairs[loop.index0] }}
-            {% endfor %}
-            Response: """)
-            # If you think they are consistent, please type "consistent". If not, please type "inconsistent".
-
-        prompt_template = environment.from_string(template_str)
-        prompt = prompt_template.render(
-            context=data[id]['context'],
-            usr_turn_pairs= user_act_utt_pairs,
-            sys_turn_pairs= system_act_utt_pairs,
-        )
-        prompts.append(prompt)
-
-
-    def response_extractor(response):
-        llm_output = response.choices[0].message.content.strip()
-        return {'llm_output': llm_output}
-
-
-    openai_manager = OpenAIRequestManager(response_extractor)
-    openai_manager.multi_threading_openai_api_call(prompts=prompts, max_workers=5)
-
-    check_results = load_jsonl('temp_buffer.jsonl')
-    check_results = sorted(check_results, key=lambda x: x['id'])
+CONSISTENCY_PROMPT_TEMPLATE = environment.from_string(dedent("""\
+    Please check the consistency between the actions and the corresponding utterances for the following dialog. They might refer to the context below.
     
+    Context: {{ context }}
+    {% for usr_turn in usr_turn_pairs %}
+    User: {{ usr_turn }}
+                    
+    System: {{ sys_turn_pairs[loop.index0] }}
+    {% endfor %}
+    Response: """))
+    # If you think they are consistent, please type "consistent". If not, please type "inconsistent".
+
+
+def build_consistency_prompt(datapoint):
+    user_actions, system_actions = extract_plot_from_datapoint(datapoint)
+    user_act_utt_pairs, system_act_utt_pairs = combine_act_utt_pairs(datapoint, user_actions, system_actions)
+    return CONSISTENCY_PROMPT_TEMPLATE.render(
+        context=datapoint['context'],
+        usr_turn_pairs= user_act_utt_pairs,
+        sys_turn_pairs= system_act_utt_pairs,
+    )
+
+
+def response_extractor(response):
+    llm_output = response.choices[0].message.content.strip()
+    return {'llm_output': llm_output}
+
+
+def make_consistency_checker():
+    """ A function checking a datapoint with the LLM: True if consistent, False if not, None if the check failed.
+    """
+    openai_manager = OpenAIRequestManager(response_extractor, api_params={'buffer_path': os.devnull}, stage='qc')
+
+    def check(datapoint):
+        result = openai_manager.request(build_consistency_prompt(datapoint))
+        if result is None:
+            return None
+        return 'inconsistent' not in result['llm_output'].lower()
+    return check
+
+
+def imap_ordered_bounded(func, iterable, num_workers: int, max_in_flight: int, processes: bool = False):
+    """ Yield (item, func(item)) in input order, from a pool of `num_workers` threads (or processes), with at most
+    `max_in_flight` items submitted but not yet yielded (so the input is only read as fast as the results are consumed).
+    """
+    if processes:
+        # Spawned rather than forked: the parent already runs the LLM and metrics threads
+        executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+    with executor:
+        pending = deque()
+        for item in iterable:
+            if len(pending) >= max_in_flight:
+                done_item, future = pending.popleft()
+                yield done_item, future.result()
+            pending.append((item, executor.submit(func, item)))
+        while pending:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+
+
+def filter_inconsistent_data_by_llm(data, num_workers: int = 5):
+    check = make_consistency_checker()
     filtered_data = []
-    for idx, result in enumerate(check_results):
-        if 'inconsistent' in result['llm_output'].lower():
-            continue
-        filtered_data.append(data[idx])
+    for datapoint, consistent in imap_ordered_bounded(check, data, num_workers, 4 * num_workers):
+        if consistent:
+            filtered_data.append(datapoint)
 
     print('Filtered {} inconsistent data; {} examples left.'.format(len(data)-len(filtered_data) , len(filtered_data)))
     return filtered_data
 
 
+def run_quality_control(input_path, output_path, llm_workers: int = 5, max_in_flight: int = None,
+                        rule_workers: int = 1, rule_chunk_size: int = 256) -> Counter:
+    """ Stream the datapoints of `input_path` through the rule filters and the LLM consistency check, and write the
+    ones that pass to `output_path` as they come (in input order). Memory is bounded by the `max_in_flight` datapoints
+    being checked, whatever the size of the input. With `rule_workers` > 1, the rule filters run on chunks of
+    `rule_chunk_size` lines in that many processes (2 chunks per process in flight). Returns the counts of each outcome.
+    """
+    counts = Counter()
+
+    def rule_filtered_data():
+        chunks = iter_chunks(iter_jsonl_lines(input_path), rule_chunk_size)
+        if rule_workers > 1:
+            results = (result for _, result in imap_ordered_bounded(filter_rule_based_chunk, chunks, rule_workers,
+                                                                    2 * rule_workers, processes=True))
+        else:
+            results = map(filter_rule_based_chunk, chunks)
+        for filtered_data, chunk_counts in results:
+            counts.update(chunk_counts)
+            yield from filtered_data
+
+    check = make_consistency_checker()
+    with open(output_path, 'w') as file:
+        for datapoint, consistent in imap_ordered_bounded(check, rule_filtered_data(), llm_workers,
+                                                          max_in_flight or 4 * llm_workers):
+            if consistent is None:
+                counts['unchecked'] += 1  # The LLM check failed after all its attempts
+                continue
+            if not consistent:
+                counts['inconsistent'] += 1
+                continue
+            file.write(dumps_record(datapoint)+'\n')
+            file.flush()
+            counts['kept'] += 1
+
+    print('Loading raw data length: {} from {}'.format(counts['loaded'], input_path))
+    left = counts['loaded'] - counts['nan']
+    print('Filtered {} nan data; {} examples left.'.format(counts['nan'], left))
+    left -= counts['misformatted']
+    print('Filtered {} mis-formated data; {} examples left.'.format(counts['misformatted'], left))
+    if counts['unchecked']:
+        print('Dropped {} data whose LLM check failed.'.format(counts['unchecked']))
+    print('Filtered {} inconsistent data; {} examples left.'.format(counts['inconsistent'], counts['kept']))
+    return counts
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input_dir', type=str, help='Path to synthesized data.', default=Path('data/dialogs'))
-    parser.add_argument('--output_dir', type=str, help='Path to save the filtered synthesized data.', default=Path('data/filtered_dialogs'))
+    parser.add_argument('--input_dir', type=Path, help='Path to synthesized data.', default=Path('data/dialogs'))
+    parser.add_argument('--output_dir', type=Path, help='Path to save the filtered synthesized data.', default=Path('data/filtered_dialogs'))
+    parser.add_argument('--metrics_file', type=Path, help='Export the metrics of the LLM check to this Prometheus textfile.', default=None)
+    parser.add_argument('--llm_trace', action='store_true', help='Write a record per LLM call to qc.llm_trace.jsonl in the output directory.')
+    parser.add_argument('--llm_workers', type=int, help='Number of concurrent LLM consistency checks.', default=5)
+    parser.add_argument('--max_in_flight', type=int, help='Maximum number of datapoints read but not yet written (default: 4 * llm_workers).', default=None)
+    parser.add_argument('--rule_workers', type=int, help='Number of processes running the rule-based filters (1: in the main process; 0: one per CPU).', default=1)
+    parser.add_argument('--rule_chunk_size', type=int, help='Number of datapoints sent to a rule filter process at a time.', default=256)
+    add_profile_argument(parser)
+    add_dry_run_arguments(parser)
     args = parser.parse_args()
+    profiler = start_profiler(args.profile)
+    dry_run = args.dry_run is not None
+    if dry_run:
+        enable_dry_run()
+    exporter = MetricsExporter(args.metrics_file).start()
 
     file_names = ['none.jsonl', 'compositional.jsonl', 'compound.jsonl']
     args.output_dir.mkdir(exist_ok=True)
+    if args.llm_trace and not dry_run:
+        start_trace(args.output_dir / f'qc{TRACE_SUFFIX}', erase=True)
+    total_datapoints = 0
 
     for fn in file_names:
-        path = args.input_dir / fn
-        if not path.is_file():
+        path = resolve_jsonl_path(args.input_dir / fn)  # Also finds compressed or sharded outputs
+        if path is None:
             continue
-        data = load_jsonl(path)
-        filtered_data = filter_nan_data(data)
-        filtered_data = filter_misformat_data(filtered_data)
-
-        # LLM inconsistency check
-        filtered_data = filter_inconsistent_data_by_llm(filtered_data)
-
-        saving_path = os.path.join(args.output_dir, fn)
-        with open(saving_path, 'w') as file:
-            for d in filtered_data:
-                file.write(json.dumps(d, ensure_ascii=False)+'\n')
+        saving_path = os.devnull if dry_run else os.path.join(args.output_dir, fn)
+        counts = run_quality_control(path, saving_path, args.llm_workers, args.max_in_flight,
+                                     args.rule_workers or os.cpu_count(), args.rule_chunk_size)
+        total_datapoints += counts['loaded']
+    exporter.stop()
+    stop_trace()
+    print(f'LLM requests by stage: {format_stage_summary()}')
+    if dry_run:  # All the dialogs are checked (the stubbed requests are free)
+        report_dry_run(args, total_datapoints, total_datapoints, concurrency=args.llm_workers)
+    if profiler is not None:
+        profiler.stop().save(args.output_dir / 'qc.profile')
@@ -13,6 +13,9 @@ from dotenv import load_dotenv
 from openai import OpenAI
 from tqdm import tqdm
 
+from .llm_trace import record_llm_call
+from .metrics import LLM_RETRIES, record_llm_usage, track_llm_request
+
 load_dotenv()
 openai_api_key = os.environ.get("OPENAI_API_KEY")
 base_url = os.environ.get("BASE_URL")
@@ -44,7 +47,7 @@ class Timer(object):
 
 
 class OpenAIRequestManager:
-    def __init__(self, response_extractor, api_params={}, api_key=None):
+    def __init__(self, response_extractor, api_params={}, api_key=None, stage='other'):
         # Global api parameters
         # openai.api_key = os.getenv("OPENAI_API_KEY")
         if 'engine' not in api_params:
@@ -67,6 +70,7 @@ class OpenAIRequestManager:
         self.outbuf = open(api_params['buffer_path'], 'a')
         self.lock = threading.Lock()
         self.api_params = api_params
+        self.stage = stage  # The pipeline stage of the requests in the metrics
         if api_key:
             self.client = OpenAI(
                 api_key=api_key
@@ -83,34 +87,45 @@ class OpenAIRequestManager:
         self.outbuf.flush()
         self.lock.release()
 
-    def openai_api_call(self, prompt):
-        id, prompt = prompt
+    def request(self, prompt):
+        """ The extracted response to a prompt, or None if every attempt failed. """
         messages = [
             {"role": "system", "content": "You are a helpful AI assistant."},
             {"role": "user", "content": prompt},
         ]
         attempt = 0
         wait_sec = 0.1
-        while True:
-            try:
-                response = self.client.chat.completions.create(
-                    model=self.api_params['engine'],
-                    messages=messages,
-                    temperature=self.api_params['temperature'],
-                    max_tokens=self.api_params['max_tokens'],
-                    logprobs=self.api_params['logprobs'],
-                    top_logprobs=self.api_params['top_logprobs'] if self.api_params['logprobs'] else None,
-                )
-                result = self.response_extractor(response)
-                result['id'] = id
-                self.write_result(result)
-                break
-            except Exception as e:
-                print(e)
-                attempt += 1
-                if attempt >= self.api_params['attempt_num']:
-                    return None
-                time.sleep(wait_sec)
+        start = time.perf_counter()
+        with track_llm_request(self.stage):
+            while True:
+                try:
+                    response = self.client.chat.completions.create(
+                        model=self.api_params['engine'],
+                        messages=messages,
+                        temperature=self.api_params['temperature'],
+                        max_tokens=self.api_params['max_tokens'],
+                        logprobs=self.api_params['logprobs'],
+                        top_logprobs=self.api_params['top_logprobs'] if self.api_params['logprobs'] else None,
+                    )
+                    record_llm_usage(self.stage, response.usage)
+                    record_llm_call(self.stage, messages, response.usage, time.perf_counter() - start, attempt)
+                    return self.response_extractor(response)
+                except Exception as e:
+                    print(e)
+                    attempt += 1
+                    if attempt >= self.api_params['attempt_num']:
+                        record_llm_call(self.stage, messages, None, time.perf_counter() - start, attempt - 1,
+                                        outcome=type(e).__name__)
+                        return None
+                    LLM_RETRIES.inc(stage=self.stage, cause=type(e).__name__)
+                    time.sleep(wait_sec)
+
+    def openai_api_call(self, prompt):
+        id, prompt = prompt
+        result = self.request(prompt)
+        if result is not None:
+            result['id'] = id
+            self.write_result(result)
 
     def multi_threading_openai_api_call(self, prompts, max_workers=64):
         timer = Timer()
@@ -0,0 +1,160 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Dry runs (`--dry_run`) of the pipeline entry points, to budget a planned run before spending any quota.
+
+A sample of the planned datapoints goes through the pipeline as usual (operations, plots, every prompt rendered),
+but the chat completion clients are replaced by a local stub that answers instantly with the responses of
+`utilities.fake_llm_server`. The requests are counted in `utilities.metrics` like real ones, with the prompt tokens
+counted by the local tokenizer, and the counts are extrapolated to the full run: LLM calls, prompt and completion
+tokens, cost and wall clock at the run's concurrency.
+
+The stub's completions are shorter than real ones, and the latency of a request is unknown without an LLM: pass the
+LLM traces of earlier runs (`--dry_run_trace`, see `utilities.llm_trace`) to use their mean latency and completion
+tokens of each template instead of `--dry_run_latency` and the stub's completion tokens.
+"""
+import datetime
+import random
+import zlib
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Dict, List
+
+from . import async_openai_api, llm_synthesis_utils
+from .fake_llm_server import fake_completion
+from .llm_trace import format_table, load_trace
+from .metrics import LLM_LATENCY, LLM_TOKENS
+
+DEFAULT_SAMPLE_SIZE = 100
+
+
+class _StubCompletions:
+    def create(self, model=None, messages=(), max_tokens=None, **kwargs):
+        prompt = messages[-1]['content'] if messages else ''
+        # Seeded by the prompt, so that the same request gets the same response whatever the thread timing
+        content = fake_completion(prompt, random.Random(zlib.crc32(prompt.encode())))
+        prompt_tokens = sum(llm_synthesis_utils.count_tokens(message.get('content') or '') for message in messages)
+        completion_tokens = llm_synthesis_utils.count_tokens(content)
+        message = SimpleNamespace(role='assistant', content=content)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(index=0, message=message, logprobs=None, finish_reason='stop')],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                  total_tokens=prompt_tokens + completion_tokens),
+        )
+
+
+class _AsyncStubCompletions(_StubCompletions):
+    async def create(self, *args, **kwargs):
+        return super().create(*args, **kwargs)
+
+
+class DryRunClient:
+    """ Stands in for `openai.OpenAI`: only `chat.completions.create` is supported. """
+    completions_class = _StubCompletions
+
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=self.completions_class())
+
+
+class AsyncDryRunClient(DryRunClient):
+    completions_class = _AsyncStubCompletions
+
+
+def enable_dry_run() -> None:
+    """ Replace the chat completion clients of the pipeline by the stub, for the rest of the process. """
+    llm_synthesis_utils.OpenAI = DryRunClient
+    llm_synthesis_utils.AsyncOpenAI = AsyncDryRunClient
+    llm_synthesis_utils._async_client = None
+    async_openai_api.OpenAI = DryRunClient
+
+
+def add_dry_run_arguments(parser) -> None:
+    parser.add_argument('--dry_run', type=int, nargs='?', const=DEFAULT_SAMPLE_SIZE, default=None, metavar='SAMPLE_SIZE',
+                        help=f"Forecast the LLM calls, tokens, cost and wall clock of the run from a sample of "
+                             f"SAMPLE_SIZE datapoints (default {DEFAULT_SAMPLE_SIZE}; quality control checks all of "
+                             f"them) generated with a stubbed LLM; nothing is written.")
+    parser.add_argument('--dry_run_latency', type=float, default=2.0,
+                        help="Assumed seconds per LLM request in the --dry_run forecast.")
+    parser.add_argument('--dry_run_trace', type=str, nargs='+', default=None,
+                        help="LLM traces of earlier runs: the --dry_run forecast uses their mean latency and completion "
+                             "tokens of each template.")
+    parser.add_argument('--price_per_1k_prompt_tokens', type=float, default=0.002,
+                        help="Price of 1000 prompt tokens in the --dry_run forecast.")
+    parser.add_argument('--price_per_1k_completion_tokens', type=float, default=0.002,
+                        help="Price of 1000 completion tokens in the --dry_run forecast.")
+
+
+def sample_evenly(items: list, sample_size: int) -> list:
+    """ `sample_size` items spread over the whole list (all of them if there are fewer). """
+    if sample_size >= len(items):
+        return list(items)
+    return [items[i * len(items) // sample_size] for i in range(sample_size)]
+
+
+def load_calibration(trace_paths) -> Dict[str, Dict[str, float]]:
+    """ The mean latency and completion tokens of the successful calls of each template of the traces. """
+    records = defaultdict(list)
+    for path in trace_paths or []:
+        for record in load_trace(path):
+            if record.get('outcome', 'ok') == 'ok':
+                records[record['template']].append(record)
+    return {template: {'latency': sum(record['latency'] for record in template_records) / len(template_records),
+                       'completion_tokens': sum(record.get('completion_tokens') or 0
+                                                for record in template_records) / len(template_records)}
+            for template, template_records in records.items()}
+
+
+def forecast(scale: float, latency: float, calibration: Dict[str, Dict[str, float]], prompt_price: float,
+             completion_price: float, worker_weights: Dict[str, float] = None) -> List[dict]:
+    """ One row per stage of the LLM requests counted so far, extrapolated by `scale`. `worker_weights` is the number
+    of workers a request of the stage keeps busy (e.g. the dialogs of a batched turn request), 1 by default.
+    """
+    rows = []
+    for (stage,), (count, _) in sorted(LLM_LATENCY.stats().items()):
+        if not count:
+            continue
+        calls = count * scale
+        prompt_tokens = LLM_TOKENS.get(stage=stage, kind='prompt') * scale
+        completion_tokens = LLM_TOKENS.get(stage=stage, kind='completion') * scale
+        stage_latency = latency
+        if stage in calibration:
+            stage_latency = calibration[stage]['latency']
+            completion_tokens = calls * calibration[stage]['completion_tokens']
+        rows.append({
+            'stage': stage,
+            'sampled_calls': count,
+            'calls': round(calls),
+            'prompt_tokens': round(prompt_tokens),
+            'completion_tokens': round(completion_tokens),
+            'cost': (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000,
+            'llm_s': calls * stage_latency,
+            'worker_s': calls * stage_latency * (worker_weights or {}).get(stage, 1),
+            'calibrated': stage in calibration,
+        })
+    return rows
+
+
+def report_dry_run(args, sampled: int, total: int, concurrency: int, worker_weights: Dict[str, float] = None,
+                   unit: str = 'datapoint') -> None:
+    """ Print the forecast of a run of `total` units (e.g. datapoints) from the dry run of `sampled` of them, with `concurrency`
+    requests (or workers making requests one at a time) in parallel.
+    """
+    scale = total / sampled if sampled else 0
+    calibration = load_calibration(args.dry_run_trace)
+    rows = forecast(scale, args.dry_run_latency, calibration, args.price_per_1k_prompt_tokens,
+                    args.price_per_1k_completion_tokens, worker_weights)
+    print(f'\nDry run: {unit} sample of {sampled} out of {total}, counts extrapolated x{scale:.2f}\n')
+    print(format_table([{key: value for key, value in row.items() if key != 'worker_s'} for row in rows]))
+    calls = sum(row['calls'] for row in rows)
+    prompt_tokens = sum(row['prompt_tokens'] for row in rows)
+    completion_tokens = sum(row['completion_tokens'] for row in rows)
+    cost = sum(row['cost'] for row in rows)
+    wall = sum(row['worker_s'] for row in rows) / max(concurrency, 1)
+    print(f'\nForecast: {calls} LLM calls ({calls / total if total else 0:.1f} per {unit}), '
+          f'{prompt_tokens} prompt + {completion_tokens} completion tokens, ${cost:.2f}, '
+          f'wall clock ~{datetime.timedelta(seconds=round(wall))} at concurrency {concurrency}')
+    uncalibrated = [row['stage'] for row in rows if not row['calibrated']]
+    if uncalibrated:
+        print(f'Assumed {args.dry_run_latency} s per request and the stub\'s completion tokens for: '
+              f'{", ".join(uncalibrated)} (calibrate with --dry_run_trace)')
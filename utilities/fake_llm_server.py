@@ -0,0 +1,259 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" A local fake of an OpenAI-compatible chat completion API, for load testing the pipeline without an LLM.
+
+The responses are valid for every prompt of context generation, dialog generation and quality control (turns that restate their
+actions, slot values, summaries, consistency checks), after a configurable latency: `latency` seconds plus
+`token_latency` per completion token, times a lognormal jitter factor. Rate limits (requests per minute and
+concurrent requests) are enforced with HTTP 429 responses, like a real backend.
+
+Run `python -m utilities.fake_llm_server --port 8000 --latency 0.5` and point the pipeline to it with
+`BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=fake`.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STYLE_KEYS = [f'{v} {m}' for v in ['verbosity_low', 'verbosity_mid', 'verbosity_high'] for m in ['mirroring', 'no_mirroring']]
+
+
+def _json_after(prompt: str, marker: str):
+    """ The JSON value following the last occurrence of `marker` in the prompt, or None. """
+    start = prompt.rfind(marker)
+    if start < 0:
+        return None
+    try:
+        return json.JSONDecoder().raw_decode(prompt[start + len(marker):].lstrip())[0]
+    except ValueError:
+        return None
+
+
+def _utterance(actions) -> str:
+    """ A "turn" that mentions the slot values of its actions, so that the quality control rule filters pass. """
+    return 'Sure: ' + '; '.join(actions) if actions else 'Okay.'
+
+
+def _requested_count(prompt: str, default: int = 3) -> int:
+    match = re.search(r'JSON list of (\d+)', prompt) or re.search(r'Create (\d+) random', prompt)
+    return int(match.group(1)) if match else default
+
+
+def _fake_context_completion(prompt: str, rng: random.Random):
+    """ Completions of the context generation prompts, or None for other prompts. """
+    n = _requested_count(prompt)
+    if 'write an introduction for' in prompt:
+        return ' '.join(['Alex is a 35-year-old living with family, who enjoys hiking, cooking and reading.'] * 4)
+    if 'establishments of different sizes' in prompt:
+        items = [{'establishment': f'Establishment {i}', 'address': 'Springfield, IL', 'description': 'A local business.',
+                  'position': 'Manager', 'level': rng.choice(['entry-level', 'intermediate', 'senior'])} for i in range(n)]
+    elif 'possible contacts' in prompt:
+        items = [{'relationship': rng.choice(['friend', 'colleague', 'sister']), 'full_name': f'Contact {i} Smith'}
+                 for i in range(n)]
+    elif 'alarms set on' in prompt:
+        items = [{'time': f'{rng.randint(5, 22):02}:{rng.choice([0, 30]):02}', 'name': 'Alarm', 'recurring': rng.random() < 0.5}
+                 for _ in range(n)]
+    elif 'events on this person\'s calendar' in prompt:
+        today = re.search(r'Today is (\w{3} \d{4}-\d{2}-\d{2})', prompt).group(1)
+        items = [{'calendar_name': 'work', 'event_name': f'Meeting {i}', 'all_day': i == 0, 'repeated': i == 1,
+                  'start_time': f'{today} 09:00', 'end_time': f'{today} 10:00', 'host': 'myself'} for i in range(n)]
+    elif 'upcoming reminders' in prompt:
+        today = re.search(r'Today is (\w{3} \d{4}-\d{2}-\d{2})', prompt).group(1)
+        items = [{'todo': f'Task {i}', 'trigger_time': f'{today} 18:00'} for i in range(n)]
+    elif 'current projects' in prompt:
+        items = [{'name': f'Project {i}', 'description': 'A current work item.'} for i in range(n)]
+    elif 'SMS message received by this person from each of the following contacts:' in prompt:
+        contacts = prompt.split('following contacts:')[1].split('. Write a JSON list')[0]
+        senders = [re.sub(r' \(.*\)$', '', contact.strip()) for contact in contacts.split(', ') if contact.strip()]
+        items = [{'sender': sender, 'message': 'Are we still on for tomorrow?'} for sender in senders]
+    elif 'Write an SMS conversation between this person and' in prompt:
+        contact = re.search(r'The sender is either "(.*?)" or "myself"', prompt).group(1)
+        items = [{'sender': contact if i % 2 == 0 else 'myself', 'message': 'Sounds good.'} for i in range(n)]
+    else:
+        return None
+    return json.dumps(items)
+
+
+def fake_completion(prompt: str, rng: random.Random) -> str:
+    """ A plausible completion of a pipeline prompt, keyed on the fixed parts of the prompt templates. """
+    context_completion = _fake_context_completion(prompt, rng)
+    if context_completion is not None:
+        return context_completion
+    if 'check the consistency between the actions and the corresponding utterances' in prompt:
+        return 'consistent'
+    if 'Dialogs:' in prompt and '\nReturn {' in prompt:  # Batched turns
+        dialogs = _json_after(prompt, 'Dialogs:') or {}
+        return json.dumps({key: {'actions': fields.get('actions', []), 'utterance': _utterance(fields.get('actions', []))}
+                           for key, fields in dialogs.items()}, ensure_ascii=False)
+    if '"summary" as key' in prompt:
+        return json.dumps({'summary': 'Here are the results you asked for.'})
+    if 'Response list:' in prompt:
+        slots = _json_after(prompt, 'Slots:') or []
+        return json.dumps([{slot: f'{slot.replace("_", " ")} {rng.randint(1, 99)}' for slot in slots} for _ in range(5)])
+    if 'You should return in JSON format with 6 keys' in prompt:
+        style_actions = _json_after(prompt, 'assistant actions:') or {}
+        return json.dumps({key: _utterance(style_actions.get(key, [])) for key in STYLE_KEYS}, ensure_ascii=False)
+    if 'user action:' in prompt:  # One-off user turn
+        return json.dumps({'message': _utterance(_json_after(prompt, 'user action:') or [])}, ensure_ascii=False)
+    for marker in ['The "actions" you need to follow is', 'Your next actions are']:
+        actions = _json_after(prompt, marker)
+        if actions is not None:
+            return json.dumps({'actions': actions, 'utterance': _utterance(actions)}, ensure_ascii=False)
+    return json.dumps({'message': 'Okay.'})
+
+
+def count_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+class FakeLLMServer:
+    """ Serves `POST /v1/chat/completions` (and `/chat/completions`) on `http://host:port`, see the module docstring.
+    `rpm` and `max_concurrency` (None: unlimited) answer the requests over the limits with 429.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.5, jitter: float = 0.3,
+                 token_latency: float = 0.0, rpm: int = None, max_concurrency: int = None, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_latency = token_latency
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.recent = deque()  # Times of the requests of the last minute
+        self.stats = Counter()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like a real API
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self._send(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+                    return
+                status, payload, headers = server.handle(body)
+                self._send(status, payload, headers)
+
+            def _send(self, status, payload, headers=None):
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass  # Don't log every request
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def _admit(self):
+        """ None if the request is admitted, or the seconds after which it may be retried. """
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and now - self.recent[0] >= 60:
+                self.recent.popleft()
+            if self.rpm is not None and len(self.recent) >= self.rpm:
+                return 60 - (now - self.recent[0])
+            if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                return 1
+            self.recent.append(now)
+            self.in_flight += 1
+            return None
+
+    def handle(self, body: dict):
+        retry_after = self._admit()
+        if retry_after is not None:
+            with self.lock:
+                self.stats['rate_limited'] += 1
+            return 429, {'error': {'message': 'Rate limit reached, please retry later.', 'type': 'rate_limit_error',
+                                   'code': 'rate_limit_exceeded'}}, {'Retry-After': f'{retry_after:.3f}'}
+        try:
+            messages = body.get('messages') or [{'content': ''}]
+            with self.lock:
+                content = fake_completion(messages[-1]['content'], self.rng)
+                jitter = self.rng.lognormvariate(0, self.jitter) if self.jitter else 1
+            prompt_tokens = sum(count_tokens(message.get('content') or '') for message in messages)
+            completion_tokens = count_tokens(content)
+            time.sleep((self.latency + self.token_latency * completion_tokens) * jitter)
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['prompt_tokens'] += prompt_tokens
+                self.stats['completion_tokens'] += completion_tokens
+            return 200, {
+                'id': f'chatcmpl-{uuid.uuid4().hex}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model') or 'fake',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'logprobs': None,
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                          'total_tokens': prompt_tokens + completion_tokens},
+            }, None
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def start(self) -> 'FakeLLMServer':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_server_arguments(parser) -> None:
+    parser.add_argument('--latency', type=float, help='Base latency of a response, in seconds.', default=0.5)
+    parser.add_argument('--jitter', type=float, help='Sigma of the lognormal factor applied to the latency (0: none).', default=0.3)
+    parser.add_argument('--token_latency', type=float, help='Additional latency per completion token, in seconds.', default=0.0)
+    parser.add_argument('--rpm', type=int, help='Requests per minute before answering 429 (default: unlimited).', default=None)
+    parser.add_argument('--max_concurrency', type=int, help='Concurrent requests before answering 429 (default: unlimited).', default=None)
+
+
+def server_from_args(args, host: str = '127.0.0.1', port: int = 0) -> FakeLLMServer:
+    return FakeLLMServer(host, port, latency=args.latency, jitter=args.jitter, token_latency=args.token_latency,
+                         rpm=args.rpm, max_concurrency=args.max_concurrency)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake OpenAI-compatible chat completion server.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = server_from_args(args, args.host, args.port)
+    print(f'Serving fake chat completions on {server.base_url}')
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+        print(dict(server.stats))
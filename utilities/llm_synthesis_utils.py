@@ -2,14 +2,19 @@
 # For licensing see accompanying LICENSE file.
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
+import asyncio
 import logging
 import os
+import threading
 import time
 from typing import List, Dict, Tuple
 
 from dotenv import load_dotenv
 from jinja2 import Environment, select_autoescape
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+
+from .llm_trace import record_llm_call
+from .metrics import LLM_RETRIES, record_llm_usage, track_llm_request
 
 load_dotenv()
 openai_api_key = os.environ.get("OPENAI_API_KEY")
@@ -19,33 +24,122 @@ engine = os.environ.get("ENGINE")
 environment = Environment(autoescape=select_autoescape(default_for_string=False))
 
 
+_tokenizer_lock = threading.Lock()
+_tokenizer = []  # Loaded once: [encoding or None]
+
+
+def _load_tokenizer():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(engine or '')
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:  # The encoding file could not be downloaded
+        logging.warning(f"Cannot load the tiktoken encoding, approximating token counts: {repr(e)}")
+        return None
+
+
+def get_tokenizer():
+    """ The tiktoken encoding of the engine (cl100k_base for unknown engines), or None if tiktoken or its encoding
+    files are not available.
+    """
+    with _tokenizer_lock:
+        if not _tokenizer:
+            _tokenizer.append(_load_tokenizer())
+    return _tokenizer[0]
+
+
+def count_tokens(text: str) -> int:
+    """ Number of tokens of `text`, counted locally. Without a tokenizer, it is approximated as 1 token per 4 characters.
+    """
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return (len(text) + 3) // 4
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def _request_kwargs(messages: List[Dict], temperature: float, max_tokens: int, **kwargs) -> Dict:
+    return dict(model=engine, messages=messages, temperature=temperature, max_tokens=max_tokens, **kwargs)
+
+
+def _on_request_error(e: Exception, stage: str, wait_sec: float, max_wait_sec: float) -> Tuple[float, float]:
+    """ Count and log a failed request. Returns the seconds to wait before retrying, and the wait after the next
+    failure (exponential backoff up to `max_wait_sec`).
+    """
+    LLM_RETRIES.inc(stage=stage, cause=type(e).__name__)
+    msg = f"Retrying in {wait_sec} s due to OpenAI Error: {e}"
+    if 'rate limit' in msg.lower():
+        logging.debug(msg)
+    else:
+        logging.warning(msg)
+    return wait_sec, min(wait_sec * 2, max_wait_sec)
+
+
+def _finish_request(stage: str, messages: List[Dict], response, start: float, retries: int) -> Tuple[str, float]:
+    """ Record the usage of a successful request in the metrics and the LLM trace; returns its output and cost. """
+    record_llm_usage(stage, response.usage)
+    llm_output = response.choices[0].message.content.strip().replace('```json', '').replace('```', '')
+    record_llm_call(stage, messages, response.usage, time.perf_counter() - start, retries, llm_output=llm_output)
+    cost = 0.002 * response.usage.total_tokens / 1000
+    return llm_output, cost
+
+
 def call_openai_chat_completion(
         messages: List[Dict],
         temperature: float,
         max_tokens: int,
         wait_sec: float = 0.3,
         max_wait_sec: float = 0.3,
+        stage: str = 'other',
         **kwargs
 ) -> Tuple[str, float]:
+    """ The output and approximate cost of a chat completion, retried until it succeeds. The request is measured in
+    the pipeline metrics and the LLM trace under `stage` (see `utilities.metrics` and `utilities.llm_trace`).
+    """
     client = OpenAI(api_key=openai_api_key, base_url=base_url)
-    while True:
-        try:
-            response = client.chat.completions.create(
-                model=engine,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                **kwargs
-            )
-            break
-        except Exception as e:
-            msg = f"Retrying in {wait_sec} s due to OpenAI Error: {e}"
-            if 'rate limit' in msg.lower():
-                logging.debug(msg)
-            else:
-                logging.warning(msg)
-            time.sleep(wait_sec)
-            wait_sec = min(wait_sec * 2, max_wait_sec)
-    llm_output = response.choices[0].message.content.strip().replace('```json', '').replace('```', '')
-    cost = 0.002 * response.usage.total_tokens / 1000
-    return llm_output, cost
+    start, retries = time.perf_counter(), 0
+    with track_llm_request(stage):
+        while True:
+            try:
+                response = client.chat.completions.create(**_request_kwargs(messages, temperature, max_tokens, **kwargs))
+                break
+            except Exception as e:
+                retries += 1
+                delay, wait_sec = _on_request_error(e, stage, wait_sec, max_wait_sec)
+                time.sleep(delay)
+    return _finish_request(stage, messages, response, start, retries)
+
+
+_async_client = None
+
+
+async def async_call_openai_chat_completion(
+        messages: List[Dict],
+        temperature: float,
+        max_tokens: int,
+        wait_sec: float = 0.3,
+        max_wait_sec: float = 0.3,
+        stage: str = 'other',
+        **kwargs
+) -> Tuple[str, float]:
+    """ `call_openai_chat_completion` for an event loop. The client (and its connection pool) is shared by all the
+    requests, so it must only be used from a single event loop.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(api_key=openai_api_key, base_url=base_url)
+    start, retries = time.perf_counter(), 0
+    with track_llm_request(stage):
+        while True:
+            try:
+                response = await _async_client.chat.completions.create(**_request_kwargs(messages, temperature, max_tokens, **kwargs))
+                break
+            except Exception as e:
+                retries += 1
+                delay, wait_sec = _on_request_error(e, stage, wait_sec, max_wait_sec)
+                await asyncio.sleep(delay)
+    return _finish_request(stage, messages, response, start, retries)
@@ -0,0 +1,221 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Opt-in structured trace of the LLM calls, and its offline analyzer.
+
+When a trace is started, every LLM call appends one JSON record to the trace file: the call site (`template`, the
+pipeline stage of `utilities.metrics`), the hash and token counts of the prompt, the latency, the number of API
+retries and the outcome. The calls are attributed to a datapoint through `trace_context`, which holds the data id,
+the service intents and the dialog turn of the running code (a context variable, so it follows both worker threads
+and asyncio tasks).
+
+Analyze a trace with `python -m utilities.llm_trace data/dialogs/none.llm_trace.jsonl`.
+"""
+import argparse
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, List
+
+TRACE_SUFFIX = '.llm_trace.jsonl'
+
+_trace_context: ContextVar[dict] = ContextVar('llm_trace_context', default={})
+
+
+@contextmanager
+def trace_context(**fields):
+    """ Attribute the LLM calls made inside the block to `fields` (e.g. data_id, intents, turn), on top of the
+    fields of the enclosing blocks.
+    """
+    token = _trace_context.set({**_trace_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _trace_context.reset(token)
+
+
+class LLMTrace:
+    def __init__(self, path, erase: bool = False):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.fp = open(self.path, 'w' if erase else 'a')
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+        with self.lock:
+            self.fp.write(line)
+            self.fp.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.fp.close()
+
+
+_trace: LLMTrace = None
+
+
+def start_trace(path, erase: bool = False) -> LLMTrace:
+    global _trace
+    stop_trace()
+    _trace = LLMTrace(path, erase)
+    return _trace
+
+
+def stop_trace() -> None:
+    global _trace
+    if _trace is not None:
+        _trace.close()
+        _trace = None
+
+
+def is_tracing() -> bool:
+    return _trace is not None
+
+
+def hash_prompt(messages: List[Dict]) -> str:
+    return hashlib.sha1(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def record_llm_call(template: str, messages: List[Dict], usage, latency: float, retries: int, outcome: str = 'ok',
+                    llm_output: str = None) -> None:
+    """ Append the record of an LLM call to the trace (no-op unless a trace is started). `llm_output` is only checked
+    for being valid JSON, which most prompts of the pipeline ask for.
+    """
+    trace = _trace
+    if trace is None:
+        return
+    record = {
+        'time': round(time.time(), 3),
+        'template': template,
+        **_trace_context.get(),
+        'prompt_hash': hash_prompt(messages),
+        'prompt_tokens': getattr(usage, 'prompt_tokens', None),
+        'completion_tokens': getattr(usage, 'completion_tokens', None),
+        'latency': round(latency, 4),
+        'retries': retries,
+        'outcome': outcome,
+    }
+    if llm_output is not None:
+        try:
+            json.loads(llm_output)
+            record['json_valid'] = True
+        except ValueError:
+            record['json_valid'] = False
+    trace.write(record)
+
+
+def load_trace(path) -> List[dict]:
+    records = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # e.g. a line truncated by a crash
+    return records
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """ Nearest-rank percentile of already sorted values. """
+    if not sorted_values:
+        return math.nan
+    rank = max(math.ceil(q / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def _intent_keys(record: dict) -> List[str]:
+    return record.get('intents') or ['-']
+
+
+def _service_keys(record: dict) -> List[str]:
+    return sorted({intent.split('.')[0] for intent in _intent_keys(record)})
+
+
+def summarize(records: List[dict], key) -> List[dict]:
+    """ Latency percentiles and token totals of the calls grouped by `key(record)` (a list of groups: a call of a
+    compound dialog counts for each of its intents), slowest total first.
+    """
+    groups = defaultdict(list)
+    for record in records:
+        for group in key(record):
+            groups[group].append(record)
+    rows = []
+    for group, group_records in groups.items():
+        latencies = sorted(record['latency'] for record in group_records)
+        rows.append({
+            'group': group,
+            'calls': len(group_records),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'total_s': sum(latencies),
+            'prompt_tokens': sum(record.get('prompt_tokens') or 0 for record in group_records),
+            'completion_tokens': sum(record.get('completion_tokens') or 0 for record in group_records),
+            'retries': sum(record.get('retries', 0) for record in group_records),
+            'invalid_json': sum(record.get('json_valid') is False for record in group_records),
+            'failed': sum(record.get('outcome', 'ok') != 'ok' for record in group_records),
+        })
+    return sorted(rows, key=lambda row: -row['total_s'])
+
+
+def slowest_dialogs(records: List[dict], top: int = 10) -> List[dict]:
+    """ The datapoints with the most LLM time (the sum of their call latencies, whether or not concurrent). """
+    dialogs = defaultdict(list)
+    for record in records:
+        if record.get('data_id'):
+            dialogs[record['data_id']].append(record)
+    rows = []
+    for data_id, dialog_records in dialogs.items():
+        rows.append({
+            'data_id': data_id,
+            'intents': '+'.join(_intent_keys(dialog_records[-1])),
+            'calls': len(dialog_records),
+            'llm_s': sum(record['latency'] for record in dialog_records),
+            'span_s': max(record['time'] for record in dialog_records) - min(record['time'] - record['latency'] for record in dialog_records),
+            'tokens': sum((record.get('prompt_tokens') or 0) + (record.get('completion_tokens') or 0) for record in dialog_records),
+        })
+    return sorted(rows, key=lambda row: -row['llm_s'])[:top]
+
+
+def format_table(rows: List[dict]) -> str:
+    if not rows:
+        return '(no calls)'
+    columns = list(rows[0])
+    cells = [[f'{row[column]:.3f}' if isinstance(row[column], float) else str(row[column]) for column in columns]
+             for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells)) for i, column in enumerate(columns)]
+    lines = ['  '.join(column.ljust(width) for column, width in zip(columns, widths))]
+    lines.extend('  '.join(cell.ljust(width) for cell, width in zip(line, widths)) for line in cells)
+    return '\n'.join(lines)
+
+
+def print_report(records: List[dict], top: int = 10) -> None:
+    print(f'{len(records)} LLM calls, {sum(record["latency"] for record in records):.1f} s of LLM time\n')
+    print('By template:')
+    print(format_table(summarize(records, lambda record: [record['template']])))
+    print('\nBy service:')
+    print(format_table(summarize(records, _service_keys)))
+    print('\nBy service intent:')
+    print(format_table(summarize(records, _intent_keys)))
+    print(f'\nSlowest {top} dialogs:')
+    print(format_table(slowest_dialogs(records, top)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aggregate an LLM trace into latency and token breakdowns.')
+    parser.add_argument('trace', type=Path, nargs='+', help='LLM trace files (`*.llm_trace.jsonl`).')
+    parser.add_argument('--template', type=str, help='Only analyze the calls of this template.', default=None)
+    parser.add_argument('--top', type=int, help='Number of slowest dialogs to list.', default=10)
+    args = parser.parse_args()
+
+    records = [record for path in args.trace for record in load_trace(path)]
+    if args.template:
+        records = [record for record in records if record['template'] == args.template]
+    print_report(records, args.top)
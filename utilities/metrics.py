@@ -0,0 +1,306 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" A lightweight in-process metrics registry: labelled counters, gauges and histograms, exported in the Prometheus
+text format to a textfile (e.g. for the node_exporter textfile collector) or on a local `/metrics` HTTP endpoint.
+
+The pipeline metrics are defined at the bottom: the LLM requests are measured by pipeline stage in
+`llm_synthesis_utils`, and `dialog_generation.main` tracks the datapoints and its queues.
+"""
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+# Seconds; LLM requests take from a fraction of a second to minutes with retries
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # Label values tuple -> value
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """ The (name, labels, value) samples of the metric. """
+        with self.lock:
+            return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in sorted(self.values.items())]
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}' for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def stats(self) -> Dict[Tuple[str, ...], Tuple[int, float]]:
+        """ The (count, sum) of the observations by label values. """
+        with self.lock:
+            return {key: (count, total) for key, (_, total, count) in self.values.items()}
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                labels = dict(zip(self.labelnames, key))
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket', {**labels, 'le': _format_value(bound)}, bucket_count))
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, count))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+        self.lock = threading.Lock()
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, *args, **kwargs)
+            metric = self.metrics[name]
+        if not isinstance(metric, metric_class):
+            raise ValueError(f"{name} is already registered as a {metric.type}")
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """ `collector()` is called before every export, e.g. to update the gauges derived from other metrics. """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(line + '\n' for metric in metrics for line in metric.render())
+
+    def write_textfile(self, path) -> None:
+        """ Write the metrics to `path` atomically, so a collector never reads a partial file. """
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsExporter:
+    """ Exports the metrics of `registry` while the pipeline runs: rewrites the textfile `path` every `interval`
+    seconds and/or serves them on `http://host:port/metrics`. The textfile is written a last time on `stop()`.
+    """
+
+    def __init__(self, path=None, port: int = None, host: str = '127.0.0.1', interval: float = 10,
+                 registry: MetricsRegistry = REGISTRY):
+        self.path = path
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.threads = []
+        self.server = None
+
+    def start(self) -> 'MetricsExporter':
+        if self.path:
+            self.threads.append(threading.Thread(target=self._write_periodically, daemon=True))
+        if self.port is not None:
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = registry.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass  # Don't log every scrape
+
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.threads.append(threading.Thread(target=self.server.serve_forever, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def _write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.write_textfile(self.path)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.path:
+            self.registry.write_textfile(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# Pipeline metrics
+LLM_LATENCY = REGISTRY.histogram(
+    'toad_llm_request_seconds', 'Wall-clock time of the LLM requests, including API retries, by pipeline stage.',
+    ['stage'])
+LLM_IN_FLIGHT = REGISTRY.gauge('toad_llm_requests_in_flight', 'LLM requests currently running, by pipeline stage.',
+                               ['stage'])
+LLM_RETRIES = REGISTRY.counter(
+    'toad_llm_retries_total', 'Retried LLM requests, by pipeline stage and cause (API error class or malformed_json).',
+    ['stage', 'cause'])
+LLM_TOKENS = REGISTRY.counter('toad_llm_tokens_total', 'Tokens reported by the LLM API, by pipeline stage and kind.',
+                              ['stage', 'kind'])
+DATAPOINTS = REGISTRY.counter('toad_datapoints_total', 'Finished datapoints, by outcome (generated or failed).',
+                              ['outcome'])
+QUEUE_DEPTH = REGISTRY.gauge(
+    'toad_queue_depth', 'Items waiting or in progress, by queue (pending and in_flight datapoints, llm_waiting '
+    'requests of the async engine, turn_batch turns waiting for a batch).', ['queue'])
+DIALOGS_PER_MINUTE = REGISTRY.gauge('toad_dialogs_per_minute', 'Generated datapoints per minute since the start.')
+TOKENS_PER_SECOND = REGISTRY.gauge('toad_tokens_per_second', 'LLM tokens per second since the start.')
+
+
+@contextmanager
+def track_llm_request(stage: str):
+    """ Measure an LLM request of `stage` (latency and requests in flight). """
+    LLM_IN_FLIGHT.inc(stage=stage)
+    try:
+        with LLM_LATENCY.time(stage=stage):
+            yield
+    finally:
+        LLM_IN_FLIGHT.dec(stage=stage)
+
+
+def record_llm_usage(stage: str, usage) -> None:
+    if usage is None:
+        return
+    LLM_TOKENS.inc(getattr(usage, 'prompt_tokens', 0) or 0, stage=stage, kind='prompt')
+    LLM_TOKENS.inc(getattr(usage, 'completion_tokens', 0) or 0, stage=stage, kind='completion')
+
+
+def track_throughput(start_time: float = None, registry: MetricsRegistry = REGISTRY) -> None:
+    """ Keep the dialogs per minute and tokens per second gauges up to date (measured from `start_time`). """
+    start_time = start_time or time.time()
+
+    def collect():
+        elapsed = max(time.time() - start_time, 1e-9)
+        DIALOGS_PER_MINUTE.set(60 * DATAPOINTS.get(outcome='generated') / elapsed)
+        TOKENS_PER_SECOND.set(LLM_TOKENS.total() / elapsed)
+    registry.add_collector(collect)
+
+
+def format_stage_summary() -> str:
+    """ Requests, mean latency and total wall-clock time of the LLM requests of each stage, slowest first. """
+    stats = sorted(LLM_LATENCY.stats().items(), key=lambda item: -item[1][1])
+    return '; '.join(f'{stage}: {count} requests, {total / count:.2f} s mean, {total:.1f} s total'
+                     for (stage,), (count, total) in stats if count)
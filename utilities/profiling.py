@@ -0,0 +1,254 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Built-in profiler of the pipeline entry points (`--profile`), to find the CPU-side bottlenecks that cap the
+throughput once the LLM is fast.
+
+Three complementary views, each optional:
+- `cpu`: a cProfile per thread (worker threads included) timed with the thread's CPU time, merged at the end;
+- `wall`: a sampling profiler that records the stacks of all the threads every few milliseconds (where wall-clock
+  time goes, including waiting for the LLM);
+- `memory`: tracemalloc snapshots at the start and the end (peak usage, allocation sites, growth).
+The report lists the functions of this repository (e.g. `generic_intent_plot_generator`, `MetaAction.realize`,
+`convert_context`), whose cumulative time includes the libraries they call, and the time spent in third-party and
+standard library code by package (e.g. `jinja2` for template rendering).
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+PROFILE_KINDS = ['cpu', 'wall', 'memory']
+
+REPO_ROOT = str(Path(__file__).resolve().parents[1]) + os.sep
+
+
+def is_own_code(filename: str) -> bool:
+    return filename.startswith(REPO_ROOT)
+
+
+def get_package(filename: str, function_name: str = '') -> str:
+    """ The package of a code location: the top-level module of installed or standard library code. """
+    if filename == '~' or not filename:  # Built-in functions
+        return 'builtins'
+    parts = Path(filename).parts
+    for marker in ('site-packages', 'dist-packages'):
+        if marker in parts:
+            return Path(parts[parts.index(marker) + 1]).stem
+    for i, part in enumerate(parts):
+        if part.startswith('python3') and i + 1 < len(parts):
+            return Path(parts[i + 1]).stem
+    return Path(filename).stem
+
+
+def _format_location(filename: str, lineno: int, name: str) -> str:
+    if is_own_code(filename):
+        filename = filename[len(REPO_ROOT):]
+    return f'{name} ({filename}:{lineno})'
+
+
+def _format_rows(header: Tuple[str, ...], rows: List[Tuple]) -> str:
+    cells = [tuple(f'{cell:.3f}' if isinstance(cell, float) else str(cell) for cell in row) for row in rows]
+    widths = [max(len(column), *(len(row[i]) for row in cells)) if cells else len(column)
+              for i, column in enumerate(header)]
+    lines = ['  '.join(column.rjust(width) for column, width in zip(header[:-1], widths)) + '  ' + header[-1]]
+    lines.extend('  '.join(cell.rjust(width) for cell, width in zip(row[:-1], widths)) + '  ' + row[-1]
+                 for row in cells)
+    return '\n'.join(lines)
+
+
+class StackSampler:
+    """ Samples the stacks of all the threads (except its own) every `interval` seconds. """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.self_samples = Counter()  # Innermost frame -> samples
+        self.cumulative_samples = Counter()  # Function anywhere on the stack -> samples
+        self.num_samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='profiling-sampler', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self.num_samples += 1
+                code = frame.f_code
+                self.self_samples[(code.co_filename, code.co_firstlineno, getattr(code, 'co_qualname', code.co_name))] += 1
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_firstlineno, getattr(code, 'co_qualname', code.co_name))
+                    if key not in seen:
+                        seen.add(key)
+                        self.cumulative_samples[key] += 1
+                    frame = frame.f_back
+
+    def report(self, top: int) -> str:
+        seconds = self.interval
+        own = sorted(((key, count) for key, count in self.cumulative_samples.items() if is_own_code(key[0])),
+                     key=lambda item: -item[1])[:top]
+        packages = Counter()
+        for (filename, _, name), count in self.self_samples.items():
+            packages['(own code)' if is_own_code(filename) else get_package(filename, name)] += count
+        lines = [f'Own functions by cumulative wall time (thread-seconds, {self.num_samples} samples every '
+                 f'{self.interval * 1000:g} ms):',
+                 _format_rows(('cum_s', 'self_s', 'function'),
+                              [(count * seconds, self.self_samples[key] * seconds, _format_location(*key))
+                               for key, count in own]),
+                 '', 'Wall time by package (thread-seconds, innermost frame; idle worker threads count too):',
+                 _format_rows(('self_s', 'package'), [(count * seconds, package)
+                                                      for package, count in packages.most_common(top)])]
+        return '\n'.join(lines)
+
+
+class StageProfiler:
+    """ Profiles the process between `start()` and `stop()`, see the module docstring. Threads started after
+    `start()` get their own CPU profile; on Python 3.12+, where cProfile instruments all the threads at once, a
+    single profiler measures the whole process instead (with wall-clock timing).
+    """
+
+    def __init__(self, kinds=PROFILE_KINDS, sample_interval: float = 0.01, top: int = 25):
+        unknown = set(kinds) - set(PROFILE_KINDS)
+        if unknown:
+            raise ValueError(f"Unknown profile kinds {sorted(unknown)}, expected some of {PROFILE_KINDS}")
+        self.kinds = list(kinds)
+        self.top = top
+        self.per_thread = sys.version_info < (3, 12)
+        self.profiles: List[cProfile.Profile] = []
+        self.lock = threading.Lock()
+        self.sampler = StackSampler(sample_interval) if 'wall' in self.kinds else None
+        self.start_snapshot = None
+        self.end_snapshot = None
+        self.start_time = None
+        self.elapsed = None
+
+    def _new_profile(self) -> cProfile.Profile:
+        profile = cProfile.Profile(time.thread_time) if self.per_thread else cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+    def _profile_new_thread(self, frame, event, arg):
+        # Installed with threading.setprofile: runs at the first event of every new thread
+        sys.setprofile(None)
+        if self.sampler is not None and threading.current_thread() is self.sampler.thread:
+            return
+        self._new_profile().enable()
+
+    def start(self) -> 'StageProfiler':
+        self.start_time = time.perf_counter()
+        if 'memory' in self.kinds:
+            tracemalloc.start()
+            self.start_snapshot = tracemalloc.take_snapshot()
+        if self.sampler is not None:
+            self.sampler.start()
+        if 'cpu' in self.kinds:
+            if self.per_thread:
+                threading.setprofile(self._profile_new_thread)
+            self._new_profile().enable()
+        return self
+
+    def stop(self) -> 'StageProfiler':
+        if 'cpu' in self.kinds:
+            threading.setprofile(None)
+            self.profiles[0].disable()  # The profile of this thread (the worker threads have finished)
+        if self.sampler is not None:
+            self.sampler.stop()
+        if 'memory' in self.kinds:
+            self.end_snapshot = tracemalloc.take_snapshot()
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.elapsed = time.perf_counter() - self.start_time
+        return self
+
+    def get_stats(self) -> pstats.Stats:
+        """ The CPU profiles of all the threads, merged. """
+        stats = pstats.Stats(self.profiles[0], stream=io.StringIO())
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def _cpu_report(self) -> str:
+        stats = self.get_stats()
+        entries: Dict[Tuple, Tuple] = stats.stats
+        own = sorted(((key, value) for key, value in entries.items() if is_own_code(key[0])),
+                     key=lambda item: -item[1][3])[:self.top]
+        packages = Counter()
+        for (filename, _, name), (_, _, self_time, _, _) in entries.items():
+            packages['(own code)' if is_own_code(filename) else get_package(filename, name)] += self_time
+        timing = f'CPU time of {len(self.profiles)} threads' if self.per_thread else 'wall time of all the threads'
+        return '\n'.join([
+            f'Own functions by cumulative {timing} (seconds):',
+            _format_rows(('cum_s', 'self_s', 'calls', 'function'),
+                         [(cumulative, self_time, calls, _format_location(*key))
+                          for key, (_, calls, self_time, cumulative, _) in own]),
+            '', f'Self {timing} by package (seconds):',
+            _format_rows(('self_s', 'package'), [(seconds, package) for package, seconds in packages.most_common(self.top)]),
+        ])
+
+    def _memory_report(self) -> str:
+        own_filter = [tracemalloc.Filter(True, REPO_ROOT + '*')]
+        top_sites = self.end_snapshot.filter_traces(own_filter).statistics('lineno')[:self.top]
+        growth = self.end_snapshot.compare_to(self.start_snapshot, 'lineno')[:self.top]
+        return '\n'.join([
+            f'Peak traced memory: {self.peak_memory / 2 ** 20:.1f} MiB',
+            'Memory held at the end, by allocation site in own code (MiB):',
+            _format_rows(('MiB', 'blocks', 'site'),
+                         [(stat.size / 2 ** 20, stat.count, str(stat.traceback[0])) for stat in top_sites]),
+            '', 'Memory growth since the start, by allocation site (MiB):',
+            _format_rows(('MiB', 'site'), [(stat.size_diff / 2 ** 20, str(stat.traceback[0])) for stat in growth]),
+        ])
+
+    def report(self) -> str:
+        sections = [f'Profiled {self.elapsed:.1f} s ({", ".join(self.kinds)})']
+        if 'cpu' in self.kinds:
+            sections.append(self._cpu_report())
+        if self.sampler is not None:
+            sections.append(self.sampler.report(self.top))
+        if 'memory' in self.kinds:
+            sections.append(self._memory_report())
+        return '\n\n'.join(sections) + '\n'
+
+    def save(self, prefix) -> str:
+        """ Write the report to `{prefix}.txt` and the merged CPU profile to `{prefix}.pstats` (e.g. for snakeviz).
+        Returns the report.
+        """
+        report = self.report()
+        with open(f'{prefix}.txt', 'w') as fp:
+            fp.write(report)
+        if 'cpu' in self.kinds:
+            self.get_stats().dump_stats(f'{prefix}.pstats')
+        logging.warning(f"Profile written to {prefix}.txt")
+        return report
+
+
+def add_profile_argument(parser) -> None:
+    parser.add_argument('--profile', type=str, nargs='*', choices=PROFILE_KINDS, default=None,
+                        help="Profile the run (`cpu`, `wall` and/or `memory`, all of them if none is given) and "
+                             "write a report of the hot spots. `memory` slows the run down noticeably.")
+
+
+def start_profiler(kinds) -> StageProfiler:
+    """ A started profiler for the value of `--profile`, or None if profiling is off. """
+    if kinds is None:
+        return None
+    return StageProfiler(kinds or PROFILE_KINDS).start()
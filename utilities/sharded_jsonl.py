@@ -0,0 +1,306 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+""" Rolling, optionally compressed JSONL shards with a manifest, and a reader for all JSONL layouts.
+
+A sharded dataset is a directory of `part-00000.jsonl[.gz|.zst]` files plus a `manifest.json` that lists the
+shards with their record counts, sizes and sha256 checksums.
+"""
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional
+
+MANIFEST_FILE = 'manifest.json'
+COMPRESSION_SUFFIXES = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+SHARD_PATTERN = re.compile(r'^part-(\d+)\.jsonl(\.gz|\.zst)?$')
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the `zstandard` package (pip install zstandard)")
+    return zstandard
+
+
+class _HashingFile(io.RawIOBase):
+    """ Write-only file wrapper that keeps the sha256 and size of the (compressed) bytes written. """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.fp.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        if not self.closed:
+            super().close()  # Flushes
+            self.fp.close()
+
+
+class _ShardStream:
+    """ An open shard: the compression layer on top of a hashing file. """
+
+    def __init__(self, path: Path, compression: str):
+        self.path = path
+        self.compression = compression
+        self.raw = _HashingFile(open(path, 'wb'))
+        if compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        elif compression == 'zstd':
+            self.stream = _import_zstandard().ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = self.raw
+        self.records = 0
+        self.uncompressed_bytes = 0
+
+    def write(self, data: bytes):
+        self.stream.write(data)
+        self.uncompressed_bytes += len(data)
+
+    def flush(self):
+        if self.compression == 'gzip':
+            self.stream.flush(zlib.Z_SYNC_FLUSH)
+        elif self.compression == 'zstd':
+            self.stream.flush(_import_zstandard().FLUSH_BLOCK)
+        self.raw.flush()
+
+    def close(self) -> dict:
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.close()
+        return {'file': self.path.name, 'records': self.records, 'bytes': self.raw.size, 'sha256': self.raw.sha256.hexdigest()}
+
+
+def _describe_shard(path: Path) -> dict:
+    """ Manifest entry of an existing shard (e.g. one left open by a crashed run). """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha256.update(chunk)
+    records = sum(1 for _ in _iter_file_lines(path))
+    return {'file': path.name, 'records': records, 'bytes': path.stat().st_size, 'sha256': sha256.hexdigest()}
+
+
+def load_manifest(directory: Path) -> dict:
+    try:
+        with open(directory / MANIFEST_FILE, 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {'shards': [], 'total_records': 0}
+
+
+def _save_manifest(directory: Path, manifest: dict) -> None:
+    manifest['total_records'] = sum(shard['records'] for shard in manifest['shards'])
+    tmp_path = directory / (MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    os.replace(tmp_path, directory / MANIFEST_FILE)
+
+
+def _list_shards(directory: Path) -> List[Path]:
+    shards = [p for p in directory.iterdir() if SHARD_PATTERN.match(p.name)]
+    return sorted(shards, key=lambda p: int(SHARD_PATTERN.match(p.name).group(1)))
+
+
+class ShardedJsonlWriter:
+    """ Writes JSONL records into a directory of shards, starting a new shard after `max_records` records or
+    `max_bytes` uncompressed bytes, and keeps the manifest up to date whenever a shard is closed.
+    Opening an existing directory appends new shards (shards left unlisted by a crash are added to the manifest).
+    Compressed shards are flushed at most every `flush_interval` seconds, since every flush costs compression ratio.
+    """
+
+    def __init__(self, directory: Path, max_records: Optional[int] = None, max_bytes: Optional[int] = None,
+                 compression: str = 'none', erase: bool = False, flush_interval: float = 5.0):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"unknown compression: {compression}")
+        if compression == 'zstd':
+            _import_zstandard()
+        self.directory = Path(directory)
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.flush_interval = flush_interval
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        existing_shards = _list_shards(self.directory)
+        if erase:
+            for path in existing_shards:
+                path.unlink()
+            existing_shards = []
+            self.manifest = {'shards': [], 'total_records': 0}
+        else:
+            self.manifest = load_manifest(self.directory)
+            listed = {shard['file'] for shard in self.manifest['shards']}
+            for path in existing_shards:
+                if path.name not in listed:
+                    logging.warning(f"Adding unlisted shard {path} to the manifest")
+                    self.manifest['shards'].append(_describe_shard(path))
+        self.manifest['compression'] = compression
+        _save_manifest(self.directory, self.manifest)
+
+        self.next_shard_index = int(SHARD_PATTERN.match(existing_shards[-1].name).group(1)) + 1 if existing_shards else 0
+        self.first_shard_index = self.next_shard_index  # The first shard written by this writer
+        self.current: Optional[_ShardStream] = None
+        self.last_flush = time.monotonic()
+
+    def _open_shard(self):
+        name = f'part-{self.next_shard_index:05d}.jsonl{COMPRESSION_SUFFIXES[self.compression]}'
+        self.next_shard_index += 1
+        self.current = _ShardStream(self.directory / name, self.compression)
+
+    def _close_shard(self):
+        if self.current is None:
+            return
+        self.manifest['shards'].append(self.current.close())
+        self.current = None
+        _save_manifest(self.directory, self.manifest)
+
+    def write(self, text: str) -> None:
+        """ Write one complete record line (including its trailing newline). """
+        if self.current is None:
+            self._open_shard()
+        self.current.write(text.encode('utf8'))
+        self.current.records += 1
+        if (self.max_records and self.current.records >= self.max_records) or \
+                (self.max_bytes and self.current.uncompressed_bytes >= self.max_bytes):
+            self._close_shard()
+
+    def flush(self) -> None:
+        if self.current is None:
+            return
+        now = time.monotonic()
+        if self.compression == 'none' or now - self.last_flush >= self.flush_interval:
+            self.current.flush()
+            self.last_flush = now
+
+    def close(self) -> None:
+        self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _open_text(path: Path):
+    if path.name.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf8')
+    if path.name.endswith('.zst'):
+        reader = _import_zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf8')
+    return open(path, 'r', encoding='utf8')
+
+
+def _iter_file_lines(path: Path) -> Iterator[str]:
+    with _open_text(path) as fp:
+        try:
+            for line in fp:
+                yield line
+        except (EOFError, OSError) as e:  # includes zstd.ZstdError
+            # A compressed shard that was not closed properly (e.g. after a crash): keep what could be read
+            logging.warning(f"Stopped reading truncated file {path}: {repr(e)}")
+
+
+def is_sharded_directory(path) -> bool:
+    path = Path(path)
+    return path.is_dir() and ((path / MANIFEST_FILE).is_file() or bool(_list_shards(path)))
+
+
+def resolve_jsonl_path(path) -> Optional[Path]:
+    """ Find the data stored under a `xxx.jsonl` path: the file itself, a compressed `xxx.jsonl.gz`/`xxx.jsonl.zst`,
+    or a sharded directory `xxx/`. Returns None if there is none.
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    for suffix in ['.gz', '.zst']:
+        candidate = path.with_name(path.name + suffix)
+        if candidate.is_file():
+            return candidate
+    if path.suffix == '.jsonl' and is_sharded_directory(path.with_suffix('')):
+        return path.with_suffix('')
+    return None
+
+
+def iter_jsonl_lines(path) -> Iterator[str]:
+    """ Iterate over the lines of a JSONL file (optionally compressed), a sharded directory, or its manifest.
+    """
+    path = Path(path)
+    if path.name == MANIFEST_FILE:
+        path = path.parent
+    if path.is_dir():
+        for shard in _list_shards(path):
+            yield from _iter_file_lines(shard)
+    else:
+        yield from _iter_file_lines(path)
+
+
+def verify_shards(directory: Path) -> List[str]:
+    """ Return the files whose checksum doesn't match the manifest. """
+    mismatched = []
+    for shard in load_manifest(Path(directory))['shards']:
+        path = Path(directory) / shard['file']
+        if not path.is_file() or _describe_shard(path)['sha256'] != shard['sha256']:
+            mismatched.append(shard['file'])
+    return mismatched
+
+
+def sort_shards(writer: ShardedJsonlWriter, key: Callable[[str], object], run_size: int = 10000) -> None:
+    """ Reorder the records of the shards written by a (closed) writer by `key`, keeping the shard boundaries policy.
+    The records are sorted in runs of `run_size` lines written to temporary files, which are then merged, so at most
+    `run_size` records are held in memory whatever the shard size (e.g. a single compressed shard for the whole run).
+    """
+    directory = writer.directory
+    written = [shard for shard in writer.manifest['shards']
+               if int(SHARD_PATTERN.match(shard['file']).group(1)) >= writer.first_shard_index]
+    if not written:
+        return
+    lines = (line if line.endswith('\n') else line + '\n'
+             for shard in written for line in _iter_file_lines(directory / shard['file']))
+    run_paths = []
+    while True:
+        run = sorted(itertools.islice(lines, run_size), key=key)
+        if not run:
+            break
+        run_path = directory / f'.sort-run-{len(run_paths):05d}.jsonl'
+        with open(run_path, 'w', encoding='utf8') as fp:
+            fp.writelines(run)
+        run_paths.append(run_path)
+
+    writer.manifest['shards'] = [shard for shard in writer.manifest['shards'] if shard not in written]
+    for shard in written:
+        (directory / shard['file']).unlink()
+    writer.next_shard_index = writer.first_shard_index
+    run_files = [open(p, 'r', encoding='utf8') for p in run_paths]
+    try:
+        for line in heapq.merge(*run_files, key=key):
+            writer.write(line)
+        writer.close()
+    finally:
+        for fp, p in zip(run_files, run_paths):
+            fp.close()
+            p.unlink()